@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Shared test fixtures: sample chunks, a temporary cache directory and a pipeline wired to fake Ollama models
+"""
+
+import asyncio
+import time
+from pathlib import Path
+from typing import Optional
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from rag_tool import cache, document_processor, indexing, pipeline, query_transformer, snapshot, translation
+
+class FakeOllama(LLM):
+    """Answers every prompt with `answer`, streamed word by word, after `delay` seconds.
+    
+    With `fail_after` set, a stream fails after that many words.
+    """
+    model: str = "fake"
+    answer: str = "The committee approved the budget"
+    delay: float = 0.0
+    fail_after: Optional[int] = None
+    calls: list = []
+
+    @property
+    def _llm_type(self):
+        return "fake-ollama"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        self.calls.append(prompt)
+        time.sleep(self.delay)
+        return self.answer
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs):
+        self.calls.append(prompt)
+        await asyncio.sleep(self.delay)
+        return self.answer
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        self.calls.append(prompt)
+        time.sleep(self.delay)
+        for i, word in enumerate(self.answer.split(" ")):
+            if i == self.fail_after:
+                raise RuntimeError("Generator connection lost")
+            yield GenerationChunk(text=word + " ")
+
+@pytest.fixture
+def make_chunks():
+    """Build fresh sample chunks: English and Arabic, two chunks from one source"""
+    def make():
+        return [
+            Document(page_content="The committee approved the budget for 2024 under item 7C",
+                     metadata={"source": "a.pdf", "language": "en", "start_index": 0}),
+            Document(page_content="وافقت اللجنة على الميزانية", metadata={"source": "b.pdf", "language": "ar", "start_index": 0}),
+            Document(page_content="Minutes of the security committee meeting",
+                     metadata={"source": "a.pdf", "language": "en", "start_index": 896}),
+        ]
+    return make
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Point every module's cache directory at a temporary one"""
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    for module in (cache, document_processor, indexing, pipeline, query_transformer, snapshot):
+        monkeypatch.setattr(module, "CACHE_DIR", str(directory))
+    return directory
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    """Replace the Ollama clients; generator, translator and query transformer share one FakeOllama"""
+    llm = FakeOllama(calls=[])
+    for module in (pipeline, query_transformer, translation):
+        monkeypatch.setattr(module, "OllamaLLM", lambda **kwargs: llm)
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    monkeypatch.setenv("GENERATOR_WARMUP_INTERVAL", "0")
+    return llm
+
+def read_document(path):
+    return Document(page_content=Path(path).read_text(), metadata={"source": str(path), "language": "en"})
+
+@pytest.fixture
+def make_pipeline(tmp_path, cache_dir, fake_models, monkeypatch):
+    """Build an initialized pipeline over text files written as `name.pdf: text`"""
+    monkeypatch.setattr(pipeline, "load_documents",
+                        lambda path, language: [read_document(p) for p in sorted(Path(path).rglob("*.pdf"))])
+    monkeypatch.setattr(pipeline, "load_files", lambda paths: [read_document(p) for p in paths])
+
+    def make(documents, language="en"):
+        docs_dir = tmp_path / "docs"
+        docs_dir.mkdir(exist_ok=True)
+        for name, text in documents.items():
+            (docs_dir / name).write_text(text)
+        rag = pipeline.FocusedRAGPipeline(str(docs_dir), language)
+        rag.initialize()
+        return rag
+    return make
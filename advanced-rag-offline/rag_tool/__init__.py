@@ -20,6 +20,7 @@ Example usage:
 from .pipeline import FocusedRAGPipeline
 from .document_processor import load_documents, chunk_text, raptor_clustering
 from .indexing import MultiRepresentationIndex
+from .sharding import ShardedIndex
 from .retrieval import RetrievalSystem
 from .translation import OfflineTranslationSystem
 
@@ -29,6 +30,7 @@ __all__ = [
     "chunk_text",
     "raptor_clustering",
     "MultiRepresentationIndex",
+    "ShardedIndex",
     "RetrievalSystem",
     "OfflineTranslationSystem"
 ]
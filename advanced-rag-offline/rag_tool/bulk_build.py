@@ -0,0 +1,167 @@
+from langchain_community.vectorstores import Chroma
+from rag_tool.metrics import EMBEDDED_CHUNKS, INGEST_THROUGHPUT, model_call
+import json
+import os
+import time
+
+CHECKPOINT_FILE = "build_checkpoint.json"
+# Chroma's database file; a persist directory without it holds no embeddings
+CHROMA_DATA_FILE = "chroma.sqlite3"
+
+class DenseIndexBuildIncomplete(Exception):
+    """Raised when a dense index build stops early; the next build resumes it"""
+    def __init__(self, committed, total):
+        self.committed = committed
+        self.total = total
+        super().__init__(
+            f"Dense index build stopped after {committed}/{total} chunks. "
+            "Progress is checkpointed and the next build will resume from there."
+        )
+
+class DenseIndexBuilder:
+    """Resumable bulk build of the dense Chroma index from a chunk store.
+
+    Chunks are embedded and upserted in batches of `batch_size`. After each
+    batch is committed to Chroma, the number of committed rows is written to
+    build_checkpoint.json inside the persist directory. A build that is
+    interrupted (crash, time budget, restart) resumes after the last
+    committed batch. Chunk IDs are the Chroma IDs, so replaying a batch that
+    was partially written before a crash is harmless.
+
+    `known_embeddings`, a function from chunk IDs to {chunk_id: vector},
+    supplies embeddings computed by a previous index; only the chunks it
+    does not know are sent to the embedding model.
+
+    A persist directory with Chroma data but no checkpoint was written in
+    one go by a release before resumable builds, and is complete ("legacy"
+    in the checkpoint); its Chroma IDs are not chunk IDs.
+    """
+
+    def __init__(self, chunk_store, embeddings, persist_dir, batch_size=None, time_budget=None,
+                 known_embeddings=None):
+        self.chunk_store = chunk_store
+        self.embeddings = embeddings
+        self.known_embeddings = known_embeddings
+        self.reused = 0
+        self.persist_dir = persist_dir
+        self.batch_size = int(batch_size or os.getenv("DENSE_BUILD_BATCH_SIZE", "256"))
+        budget = time_budget if time_budget is not None else os.getenv("DENSE_BUILD_TIME_BUDGET")
+        self.time_budget = float(budget) if budget else None
+        self.checkpoint_file = os.path.join(persist_dir, CHECKPOINT_FILE)
+        self.throughput = 0.0
+
+    def open(self):
+        """Open the Chroma collection in the persist directory"""
+        return Chroma(
+            persist_directory=self.persist_dir,
+            embedding_function=self.embeddings,
+            collection_name="dense_index",
+            collection_metadata={"hnsw:space": "cosine"}
+        )
+
+    @staticmethod
+    def has_chroma_data(persist_dir):
+        return os.path.exists(os.path.join(persist_dir, CHROMA_DATA_FILE))
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_file):
+            # Chroma data without a checkpoint predates resumable builds and is complete.
+            # A directory without Chroma data is a build that stopped before its first batch.
+            if self.has_chroma_data(self.persist_dir):
+                return {"committed": len(self.chunk_store), "total": len(self.chunk_store), "complete": True,
+                        "legacy": True}
+            return {"committed": 0, "total": len(self.chunk_store), "complete": False}
+        try:
+            with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error reading build checkpoint: {str(e)}")
+            return {"committed": 0, "total": len(self.chunk_store), "complete": False}
+
+    def write_checkpoint(self, committed, complete=False):
+        checkpoint = {"committed": committed, "total": len(self.chunk_store), "complete": complete}
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        # Atomic replace so a crash never leaves a torn checkpoint
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def is_complete(self):
+        checkpoint = self.read_checkpoint()
+        return checkpoint.get("complete", False) and checkpoint.get("total") == len(self.chunk_store)
+
+    def build(self):
+        """Embed all uncommitted chunks and return the Chroma index"""
+        checkpoint = self.read_checkpoint()
+        total = len(self.chunk_store)
+        committed = checkpoint.get("committed", 0) if checkpoint.get("total") == total else 0
+        if checkpoint.get("complete") and committed == total:
+            return self.open()
+        # The checkpoint is written before Chroma touches the directory, so Chroma
+        # data without a checkpoint is always a finished legacy build
+        os.makedirs(self.persist_dir, exist_ok=True)
+        if committed:
+            print(f"♻️ Resuming dense index build at {committed}/{total} chunks")
+        else:
+            self.write_checkpoint(0)
+        vectorstore = self.open()
+
+        store = self.chunk_store
+        started = time.time()
+        embedded = 0
+        for begin in range(committed, total, self.batch_size):
+            if self.time_budget is not None and time.time() - started > self.time_budget:
+                raise DenseIndexBuildIncomplete(committed, total)
+            end = min(begin + self.batch_size, total)
+            rows = range(begin, end)
+            metadatas = [{"chunk_id": store.chunk_id(row), "source": store.metadata(row)["source"]} for row in rows]
+            texts = [store.text(row) for row in rows]
+            ids = [metadata["chunk_id"] for metadata in metadatas]
+            known = self.known_embeddings(ids) if self.known_embeddings is not None else {}
+            reused_rows = [i for i, chunk_id in enumerate(ids) if chunk_id in known]
+            new_rows = [i for i, chunk_id in enumerate(ids) if chunk_id not in known]
+            if reused_rows:
+                vectorstore._collection.upsert(
+                    ids=[ids[i] for i in reused_rows],
+                    embeddings=[[float(x) for x in known[ids[i]]] for i in reused_rows],
+                    metadatas=[metadatas[i] for i in reused_rows],
+                    documents=[texts[i] for i in reused_rows]
+                )
+                self.reused += len(reused_rows)
+                EMBEDDED_CHUNKS.inc(len(reused_rows), source="reused")
+            if new_rows:
+                self._add_batch(
+                    vectorstore,
+                    [texts[i] for i in new_rows],
+                    [metadatas[i] for i in new_rows],
+                    [ids[i] for i in new_rows]
+                )
+                EMBEDDED_CHUNKS.inc(len(new_rows), source="model")
+            committed = end
+            self.write_checkpoint(committed)
+
+            embedded += end - begin
+            elapsed = max(time.time() - started, 1e-6)
+            self.throughput = embedded / elapsed
+            INGEST_THROUGHPUT.set(self.throughput)
+            remaining = (total - committed) / self.throughput if self.throughput else 0
+            print(f"📦 Embedded {committed}/{total} chunks ({self.throughput:.1f} chunks/s, ~{remaining:.0f}s remaining)")
+
+        self.write_checkpoint(total, complete=True)
+        if self.reused:
+            print(f"♻️ Reused {self.reused} embeddings from the previous index")
+        return vectorstore
+
+    def _add_batch(self, vectorstore, texts, metadatas, ids, max_retries=3, base_delay=5):
+        """Embed and upsert one batch, retrying with exponential backoff"""
+        for attempt in range(max_retries):
+            try:
+                with model_call(self.embeddings, "embed"):
+                    vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
+                return
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    raise
+                print(f"⚠️ Embedding batch attempt {attempt + 1} failed: {str(e)}")
+                print(f"🔄 Retrying in {base_delay * (2 ** attempt)} seconds...")
+                time.sleep(base_delay * (2 ** attempt))
@@ -0,0 +1,242 @@
+from rag_tool.metrics import CACHE_REQUESTS
+from collections import OrderedDict
+import glob
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+# Cache directory
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+def config_fingerprint(**parts):
+    """Short stable hash of everything a cached result depends on (corpus version, models, prompts)"""
+    hash_input = "|".join(f"{name}={parts[name]}" for name in sorted(parts))
+    return hashlib.md5(hash_input.encode()).hexdigest()[:12]
+
+class CacheEntry:
+    """A cached value with its write time (epoch seconds) and time to live (None: no expiry)"""
+
+    def __init__(self, value, saved_at, ttl=None):
+        self.value = value
+        self.saved_at = saved_at
+        self.ttl = ttl
+
+    def age(self):
+        return time.time() - self.saved_at
+
+    def fresh(self):
+        return self.ttl is None or self.age() <= self.ttl
+
+class VersionedCache:
+    """Pickle cache on disk with an in-memory LRU tier in front of it.
+
+    Files are named {prefix}_{fingerprint}_{key}.pkl, so entries written for
+    another corpus version or model/config fingerprint are never read as
+    fresh. Entries expire after `ttl` seconds (per cache, or per entry on
+    save); None keeps them until the fingerprint changes. Memory hits skip
+    the disk entirely; callers must not mutate returned values.
+
+    With a `stale_ttl`, lookup() also returns entries up to that many
+    seconds past expiry, and entries of earlier fingerprints up to that old,
+    flagged as stale so the caller can serve them and refresh in the
+    background. Only one earlier fingerprint is read: that of `previous`,
+    the cache this one replaces (its memory tier is searched before the
+    disk), or after a restart the one recorded in {prefix}.fingerprint,
+    which names the last two fingerprints caches of this prefix were opened with.
+
+    Entries of fingerprints this process replaced are deleted lazily: gc()
+    runs on the first save and then at most once every `gc_interval`
+    seconds, and keeps the ones still young enough to be served stale.
+    Other fingerprints may still be served by other worker processes, so
+    their entries are only deleted once nobody wrote them for
+    CACHE_ORPHAN_TTL seconds.
+    """
+
+    def __init__(self, prefix, fingerprint, capacity=None, gc_interval=None, cache_dir=None, ttl=None,
+                 stale_ttl=0, previous=None):
+        self.prefix = prefix
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.capacity = int(capacity or os.getenv("MEMORY_CACHE_SIZE", "512"))
+        self.gc_interval = float(gc_interval if gc_interval is not None else os.getenv("CACHE_GC_INTERVAL", "3600"))
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.orphan_ttl = float(os.getenv("CACHE_ORPHAN_TTL", str(7 * 24 * 3600)))
+        # Fingerprints this process served under this prefix before, whose entries gc() collects
+        self.replaced = set()
+        if previous is not None:
+            self.replaced = (previous.replaced | {previous.fingerprint}) - {fingerprint}
+            # Only the directly replaced cache is kept, not the whole history
+            previous.previous = None
+        self.previous = previous if stale_ttl else None
+        recorded = self._record_fingerprint()
+        self.previous_fingerprint = previous.fingerprint if previous is not None else recorded
+        if self.previous_fingerprint == fingerprint:
+            self.previous_fingerprint = None
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_gc = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+
+    def path(self, key, fingerprint=None):
+        return os.path.join(self.cache_dir, f"{self.prefix}_{fingerprint or self.fingerprint}_{key}.pkl")
+
+    def _record_fingerprint(self):
+        """Record this cache's fingerprint as the current one; returns the fingerprint used before it"""
+        record = os.path.join(self.cache_dir, f"{self.prefix}.fingerprint")
+        try:
+            with open(record, "r", encoding="utf-8") as f:
+                recorded = f.read().split()
+        except OSError:
+            recorded = []
+        current, before = (recorded + [None, None])[:2]
+        if current == self.fingerprint:
+            return before
+        tmp_file = f"{record}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(" ".join(fingerprint for fingerprint in (self.fingerprint, current) if fingerprint))
+            os.replace(tmp_file, record)
+        except OSError as e:
+            print(f"Warning: Could not record the {self.prefix} cache fingerprint: {str(e)}")
+        return current
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.capacity:
+                self.memory.popitem(last=False)
+
+    def _read_file(self, cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            print(f"Error loading {self.prefix} cache {os.path.basename(cache_file)}: {str(e)}")
+            # Remove corrupted cache file
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+            return None
+        if not isinstance(entry, CacheEntry):
+            # Written before entries carried their age
+            entry = CacheEntry(entry, os.path.getmtime(cache_file))
+        return entry
+
+    def _read(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        cache_file = self.path(key)
+        if not os.path.exists(cache_file):
+            return None
+        entry = self._read_file(cache_file)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def _read_previous(self, key):
+        """The entry for key written under the previous fingerprint"""
+        if self.previous is not None:
+            with self.previous.lock:
+                entry = self.previous.memory.get(key)
+            if entry is not None:
+                return entry
+        if self.previous_fingerprint is None:
+            return None
+        cache_file = self.path(key, self.previous_fingerprint)
+        if not os.path.exists(cache_file):
+            return None
+        return self._read_file(cache_file)
+
+    def load(self, key):
+        """The fresh value for key, or None"""
+        value, stale = self.lookup(key, allow_stale=False)
+        return value
+
+    def lookup(self, key, allow_stale=True):
+        """Return (value, stale); (None, False) on a miss"""
+        entry = self._read(key)
+        if entry is not None and entry.fresh():
+            self.hits += 1
+            CACHE_REQUESTS.inc(namespace=self.prefix, result="hit")
+            return entry.value, False
+        if entry is not None:
+            self.expired += 1
+        if allow_stale and self.stale_ttl:
+            if entry is not None and entry.age() <= entry.ttl + self.stale_ttl:
+                self.stale += 1
+                CACHE_REQUESTS.inc(namespace=self.prefix, result="stale")
+                return entry.value, True
+            entry = self._read_previous(key)
+            if entry is not None and entry.age() <= self.stale_ttl:
+                self.stale += 1
+                CACHE_REQUESTS.inc(namespace=self.prefix, result="stale")
+                return entry.value, True
+        self.misses += 1
+        CACHE_REQUESTS.inc(namespace=self.prefix, result="miss")
+        return None, False
+
+    def save(self, key, data, ttl=None):
+        entry = CacheEntry(data, time.time(), ttl if ttl is not None else self.ttl)
+        cache_file = self.path(key)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_file, cache_file)
+        self._remember(key, entry)
+        if self.last_gc is None or time.monotonic() - self.last_gc >= self.gc_interval:
+            self.gc()
+        return cache_file
+
+    def gc(self):
+        """Delete this prefix's entries of replaced fingerprints, unless they can still be served stale,
+        and entries of other fingerprints nobody wrote for orphan_ttl seconds"""
+        self.last_gc = time.monotonic()
+        removed = 0
+        for cache_file in glob.glob(os.path.join(self.cache_dir, f"{self.prefix}_*.pkl")):
+            name = os.path.basename(cache_file)[len(self.prefix) + 1:]
+            fingerprint = name.split("_", 1)[0] if "_" in name else None
+            if fingerprint == self.fingerprint:
+                continue
+            try:
+                age = time.time() - os.path.getmtime(cache_file)
+                keep_for = self.stale_ttl if fingerprint in self.replaced else self.orphan_ttl
+                if age <= keep_for:
+                    continue
+                os.remove(cache_file)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"🧹 Removed {removed} stale {self.prefix} cache entries")
+        return removed
+
+    def clear_memory(self):
+        with self.lock:
+            self.memory.clear()
+        if self.previous is not None:
+            self.previous.clear_memory()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        return {
+            "entries_in_memory": len(self.memory),
+            "capacity": self.capacity,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
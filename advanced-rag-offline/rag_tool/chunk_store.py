@@ -0,0 +1,221 @@
+from langchain_core.documents import Document
+from rag_tool.versioned_dir import current_version, new_version, publish_version
+import numpy as np
+import hashlib
+import json
+import mmap
+import os
+
+# Metadata columns whose values repeat across chunks are interned:
+# each row stores an integer code into a small vocabulary file.
+INTERNED_COLUMNS = ("source", "language")
+
+# Bytes of kept chunk texts copied per read when a store is written from another one
+COPY_BYTES = 16 * 1024 * 1024
+
+def make_chunk_id(source, start_index, text):
+    """Generate a stable chunk ID from the chunk's source, offset and content"""
+    hash_input = f"{source}\x00{start_index}\x00{text}"
+    return hashlib.md5(hash_input.encode("utf-8")).hexdigest()[:16]
+
+def chunk_id_for(doc):
+    """Return the stable chunk ID of a langchain Document"""
+    if "chunk_id" in doc.metadata:
+        return doc.metadata["chunk_id"]
+    return make_chunk_id(
+        doc.metadata.get("source", "Unknown"),
+        doc.metadata.get("start_index", -1),
+        doc.page_content
+    )
+
+class ChunkStore:
+    """Memory-mapped columnar storage for document chunks.
+
+    A store directory holds immutable versions and a CURRENT file naming
+    the published one (see rag_tool.versioned_dir). Layout of a version:
+        texts.bin          all chunk texts as one UTF-8 blob
+        offsets.npy        int64 byte offsets into texts.bin (n + 1 entries)
+        chunk_ids.npy      stable 16-char chunk IDs in row order
+        sorted_ids.npy     chunk IDs sorted, for binary-search lookup
+        sorted_rows.npy    row of each entry in sorted_ids.npy
+        <column>.npy       int32 codes of an interned metadata column
+        <column>.json      vocabulary of an interned metadata column
+        start_index.npy    int64 character offset of the chunk in its source
+        manifest.json      row count and column names
+
+    Nothing is loaded eagerly: numpy columns are opened with mmap_mode="r"
+    and the text blob is mmapped, so resident memory is whatever the OS
+    page cache keeps. Documents are only materialized on request.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # The version opened; a rebuild publishes a new one and leaves these files alone
+        self.path = current_version(directory)
+        with open(os.path.join(self.path, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.count = self.manifest["count"]
+        self.offsets = self._load_column("offsets")
+        self.chunk_ids = self._load_column("chunk_ids")
+        self.sorted_ids = self._load_column("sorted_ids")
+        self.sorted_rows = self._load_column("sorted_rows")
+        self.start_index = self._load_column("start_index")
+        self.codes = {}
+        self.vocabularies = {}
+        for column in INTERNED_COLUMNS:
+            self.codes[column] = self._load_column(column)
+            with open(os.path.join(self.path, f"{column}.json"), "r", encoding="utf-8") as f:
+                self.vocabularies[column] = json.load(f)
+        self._text_file = None
+        self._texts = b""
+        self.closed = False
+        if os.path.getsize(os.path.join(self.path, "texts.bin")) > 0:
+            self._text_file = open(os.path.join(self.path, "texts.bin"), "rb")
+            self._texts = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_column(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    @classmethod
+    def build(cls, chunks, directory):
+        """Write chunks into a new version of a store directory, publish it and open it"""
+        return cls.build_from(None, [], chunks, directory)
+
+    @classmethod
+    def build_from(cls, base, rows, chunks, directory):
+        """Write `rows` of the store `base` followed by `chunks` into a new version, publish it and open it.
+
+        The kept rows are copied column by column: their texts as byte ranges
+        of texts.bin and everything else as numpy slices, so none of them is
+        materialized as a Document. Only `chunks` are encoded.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        kept = len(rows)
+        count = kept + len(chunks)
+        tmp_dir = new_version(directory)
+
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        chunk_ids = np.empty(count, dtype="S16")
+        start_index = np.empty(count, dtype=np.int64)
+        vocabularies = {column: {} for column in INTERNED_COLUMNS}
+        codes = {column: np.empty(count, dtype=np.int32) for column in INTERNED_COLUMNS}
+        if kept:
+            if base.closed:
+                raise ValueError(f"Chunk store {base.directory} is closed")
+            chunk_ids[:kept] = base.chunk_ids[rows]
+            start_index[:kept] = base.start_index[rows]
+            for column in INTERNED_COLUMNS:
+                # Values only used by dropped rows leave the vocabulary
+                used, codes[column][:kept] = np.unique(base.codes[column][rows], return_inverse=True)
+                vocabularies[column] = {base.vocabularies[column][code]: i for i, code in enumerate(used)}
+
+        with open(os.path.join(tmp_dir, "texts.bin"), "wb") as f:
+            if kept:
+                starts = np.asarray(base.offsets[rows])
+                ends = np.asarray(base.offsets[rows + 1])
+                offsets[1:kept + 1] = np.cumsum(ends - starts)
+                # Each run of consecutive rows is one contiguous byte range of the old blob
+                breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+                for first, last in zip(np.r_[0, breaks], np.r_[breaks, kept] - 1):
+                    for position in range(int(starts[first]), int(ends[last]), COPY_BYTES):
+                        f.write(base._texts[position:min(position + COPY_BYTES, int(ends[last]))])
+            position = int(offsets[kept])
+            for row, chunk in enumerate(chunks, start=kept):
+                data = chunk.page_content.encode("utf-8")
+                f.write(data)
+                position += len(data)
+                offsets[row + 1] = position
+                chunk_ids[row] = chunk_id_for(chunk).encode("ascii")
+                start_index[row] = chunk.metadata.get("start_index", -1)
+                for column in INTERNED_COLUMNS:
+                    value = str(chunk.metadata.get(column, "Unknown"))
+                    codes[column][row] = vocabularies[column].setdefault(value, len(vocabularies[column]))
+
+        order = np.argsort(chunk_ids, kind="stable")
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_dir, "chunk_ids.npy"), chunk_ids)
+        np.save(os.path.join(tmp_dir, "sorted_ids.npy"), chunk_ids[order])
+        np.save(os.path.join(tmp_dir, "sorted_rows.npy"), order.astype(np.int64))
+        np.save(os.path.join(tmp_dir, "start_index.npy"), start_index)
+        for column in INTERNED_COLUMNS:
+            np.save(os.path.join(tmp_dir, f"{column}.npy"), codes[column])
+            with open(os.path.join(tmp_dir, f"{column}.json"), "w", encoding="utf-8") as f:
+                json.dump(list(vocabularies[column]), f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"count": count, "columns": list(INTERNED_COLUMNS)}, f)
+
+        # Publish the finished version in one rename so readers never see a partial or missing store
+        publish_version(directory, tmp_dir)
+        return cls(directory)
+
+    @classmethod
+    def exists(cls, directory):
+        """Check if a complete store exists in directory"""
+        return os.path.exists(os.path.join(current_version(directory), "manifest.json"))
+
+    def close(self):
+        """Release the text mmap; texts can no longer be read"""
+        self.closed = True
+        if self._text_file is not None:
+            self._texts.close()
+            self._text_file.close()
+            self._text_file = None
+            self._texts = b""
+
+    def __len__(self):
+        return self.count
+
+    def text(self, row):
+        if self.closed:
+            # An empty string would be served as a real (empty) chunk
+            raise ValueError(f"Chunk store {self.directory} is closed")
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self._texts[start:end].decode("utf-8")
+
+    def rows_of_sources(self, sources):
+        """Rows whose source is in `sources`, found from the interned codes alone"""
+        sources = set(sources)
+        codes = [code for code, source in enumerate(self.vocabularies["source"]) if source in sources]
+        return np.flatnonzero(np.isin(self.codes["source"], codes))
+
+    def iter_texts(self):
+        for row in range(self.count):
+            yield self.text(row)
+
+    def chunk_id(self, row):
+        return self.chunk_ids[row].decode("ascii")
+
+    def metadata(self, row):
+        metadata = {
+            "chunk_id": self.chunk_id(row),
+            "start_index": int(self.start_index[row])
+        }
+        for column in INTERNED_COLUMNS:
+            metadata[column] = self.vocabularies[column][int(self.codes[column][row])]
+        return metadata
+
+    def row_of(self, chunk_id):
+        """Return the row of a chunk ID, or None if it is not in the store"""
+        if self.count == 0:
+            return None
+        key = chunk_id.encode("ascii") if isinstance(chunk_id, str) else chunk_id
+        position = int(np.searchsorted(self.sorted_ids, key))
+        if position < self.count and self.sorted_ids[position] == key:
+            return int(self.sorted_rows[position])
+        return None
+
+    def __contains__(self, chunk_id):
+        return self.row_of(chunk_id) is not None
+
+    def document(self, row):
+        """Materialize a single row as a langchain Document"""
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+    def get_documents(self, chunk_ids):
+        """Materialize Documents for chunk IDs, skipping IDs not in the store"""
+        documents = []
+        for chunk_id in chunk_ids:
+            row = self.row_of(chunk_id)
+            if row is not None:
+                documents.append(self.document(row))
+        return documents
@@ -0,0 +1,155 @@
+from langchain_core.documents import Document
+from rag_tool.chunk_store import chunk_id_for
+from rag_tool.reranking import LexicalReranker
+import math
+import numpy as np
+import os
+import re
+
+SENTENCE_PATTERN = re.compile(r"[^.!?؟。\n]+(?:[.!?؟。]+|\n+|$)")
+# Arabic script, including presentation forms
+ARABIC_PATTERN = re.compile(r"[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]+")
+# CJK, Hangul and emoji, about one token per character
+WIDE_PATTERN = re.compile(r"[\u2E80-\uFAFF\U00010000-\U0010FFFF]+")
+
+def _script_length(pattern, text):
+    return sum(len(run) for run in pattern.findall(text))
+
+def estimate_tokens(text):
+    """Conservative token count for budgeting prompts.
+
+    Tokenizers trained mostly on English fit about four ASCII characters
+    into a token but split Arabic and other non-Latin scripts into much
+    shorter pieces, so characters are counted per script: four per token
+    for ASCII, two for Arabic and other non-ASCII text, one for CJK and emoji.
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    arabic_chars = _script_length(ARABIC_PATTERN, text)
+    wide_chars = _script_length(WIDE_PATTERN, text)
+    other_chars = len(text) - ascii_chars - arabic_chars - wide_chars
+    return math.ceil(ascii_chars / 4 + (arabic_chars + other_chars) / 2 + wide_chars)
+
+def split_sentences(text):
+    return [sentence for sentence in (m.group(0) for m in SENTENCE_PATTERN.finditer(text)) if sentence.strip()]
+
+def mmr_select(query_embedding, embeddings, lambda_mult=0.7, k=None):
+    """Maximal marginal relevance order over candidate embeddings.
+
+    Each step picks the candidate maximizing
+    lambda * sim(query, d) - (1 - lambda) * max sim(d, selected).
+    Returns candidate indices in selection order.
+    """
+    if len(embeddings) == 0:
+        return []
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = matrix @ query
+    similarity = matrix @ matrix.T
+
+    k = min(k or len(matrix), len(matrix))
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+class ContextBuilder:
+    """Turns retrieved chunks into the smallest context that still answers the question.
+
+    1. MMR over the stored chunk embeddings orders the chunks by relevance
+       while pushing near-duplicates back.
+    2. Text a chunk shares with an already selected neighbour of the same
+       source (the chunking overlap) is trimmed, using start_index.
+    3. Optionally only the sentences that best match the query are kept.
+    4. Chunks are added until the token budget is spent.
+
+    Returns copies of the Documents; cached retrieval results are never modified.
+    """
+
+    def __init__(self, index, token_budget=None, lambda_mult=None, sentence_selection=None, sentences_per_chunk=None):
+        self.index = index
+        self.token_budget = int(token_budget or os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+        self.lambda_mult = float(lambda_mult if lambda_mult is not None else os.getenv("CONTEXT_MMR_LAMBDA", "0.5"))
+        if sentence_selection is None:
+            sentence_selection = os.getenv("CONTEXT_SENTENCE_SELECTION", "0") == "1"
+        self.sentence_selection = sentence_selection
+        self.sentences_per_chunk = int(sentences_per_chunk or os.getenv("CONTEXT_SENTENCES_PER_CHUNK", "4"))
+
+    def order(self, query_embedding, docs):
+        """MMR order of docs; docs without a stored embedding keep their retrieval order at the end"""
+        chunk_ids = [chunk_id_for(doc) for doc in docs]
+        try:
+            stored = self.index.chunk_embeddings(chunk_ids)
+        except Exception as e:
+            print(f"⚠️ Could not load chunk embeddings for MMR: {str(e)}")
+            stored = {}
+        with_embedding = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id in stored]
+        without_embedding = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in stored]
+        if not with_embedding:
+            return list(docs)
+        picked = mmr_select(query_embedding, [stored[chunk_ids[i]] for i in with_embedding], self.lambda_mult)
+        return [docs[with_embedding[i]] for i in picked] + [docs[i] for i in without_embedding]
+
+    @staticmethod
+    def trim_overlap(doc, covered):
+        """Cut the prefix/suffix of doc already covered by selected spans of the same source"""
+        start = doc.metadata.get("start_index", -1)
+        text = doc.page_content
+        if start is None or start < 0:
+            return text
+        end = start + len(text)
+        for span_start, span_end in covered:
+            if span_start <= start < span_end:
+                text = text[span_end - start:]
+                start = span_end
+            if span_start < end <= span_end and start < end:
+                text = text[:max(0, span_start - start)]
+                end = span_start
+        return text
+
+    def select_sentences(self, query, text):
+        """Keep the best matching sentences of a chunk, in their original order"""
+        sentences = split_sentences(text)
+        if len(sentences) <= self.sentences_per_chunk:
+            return text
+        scores = LexicalReranker().score_batch(query, sentences)
+        keep = sorted(np.argsort(-np.asarray(scores), kind="stable")[:self.sentences_per_chunk])
+        return " ".join(sentences[i].strip() for i in keep)
+
+    def build(self, query, docs, query_embedding=None, token_budget=None):
+        if not docs:
+            return []
+        if getattr(self.index, "dense_ready", True):
+            if query_embedding is None:
+                query_embedding = self.index.embed_query(query)
+            ordered = self.order(query_embedding, docs)
+        else:
+            # No embeddings before the dense index is built: keep the retrieval order
+            ordered = list(docs)
+        token_budget = self.token_budget if token_budget is None else min(token_budget, self.token_budget)
+        covered = {}
+        context = []
+        used_tokens = 0
+        for doc in ordered:
+            source = doc.metadata.get("source", "Unknown")
+            text = self.trim_overlap(doc, covered.get(source, []))
+            if self.sentence_selection:
+                text = self.select_sentences(query, text)
+            if not text.strip():
+                continue
+            tokens = estimate_tokens(text)
+            if context and used_tokens + tokens > token_budget:
+                continue
+            used_tokens += tokens
+            start = doc.metadata.get("start_index", -1)
+            if start is not None and start >= 0:
+                covered.setdefault(source, []).append((start, start + len(doc.page_content)))
+            context.append(Document(page_content=text, metadata=dict(doc.metadata)))
+        print(f"🧱 Built context: {len(context)}/{len(docs)} chunks, ~{used_tokens} tokens")
+        return context
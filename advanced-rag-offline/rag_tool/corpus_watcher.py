@@ -0,0 +1,58 @@
+from rag_tool.document_processor import LOADER_EXTENSIONS
+from pathlib import Path
+from watchfiles import watch
+import os
+import threading
+
+class CorpusWatcher:
+    """Reindexes the documents directory in the background as files change.
+
+    Filesystem events for document files are debounced: a batch is handled
+    once no new event arrived for `quiet` seconds, or after `max_delay`
+    seconds of continuous changes (e.g. a large copy). Each batch runs
+    pipeline.update_corpus(), which diffs the files against the served
+    index, so events are only a trigger. The directory is also rescanned
+    every `rescan_interval` seconds, which catches changes made while the
+    first build was running and events a network filesystem did not report.
+    """
+
+    def __init__(self, pipeline, quiet=None, max_delay=None, rescan_interval=None):
+        self.pipeline = pipeline
+        self.quiet = float(quiet or os.getenv("CORPUS_WATCH_QUIET", "2"))
+        self.max_delay = float(max_delay or os.getenv("CORPUS_WATCH_MAX_DELAY", "30"))
+        self.rescan_interval = float(rescan_interval or os.getenv("CORPUS_RESCAN_INTERVAL", "300"))
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def is_document(change, path):
+        return Path(path).suffix.lower() in LOADER_EXTENSIONS
+
+    def start(self, after=None):
+        """Watch in a daemon thread, once the thread `after` (the initial build) has finished"""
+        self.thread = threading.Thread(target=self.run, args=(after,), name="corpus-watcher", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, after=None):
+        if after is not None:
+            after.join()
+        print(f"👀 Watching {self.pipeline.data_path} for document changes")
+        self.update()
+        for changes in watch(self.pipeline.data_path, watch_filter=self.is_document,
+                             debounce=int(self.max_delay * 1000), step=int(self.quiet * 1000),
+                             rust_timeout=int(self.rescan_interval * 1000), yield_on_timeout=True,
+                             stop_event=self.stop_event):
+            if changes:
+                print(f"👀 {len(changes)} document changes detected")
+            self.update()
+
+    def update(self):
+        try:
+            self.pipeline.update_corpus()
+        except Exception as e:
+            # The served index is unchanged; the next change or rescan retries
+            print(f"❌ Failed to update the index: {str(e)}")
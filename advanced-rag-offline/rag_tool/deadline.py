@@ -0,0 +1,64 @@
+import concurrent.futures
+import os
+import time
+
+class Deadline:
+    """Latency budget for one request.
+
+    A Deadline with budget=None never expires. sub() derives a stage
+    deadline that ends after a share of the remaining time; stage
+    deadlines share the parent's list of cut stages, so the request can
+    report every stage that was abandoned.
+    """
+
+    def __init__(self, budget=None, cut_stages=None, expires_at=None):
+        self.budget = budget
+        if expires_at is not None:
+            self.expires_at = expires_at
+        elif budget is not None:
+            self.expires_at = time.monotonic() + budget
+        else:
+            self.expires_at = None
+        self.cut_stages = cut_stages if cut_stages is not None else []
+
+    @classmethod
+    def from_env(cls, budget=None):
+        """Use an explicit budget in seconds, else DEFAULT_LATENCY_BUDGET, else unlimited"""
+        if budget is None and os.getenv("DEFAULT_LATENCY_BUDGET"):
+            budget = float(os.getenv("DEFAULT_LATENCY_BUDGET"))
+        return cls(budget)
+
+    def remaining(self):
+        """Seconds left, or None for an unlimited budget"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def sub(self, share):
+        """A stage deadline ending after `share` of the remaining time"""
+        if self.expires_at is None:
+            return Deadline(None, self.cut_stages)
+        return Deadline(cut_stages=self.cut_stages, expires_at=time.monotonic() + self.remaining() * share)
+
+    def cut(self, stage):
+        if stage not in self.cut_stages:
+            print(f"⏱️ Deadline reached, cutting stage: {stage}")
+            self.cut_stages.append(stage)
+
+    def run(self, stage, fn, *args, fallback=None):
+        """Run fn in a worker thread until this deadline; on timeout cut the stage and return fallback"""
+        if self.expires_at is None:
+            return fn(*args)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(fn, *args)
+        try:
+            return future.result(timeout=self.remaining())
+        except concurrent.futures.TimeoutError:
+            self.cut(stage)
+            return fallback
+        finally:
+            # Never block on an abandoned call; it finishes in the background
+            executor.shutdown(wait=False)
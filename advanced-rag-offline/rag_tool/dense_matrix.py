@@ -0,0 +1,209 @@
+from sklearn.cluster import MiniBatchKMeans
+import numpy as np
+import json
+import math
+import os
+import shutil
+
+def normalize_rows(matrix):
+    """L2-normalize the last axis; zero vectors are left as they are"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+class DenseMatrix:
+    """Memory-mapped chunk embeddings with an inverted-file (IVF) search index.
+
+    Layout of a matrix directory:
+        embeddings.npy     float32 normalized embeddings, row i is chunk store row i
+        centroids.npy      float32 normalized centroids of the IVF lists
+        list_rows.npy      rows grouped by their nearest centroid
+        list_offsets.npy   CSR offsets into list_rows.npy, one list per centroid
+        manifest.json      row count, dimension and list count
+
+    All arrays are opened with mmap_mode="r", so all API worker processes
+    serving the same index share one copy of them in the page cache.
+
+    Matrices with at least DENSE_ANN_MIN_ROWS rows are clustered into about
+    sqrt(n) lists when they are written. A search ranks the centroids and
+    only scans the rows of the DENSE_ANN_PROBE best lists, so it reads
+    about probe * sqrt(n) rows instead of all n. Smaller matrices have no
+    lists and are searched exactly. Either way the scanned rows are
+    multiplied with the queries block by block, keeping the best rows of
+    each block; scores are cosine similarities (the scale of Chroma's
+    cosine space).
+    """
+
+    def __init__(self, directory, block_rows=None):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.count = manifest["count"]
+        self.dimension = manifest["dimension"]
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.block_rows = int(block_rows or os.getenv("DENSE_SEARCH_BLOCK_ROWS", "65536"))
+        self.probe = int(os.getenv("DENSE_ANN_PROBE", "16"))
+        self.centroids = None
+        self.list_rows = None
+        self.list_offsets = None
+        if manifest.get("lists"):
+            self.centroids = np.load(os.path.join(directory, "centroids.npy"), mmap_mode="r")
+            self.list_rows = np.load(os.path.join(directory, "list_rows.npy"), mmap_mode="r")
+            self.list_offsets = np.load(os.path.join(directory, "list_offsets.npy"), mmap_mode="r")
+
+    @classmethod
+    def exists(cls, directory):
+        """Check if a complete matrix exists in directory"""
+        return os.path.exists(os.path.join(directory, "manifest.json"))
+
+    @classmethod
+    def build(cls, embeddings, directory):
+        """Write embeddings (one per chunk store row) into a new matrix directory and open it"""
+        embeddings = np.asarray(embeddings)
+        block = int(os.getenv("DENSE_SEARCH_BLOCK_ROWS", "65536"))
+        batches = ((np.arange(start, min(start + block, len(embeddings))), embeddings[start:start + block])
+                   for start in range(0, len(embeddings), block))
+        return cls.write(batches, len(embeddings), directory)
+
+    @classmethod
+    def write(cls, batches, count, directory, centroids=None, labels=None):
+        """Write (rows, vectors) batches into a new matrix directory and open it.
+
+        Each batch is normalized as it is written through a memory-mapped
+        file, so the matrix is never held in memory. `centroids` and
+        `labels` (-1 for rows still to assign) reuse the search lists of an
+        older matrix instead of clustering again.
+        """
+        tmp_dir = f"{directory}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        embeddings = None
+        written = np.zeros(count, dtype=bool)
+        for rows, vectors in batches:
+            vectors = normalize_rows(vectors)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(os.path.join(tmp_dir, "embeddings.npy"), mode="w+",
+                                                       dtype=np.float32, shape=(count, vectors.shape[1]))
+            embeddings[rows] = vectors
+            written[rows] = True
+        if embeddings is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ValueError("Dense index holds no embeddings")
+        if not written.all():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ValueError(f"Dense index holds embeddings for {int(written.sum())} of {count} chunks")
+        embeddings.flush()
+
+        lists = 0
+        if centroids is None and count >= int(os.getenv("DENSE_ANN_MIN_ROWS", "200000")):
+            centroids = cls._train_centroids(embeddings)
+            labels = None
+        if centroids is not None:
+            if labels is None:
+                labels = np.full(count, -1, dtype=np.int64)
+            cls._assign(embeddings, centroids, labels)
+            cls._save_lists(tmp_dir, centroids, labels)
+            lists = len(centroids)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"count": count, "dimension": int(embeddings.shape[1]), "lists": lists}, f)
+        del embeddings
+
+        try:
+            os.replace(tmp_dir, directory)
+        except OSError:
+            if not cls.exists(directory):
+                # Not a matrix published by another process: something else holds the name
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            # Another process published the same matrix first; its content is identical
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return cls(directory)
+
+    @staticmethod
+    def _train_centroids(embeddings):
+        """Spherical k-means centroids of about sqrt(n) lists, trained on a sample of rows"""
+        lists = max(1, int(math.sqrt(len(embeddings))))
+        sample_size = min(len(embeddings), 32 * lists)
+        sample = np.sort(np.random.default_rng(0).choice(len(embeddings), sample_size, replace=False))
+        print(f"🗂️ Clustering {len(embeddings)} dense rows into {lists} search lists")
+        model = MiniBatchKMeans(n_clusters=lists, batch_size=4096, n_init=1, max_iter=20, random_state=0)
+        model.fit(np.asarray(embeddings[sample]))
+        return normalize_rows(model.cluster_centers_)
+
+    @staticmethod
+    def _assign(embeddings, centroids, labels, block_rows=65536):
+        """Set each unlabeled row's label to its nearest centroid, block by block"""
+        centroids = np.asarray(centroids)
+        for start in range(0, len(embeddings), block_rows):
+            block = labels[start:start + block_rows]
+            missing = np.flatnonzero(block < 0)
+            if len(missing):
+                scores = np.asarray(embeddings[start + missing]) @ centroids.T
+                block[missing] = np.argmax(scores, axis=1)
+
+    @staticmethod
+    def _save_lists(matrix_dir, centroids, labels):
+        order = np.argsort(labels, kind="stable")
+        offsets = np.searchsorted(labels[order], np.arange(len(centroids) + 1))
+        np.save(os.path.join(matrix_dir, "centroids.npy"), np.asarray(centroids, dtype=np.float32))
+        np.save(os.path.join(matrix_dir, "list_rows.npy"), order.astype(np.int64))
+        np.save(os.path.join(matrix_dir, "list_offsets.npy"), offsets.astype(np.int64))
+
+    def __len__(self):
+        return self.count
+
+    def labels(self):
+        """Search list of every row, or None for a matrix without lists"""
+        if self.centroids is None:
+            return None
+        sizes = np.diff(np.asarray(self.list_offsets))
+        labels = np.empty(self.count, dtype=np.int64)
+        labels[np.asarray(self.list_rows)] = np.repeat(np.arange(len(sizes)), sizes)
+        return labels
+
+    def vector(self, row):
+        return np.asarray(self.embeddings[row])
+
+    def search(self, query_embedding, top_k=10):
+        """(row, score) pairs of the best rows, best first"""
+        return self.search_many([query_embedding], top_k)[0]
+
+    def _candidate_blocks(self, queries):
+        """(rows, embeddings) blocks to scan for queries: every row, or the rows of the probed lists"""
+        if self.centroids is None:
+            for start in range(0, self.count, self.block_rows):
+                end = min(start + self.block_rows, self.count)
+                yield np.arange(start, end), np.asarray(self.embeddings[start:end])
+            return
+        probe = min(self.probe, len(self.centroids))
+        lists = np.unique(np.argpartition(-(queries @ np.asarray(self.centroids).T), probe - 1, axis=1)[:, :probe])
+        rows = np.sort(np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists]))
+        for start in range(0, len(rows), self.block_rows):
+            block = rows[start:start + self.block_rows]
+            yield block, np.asarray(self.embeddings[block])
+
+    def search_many(self, query_embeddings, top_k=10):
+        """search() for many query embeddings in one pass over the scanned rows"""
+        queries = normalize_rows(np.atleast_2d(query_embeddings))
+        top_k = min(top_k, self.count)
+        if top_k <= 0:
+            return [[] for _ in queries]
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for rows, block in self._candidate_blocks(queries):
+            scores = queries @ block.T
+            k = min(top_k, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_rows = np.concatenate([best_rows, rows[top]], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if best_rows.shape[1] > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1, axis=1)[:, :top_k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        results = []
+        for rows, scores in zip(best_rows, best_scores):
+            # Ties keep row order, so results are deterministic
+            order = np.lexsort((rows, -scores))
+            results.append([(int(rows[i]), float(scores[i])) for i in order])
+        return results
@@ -12,8 +12,10 @@ from pathlib import Path
 import numpy as np
 from sklearn.cluster import KMeans
 from rag_tool.translation import embed_text
+from rag_tool.metrics import INGESTED_FILES
 import os
 import pickle
+import concurrent.futures
 import hashlib
 import time
 from typing import List, Tuple
@@ -127,8 +129,11 @@ def get_cache_key(path: str, language: str = "en") -> str:
 def save_to_cache(key: str, data) -> str:
     """Save data to cache file"""
     cache_file = os.path.join(CACHE_DIR, f"{key}.pkl")
-    with open(cache_file, 'wb') as f:
+    # Atomic, so other worker processes never read a partial file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
         pickle.dump(data, f)
+    os.replace(tmp_file, cache_file)
     return cache_file
 
 def load_from_cache(key: str):
@@ -159,6 +164,96 @@ def ocr_pdf(file_path, language):
         full_text += f"Page {i+1}:\n{text}\n\n"
     return full_text
 
+# File types ingested from the documents directory
+LOADER_EXTENSIONS = ('.pdf', '.docx', '.doc')
+
+def load_file(fp):
+    """Load one document file as a single Document (OCR fallback for PDFs); [] on failure"""
+    try:
+        if fp.suffix.lower() == '.pdf':
+            try:
+                loader = UnstructuredLoader(str(fp))
+                docs = loader.load()
+                if docs and docs[0].page_content.strip():
+                    # Combine all documents from the same file into a single document
+                    combined_content = "\n\n".join([doc.page_content for doc in docs])
+                    combined_metadata = docs[0].metadata.copy()
+                    combined_metadata["source"] = str(fp)
+                    
+                    # Detect language for the document
+                    detected_language = detect_document_language(combined_content)
+                    combined_metadata["language"] = detected_language
+                    
+                    print(f"Detected language for {fp.name}: {detected_language}")
+                    return [Document(page_content=combined_content, metadata=combined_metadata)]
+            except Exception as e:
+                print(f"UnstructuredLoader failed for {fp}: {str(e)}")
+                pass
+            # If UnstructuredLoader fails, use OCR with detected language
+            # For OCR, we'll use a default language for now, as we don't have text to detect language from
+            # In a more advanced implementation, we could do OCR first, then detect language
+            text = ocr_pdf(str(fp), "ara")  # Default to Arabic for OCR
+            metadata = {"source": str(fp)}
+            
+            # Detect language for the document
+            detected_language = detect_document_language(text)
+            metadata["language"] = detected_language
+            
+            print(f"Detected language for {fp.name} using OCR: {detected_language}")
+            return [Document(page_content=text, metadata=metadata)]
+        else:
+            loader = UnstructuredLoader(str(fp))
+            docs = loader.load()
+            if docs:
+                # Combine all documents from the same file into a single document
+                combined_content = "\n\n".join([doc.page_content for doc in docs])
+                combined_metadata = docs[0].metadata.copy()
+                combined_metadata["source"] = str(fp)
+                
+                # Detect language for the document
+                detected_language = detect_document_language(combined_content)
+                combined_metadata["language"] = detected_language
+                
+                print(f"Detected language for {fp.name}: {detected_language}")
+                return [Document(page_content=combined_content, metadata=combined_metadata)]
+            return docs
+    except Exception as e:
+        print(f"Error processing {fp}: {str(e)}")
+        # Return empty list to continue with other files
+        return []
+
+def scan_documents(path):
+    """Modification times of the document files under path, by source path"""
+    return {str(fp): fp.stat().st_mtime for fp in Path(path).rglob('*')
+            if fp.suffix.lower() in LOADER_EXTENSIONS and fp.is_file()}
+
+def load_files(file_paths, timeout=300):
+    """Load document files one by one, skipping files that fail or time out"""
+    documents = []
+    for processed_files, file_path in enumerate(file_paths, 1):
+        file_path = Path(file_path)
+        print(f"Processing file {processed_files}/{len(file_paths)}: {file_path.name}")
+        try:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                future = executor.submit(load_file, file_path)
+                file_docs = future.result(timeout=timeout)  # 5 minute timeout per file
+                documents.extend(file_docs)
+                INGESTED_FILES.inc(result="loaded" if file_docs else "empty")
+                print(f"✅ Processed {file_path.name} successfully")
+        except concurrent.futures.TimeoutError:
+            INGESTED_FILES.inc(result="timeout")
+            print(f"❌ Processing {file_path.name} timed out after 5 minutes")
+            print(f"⚠️  This file might be too large or corrupted. Consider splitting it into smaller parts.")
+            # Continue with other files instead of failing completely
+            continue
+        except Exception as e:
+            INGESTED_FILES.inc(result="failed")
+            print(f"❌ Failed to process {file_path.name}: {str(e)}")
+            # Continue with other files instead of failing completely
+            continue
+    # Filter complex metadata to avoid issues with Chroma
+    return filter_complex_metadata(documents)
+
 def load_documents(path, language="ar"):
     """Load and process documents from directory with caching"""
     # Generate cache key
@@ -171,95 +266,9 @@ def load_documents(path, language="ar"):
         return cached_data
     
     print("🔄 Loading and processing documents...")
-    tesseract_lang = LANGUAGE_MAP.get(language, "ara")
-    loaders = {
-        '.pdf': UnstructuredLoader,
-        '.docx': UnstructuredLoader,
-        '.doc': UnstructuredLoader
-    }
-    documents = []
-    
-    import concurrent.futures
-    import time
-    
     # Process files with timeout
-    file_paths = list(Path(path).rglob('*'))
-    total_files = len([fp for fp in file_paths if fp.suffix.lower() in loaders])
-    processed_files = 0
-    
-    for file_path in file_paths:
-        if file_path.suffix.lower() in loaders:
-            processed_files += 1
-            print(f"Processing file {processed_files}/{total_files}: {file_path.name}")            
-            def process_file(fp):
-                try:
-                    if fp.suffix.lower() == '.pdf':
-                        try:
-                            loader = UnstructuredLoader(str(fp))
-                            docs = loader.load()
-                            if docs and docs[0].page_content.strip():
-                                # Combine all documents from the same file into a single document
-                                combined_content = "\n\n".join([doc.page_content for doc in docs])
-                                combined_metadata = docs[0].metadata.copy()
-                                combined_metadata["source"] = str(fp)
-                                
-                                # Detect language for the document
-                                detected_language = detect_document_language(combined_content)
-                                combined_metadata["language"] = detected_language
-                                
-                                print(f"Detected language for {fp.name}: {detected_language}")
-                                return [Document(page_content=combined_content, metadata=combined_metadata)]
-                        except Exception as e:
-                            print(f"UnstructuredLoader failed for {fp}: {str(e)}")
-                            pass
-                        # If UnstructuredLoader fails, use OCR with detected language
-                        # For OCR, we'll use a default language for now, as we don't have text to detect language from
-                        # In a more advanced implementation, we could do OCR first, then detect language
-                        text = ocr_pdf(str(fp), "ara")  # Default to Arabic for OCR
-                        metadata = {"source": str(fp)}
-                        
-                        # Detect language for the document
-                        detected_language = detect_document_language(text)
-                        metadata["language"] = detected_language
-                        
-                        print(f"Detected language for {fp.name} using OCR: {detected_language}")
-                        return [Document(page_content=text, metadata=metadata)]
-                    else:
-                        loader = UnstructuredLoader(str(fp))
-                        docs = loader.load()
-                        if docs:
-                            # Combine all documents from the same file into a single document
-                            combined_content = "\n\n".join([doc.page_content for doc in docs])
-                            combined_metadata = docs[0].metadata.copy()
-                            combined_metadata["source"] = str(fp)
-                            
-                            # Detect language for the document
-                            detected_language = detect_document_language(combined_content)
-                            combined_metadata["language"] = detected_language
-                            
-                            print(f"Detected language for {fp.name}: {detected_language}")
-                            return [Document(page_content=combined_content, metadata=combined_metadata)]
-                        return docs
-                except Exception as e:
-                    print(f"Error processing {fp}: {str(e)}")
-                    # Return empty list to continue with other files
-                    return []
-            
-            try:
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(process_file, file_path)
-                    file_docs = future.result(timeout=300)  # 5 minute timeout per file
-                    documents.extend(file_docs)
-                    print(f"✅ Processed {file_path.name} successfully")
-            except concurrent.futures.TimeoutError:
-                print(f"❌ Processing {file_path.name} timed out after 5 minutes")
-                print(f"⚠️  This file might be too large or corrupted. Consider splitting it into smaller parts.")
-                # Continue with other files instead of failing completely
-                continue
-            except Exception as e:
-                print(f"❌ Failed to process {file_path.name}: {str(e)}")
-                # Continue with other files instead of failing completely
-                continue
+    file_paths = [fp for fp in Path(path).rglob('*') if fp.suffix.lower() in LOADER_EXTENSIONS]
+    documents = load_files(file_paths)
     
     # Save to cache
     try:
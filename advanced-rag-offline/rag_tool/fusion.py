@@ -0,0 +1,61 @@
+import numpy as np
+import os
+
+FUSION_METHODS = ("rrf", "weighted")
+
+def dedupe_hits(hits):
+    """Keep the first (best-ranked) occurrence of each chunk ID in a ranking"""
+    seen = set()
+    unique = []
+    for chunk_id, score in hits:
+        if chunk_id not in seen:
+            seen.add(chunk_id)
+            unique.append((chunk_id, score))
+    return unique
+
+def _min_max(scores):
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+def fuse(rankings, method=None, k=None, weights=None):
+    """Fuse rankings of (chunk_id, score) pairs into one deduplicated ranking.
+
+    rrf       sum of weight / (k + rank + 1) over the rankings a chunk appears in
+    weighted  sum of weight * min-max normalized score per ranking
+
+    A chunk that appears more than once in a ranking counts once, at its best
+    position. Returns (chunk_id, fused_score) pairs, best first; ties are
+    broken by chunk ID so the order is deterministic.
+    """
+    method = method or os.getenv("FUSION_METHOD", "rrf")
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method}. Expected one of {', '.join(FUSION_METHODS)}")
+    k = k if k is not None else int(os.getenv("FUSION_RRF_K", "60"))
+    weights = [1.0] * len(rankings) if weights is None else weights
+    kept = [(ranking, weight) for ranking, weight in zip(rankings, weights) if ranking]
+    if not kept:
+        return []
+    rankings = [ranking for ranking, weight in kept]
+    weights = np.array([weight for ranking, weight in kept], dtype=np.float64)
+
+    ids = np.array([chunk_id for ranking in rankings for chunk_id, score in ranking], dtype=str)
+    row = np.repeat(np.arange(len(rankings)), [len(ranking) for ranking in rankings])
+    unique_ids, column = np.unique(ids, return_inverse=True)
+
+    if method == "rrf":
+        position = np.concatenate([np.arange(len(ranking)) for ranking in rankings]).astype(np.float64)
+        ranks = np.full((len(rankings), len(unique_ids)), np.inf)
+        np.minimum.at(ranks, (row, column), position)
+        contributions = np.where(np.isfinite(ranks), 1.0 / (k + ranks + 1), 0.0)
+    else:
+        normalized = np.concatenate([_min_max(np.array([score for chunk_id, score in ranking], dtype=np.float64))
+                                     for ranking in rankings])
+        contributions = np.zeros((len(rankings), len(unique_ids)))
+        np.maximum.at(contributions, (row, column), normalized)
+
+    scores = weights @ contributions
+    # unique_ids is sorted, so a stable sort on -score breaks ties by chunk ID
+    order = np.argsort(-scores, kind="stable")
+    return [(str(unique_ids[i]), float(scores[i])) for i in order]
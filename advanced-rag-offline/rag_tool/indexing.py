@@ -1,7 +1,17 @@
-from langchain_community.vectorstores import Chroma
 from langchain_ollama.embeddings import OllamaEmbeddings
+from langchain_core.documents import Document
+from rag_tool.chunk_store import ChunkStore, chunk_id_for
+from rag_tool.dense_matrix import DenseMatrix
+from rag_tool.bulk_build import DenseIndexBuilder, DenseIndexBuildIncomplete
+from rag_tool.raptor import RaptorTree
+from rag_tool.fusion import fuse
+from rag_tool.sparse_index import SparseIndex
+from rag_tool.metrics import CACHE_REQUESTS, model_call
+from collections import OrderedDict
+import itertools
 import numpy as np
 import os
+import threading
 import pickle
 import hashlib
 
@@ -9,29 +19,68 @@ import hashlib
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+# Seconds a replaced index stays mapped for queries that started before the swap
+INDEX_RETIRE_DELAY = 60
+
+def retire_index(previous, successor):
+    """Release a replaced index (or shard) once queries that started before the swap are done with it"""
+    timer = threading.Timer(INDEX_RETIRE_DELAY, previous.release, args=(successor,))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def fuse_raptor_hits(dense_hits, raptor_hits):
+    """Fuse the dense ranking with the RAPTOR ranking of the query's topic clusters.
+
+    A chunk in both rankings is lifted above chunks only in one, and chunks
+    of the matching clusters that the dense search ranks low still get in.
+    """
+    return fuse([dense_hits, raptor_hits])
+
 class MultiRepresentationIndex:
     def __init__(self):
+        # Memory-mapped DenseMatrix; the Chroma collection it is exported from is only used while building
         self.dense_index = None
         self.raptor_index = None
-        self.documents = []
+        self.chunk_store = None
+        self.embeddings = None
+        self.cache_key = None
+        # BM25 over the chunk store; serves searches until the dense index is built
+        self.sparse_index = None
+        # Build progress: None, "sparse", "dense" (RAPTOR pending) or "full"
+        self.stage = None
+        # Recent query embeddings; the same query is embedded by several stages
+        self._query_embeddings = OrderedDict()
+        self._query_embeddings_lock = threading.Lock()
+        self._query_embeddings_size = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "256"))
+    
+    @property
+    def version(self):
+        """Corpus version: changes whenever the chunks, the embedding model or the build stage change"""
+        if not self.cache_key:
+            return None
+        hash_input = self.cache_key if self.stage == "full" else f"{self.cache_key}|{self.stage}"
+        return hashlib.md5(hash_input.encode()).hexdigest()[:12]
+    
+    @property
+    def dense_ready(self):
+        return self.dense_index is not None
         
     def close(self):
-        """Properly close Chroma clients and clean up resources"""
-        try:
-            if self.dense_index:
-                self.dense_index.delete_collection()
-        except Exception as e:
-            print(f"Error cleaning dense index: {str(e)}")
-        finally:
-            self.dense_index = None
+        """Release the memory-mapped indexes"""
+        self.dense_index = None
 
         try:
             if self.raptor_index:
-                self.raptor_index.delete_collection()
+                self.raptor_index.close()
         except Exception as e:
             print(f"Error cleaning RAPTOR index: {str(e)}")
         finally:
             self.raptor_index = None
+
+        if self.chunk_store is not None:
+            self.chunk_store.close()
+            self.chunk_store = None
         
     def get_cache_key(self, chunks, raptor_chunks):
         """Generate a cache key based on chunk content"""
@@ -52,12 +101,12 @@ class MultiRepresentationIndex:
     def save_to_cache(self, key, data):
         """Save index data to cache"""
         cache_file = os.path.join(CACHE_DIR, f"index_{key}.pkl")
-        # Save only the serializable parts
-        cache_data = {
-            'documents': self.documents
-        }
-        with open(cache_file, 'wb') as f:
-            pickle.dump(cache_data, f)
+        # Only the store location is pickled; chunk texts live in the mmapped store.
+        # Written atomically, since other worker processes may be reading it.
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(tmp_file, cache_file)
         return cache_file
         
     def load_from_cache(self, key):
@@ -73,201 +122,447 @@ class MultiRepresentationIndex:
                 os.remove(cache_file)
         return None
 
+    def load_indexes(self, cache_key, stage="full"):
+        """Open previously built indexes by cache key, without the source chunks.
+
+        `stage` is how far the build had got: "sparse" opens the chunk store
+        with BM25 only and "dense" adds the dense index, so opening an
+        unfinished build never embeds or clusters anything.
+        """
+        cached_data = self.load_from_cache(cache_key)
+        if cached_data is None or not ChunkStore.exists(cached_data.get('chunk_store', '')):
+            return False
+        print("🏗️ Loaded indexes from cache")
+        self.cache_key = cache_key
+        self.chunk_store = ChunkStore(cached_data['chunk_store'])
+        if stage != "full":
+            self.sparse_index = SparseIndex(self.chunk_store)
+        if stage in ("dense", "full"):
+            # The dense index is embedded from the chunk store, so it can always be (re)created here
+            self.dense_index = self._load_or_create_dense_index(cache_key)
+        if stage == "full":
+            self.raptor_index = self._load_or_create_raptor_index(cache_key)
+        self.stage = stage
+        return True
+
+    def snapshot(self):
+        """Descriptor other processes use to open this index read-only (see rag_tool.snapshot)"""
+        return {"type": "single", "cache_key": self.cache_key, "stage": self.stage}
+
+    def release(self, successor=None):
+        """Unmap a replaced index; unlike close() its persisted dense index is kept for other readers.
+
+        Parts still used by `successor` (a copy() of this index) stay open.
+        """
+        def shared(attribute):
+            return successor is not None and getattr(successor, attribute) is getattr(self, attribute)
+        if self.raptor_index is not None and not shared("raptor_index"):
+            self.raptor_index.close()
+        if self.chunk_store is not None and not shared("chunk_store"):
+            self.chunk_store.close()
+
+    def copy(self):
+        """A new index sharing this one's chunk store and built indexes; build steps run on
+        the copy leave this index as it is"""
+        index = MultiRepresentationIndex()
+        index.cache_key = self.cache_key
+        index.chunk_store = self.chunk_store
+        index.sparse_index = self.sparse_index
+        index.dense_index = self.dense_index
+        index.raptor_index = self.raptor_index
+        index.embeddings = self.embeddings
+        index.stage = self.stage
+        return index
+
+    def successor(self, step):
+        """A copy() advanced by one build step ("build_dense" or "build_raptor").
+
+        Used to advance an index that is being served: queries keep reading
+        this index until the caller swaps the successor in.
+        """
+        index = self.copy()
+        getattr(index, step)()
+        return index
+
+    def updated(self, changed_sources, new_chunks):
+        """A new, fully built index with the chunks of `changed_sources` replaced by `new_chunks`.
+
+        The rows of unchanged files are copied column by column: chunk store
+        columns, dense matrix rows with their search lists, and RAPTOR
+        cluster memberships (see ChunkStore.build_from and
+        RaptorTree.updated). Only `new_chunks` are embedded and appended.
+        This index is left untouched and keeps serving until the caller
+        swaps it out. Returns None when no chunks are left.
+        """
+        changed_rows = self.chunk_store.rows_of_sources(changed_sources)
+        kept_rows = np.setdiff1d(np.arange(len(self.chunk_store)), changed_rows)
+        new_chunks = list(new_chunks)
+        if not len(kept_rows) and not new_chunks:
+            return None
+        index = MultiRepresentationIndex()
+        index.cache_key = self.updated_cache_key(changed_sources, new_chunks)
+        index.chunk_store = ChunkStore.build_from(self.chunk_store, kept_rows, new_chunks,
+                                                  self._store_dir(index.cache_key))
+        print(f"🧩 Chunk store holds {len(index.chunk_store)} chunks ({len(new_chunks)} new)")
+        try:
+            index.save_to_cache(index.cache_key, {'chunk_store': index.chunk_store.directory})
+        except Exception as e:
+            print(f"Warning: Could not save indexes to cache: {str(e)}")
+        if not self.dense_ready:
+            # No embeddings to copy: embed the chunk store like a first build
+            index.build_dense()
+            index.build_raptor()
+            return index
+
+        index.embeddings = self.embeddings
+        matrix_dir = self._matrix_dir(index.cache_key)
+        if DenseMatrix.exists(matrix_dir):
+            index.dense_index = DenseMatrix(matrix_dir)
+        else:
+            labels = self.dense_index.labels()
+            if labels is not None:
+                labels = np.concatenate([labels[kept_rows], np.full(len(new_chunks), -1, dtype=np.int64)])
+            batches = itertools.chain(self._copied_embeddings(kept_rows),
+                                      index._embedded_chunks(new_chunks, len(kept_rows)))
+            index.dense_index = DenseMatrix.write(batches, len(index.chunk_store), matrix_dir,
+                                                  centroids=self.dense_index.centroids, labels=labels)
+        index.raptor_index = index._updated_raptor_index(self.raptor_index, kept_rows)
+        index.stage = "full"
+        return index
+
+    def updated_cache_key(self, changed_sources, new_chunks):
+        """Cache key of updated(): derived from this index's key and the change, not from every chunk text"""
+        hash_input = "\x00".join([self.cache_key, *sorted(changed_sources), *map(chunk_id_for, new_chunks)])
+        # Keeps the RAPTOR chunk hash and embedding model parts of get_cache_key()
+        return f"{hashlib.md5(hash_input.encode()).hexdigest()}_{self.cache_key.split('_', 1)[1]}"
+
+    def _copied_embeddings(self, rows, block_rows=65536):
+        """(new rows, vectors) batches of this index's dense matrix rows `rows`, renumbered from 0"""
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            yield np.arange(start, start + len(block)), np.asarray(self.dense_index.embeddings[block])
+
+    def _embedded_chunks(self, chunks, first_row):
+        """(rows, vectors) batches of chunks embedded into the rows from `first_row` on"""
+        batch_size = int(os.getenv("DENSE_BUILD_BATCH_SIZE", "256"))
+        for start in range(0, len(chunks), batch_size):
+            texts = [chunk.page_content for chunk in chunks[start:start + batch_size]]
+            with model_call(self.embeddings, "embed"):
+                vectors = self.embeddings.embed_documents(texts)
+            yield np.arange(first_row + start, first_row + start + len(texts)), np.asarray(vectors, dtype=np.float32)
+
+    def _updated_raptor_index(self, previous, kept_rows):
+        """RAPTOR tree of updated(): `previous` with its kept leaves copied, or a new tree"""
+        if previous is None or os.getenv("RAPTOR_ENABLED", "1") != "1":
+            return self._load_or_create_raptor_index(self.cache_key)
+        raptor_dir = self._raptor_dir(self.cache_key)
+        try:
+            if RaptorTree.exists(raptor_dir):
+                return RaptorTree(raptor_dir, self.dense_index.embeddings)
+            tree = previous.updated(kept_rows, self.dense_index.embeddings, raptor_dir)
+        except Exception as e:
+            print(f"⚠️  RAPTOR tree update failed, rebuilding: {str(e)}")
+            tree = None
+        return tree if tree is not None else self._load_or_create_raptor_index(self.cache_key)
+
+    def _dense_dir(self, cache_key, legacy=True):
+        # Sanitize directory name for Windows
+        sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
+        persist_dir = os.path.join(CACHE_DIR, f"chroma_dense_{sanitized_key}")
+        # Older releases built the whole Chroma index in one go into cache/dense_*
+        legacy_dir = os.path.join(CACHE_DIR, f"dense_{sanitized_key}")
+        if legacy and not os.path.exists(persist_dir) and DenseIndexBuilder.has_chroma_data(legacy_dir):
+            return legacy_dir
+        return persist_dir
+
+    def _store_dir(self, cache_key):
+        sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
+        return os.path.join(CACHE_DIR, f"store_{sanitized_key}")
+
+    def _raptor_dir(self, cache_key):
+        sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
+        return os.path.join(CACHE_DIR, f"raptor_{sanitized_key}")
+
+    def _matrix_dir(self, cache_key):
+        sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
+        # Not "dense_": that name belongs to the Chroma directories of older releases
+        return os.path.join(CACHE_DIR, f"matrix_{sanitized_key}")
+
     def build_indexes(self, chunks, raptor_chunks):
+        self.build_sparse(chunks, raptor_chunks)
+        self.build_dense()
+        self.build_raptor()
+    
+    def build_sparse(self, chunks, raptor_chunks):
+        """Open or write the chunk store and index it with BM25; searches work from here on"""
         # Generate cache key
         cache_key = self.get_cache_key(chunks, raptor_chunks)
+        self.cache_key = cache_key
         
         # Try to load from cache first
         cached_data = self.load_from_cache(cache_key)
-        if cached_data is not None:
+        if cached_data is not None and ChunkStore.exists(cached_data.get('chunk_store', '')):
             print("🏗️ Loaded indexes from cache")
-            self.documents = cached_data['documents']
-# self.sparse_index = cached_data['sparse_index']
-            # We still need to rebuild Chroma indexes as they're not easily serializable
-            # But we can check if the Chroma DB already exists to avoid rebuilding
-            self._rebuild_chroma_indexes(chunks, raptor_chunks)
-            return
-        
-        print("🏗️ Constructing indexes...")
-        self.documents = [c.page_content for c in chunks]
-        
-        # Get Ollama base URL from environment
-        ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        # Sanitize model name for Windows paths
-        # Sanitize model name for Windows paths
-        # Sanitize model name for Windows paths
-        embedding_model = os.getenv("EMBEDDING_MODEL", "jeffh/intfloat-multilingual-e5-large:q8_0")
-        
-        import concurrent.futures
+            self.chunk_store = ChunkStore(cached_data['chunk_store'])
+        else:
+            print("🏗️ Constructing indexes...")
+            self.chunk_store = ChunkStore.build(chunks, self._store_dir(cache_key))
+        print(f"🧩 Chunk store holds {len(self.chunk_store)} chunks")
         
-        # Dense embeddings index with Chroma instead of FAISS
+        # Save to cache (only the chunk store location)
         try:
-            print("Creating dense index...")
-            # Check if Chroma DB already exists to avoid rebuilding
-            # Sanitize directory name for Windows
-            sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
-            chroma_persist_dir = os.path.join(CACHE_DIR, f"dense_{sanitized_key}")
-            if os.path.exists(chroma_persist_dir):
-                print("Loading existing dense index from disk...")
-                dense_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-                self.dense_index = Chroma(
-                    persist_directory=chroma_persist_dir,
-                    embedding_function=dense_embeddings,
-                    collection_name="dense_index"
-                )
-            else:
-                def create_dense_index():
-                    dense_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-                    chroma_index = Chroma.from_documents(
-                        chunks,
-                        dense_embeddings,
-                        collection_name="dense_index",
-                        persist_directory=chroma_persist_dir
-                    )
-                    return chroma_index
-                
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(create_dense_index)
-                    self.dense_index = future.result(timeout=120)  # 2 minute timeout
-                print("✅ Dense index created successfully")
-        except concurrent.futures.TimeoutError:
-            print("❌ Dense index creation timed out")
-            raise Exception("Dense index creation timed out. This might be due to a large number of chunks or connectivity issues with Ollama.")
+            cache_data = {
+                'chunk_store': self.chunk_store.directory,
+            }
+            self.save_to_cache(cache_key, cache_data)
+            print("💾 Saved indexes to cache")
         except Exception as e:
-            print(f"❌ Failed to create dense index: {str(e)}")
-            raise
+            print(f"Warning: Could not save indexes to cache: {str(e)}")
         
         # Sparse BM25 index
         try:
             print("Creating sparse index...")
-            tokenized_docs = [doc.split() for doc in self.documents]
+            self.sparse_index = SparseIndex(self.chunk_store)
             print("✅ Sparse index created successfully")
         except Exception as e:
             print(f"❌ Failed to create sparse index: {str(e)}")
             raise
+        self.stage = "sparse"
+    
+    def build_dense(self, reuse_from=None):
+        """Embed the chunk store into the dense index; searches switch from BM25 to dense.
+
+        Embeddings of chunks also held by `reuse_from` (an older index) are copied instead of recomputed.
+        """
+        known_embeddings = reuse_from.chunk_embeddings if reuse_from is not None and reuse_from.dense_ready else None
+        self.dense_index = self._load_or_create_dense_index(self.cache_key, known_embeddings)
+        self.stage = "dense"
+    
+    def build_raptor(self):
+        # RAPTOR index (hierarchical tree over the dense embeddings)
+        self.raptor_index = self._load_or_create_raptor_index(self.cache_key)
+        # BM25 is only a stand-in until the dense index exists. It is kept until here, not
+        # dropped by build_dense(), because a sharded index searches BM25 on every shard
+        # until all of its shards are dense.
+        self.sparse_index = None
+        self.stage = "full"
         
-        # RAPTOR index (hierarchical) - DISABLED
-        try:
-            print("⚠️  RAPTOR index creation is currently disabled")
-            self.raptor_index = None
-            # Original implementation (commented out for later use):
-            # print("Creating RAPTOR index...")
-            # # Check if Chroma DB already exists to avoid rebuilding
-            # # Sanitize directory name for Windows
-            # sanitized_key = cache_key.replace(":", "_").replace("/", "-")[:50]
-            # chroma_raptor_dir = os.path.join(CACHE_DIR, f"raptor_{sanitized_key}")
-            # if os.path.exists(chroma_raptor_dir):
-            #     print("Loading existing RAPTOR index from disk...")
-            #     raptor_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            #     self.raptor_index = Chroma(
-            #         persist_directory=chroma_raptor_dir,
-            #         embedding_function=raptor_embeddings,
-            #         collection_name="raptor_index"
-            #     )
-            # else:
-            #     def create_raptor_index():
-            #         print(f"🔧 Creating RAPTOR index with model: {embedding_model} and base_url: {ollama_base_url}")
-            #         raptor_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            #         chroma_index = Chroma.from_documents(
-            #             raptor_chunks,
-            #             raptor_embeddings,
-            #             collection_name="raptor_index",
-            #             persist_directory=chroma_raptor_dir
-            #         )
-            #         return chroma_index
-            #
-            #     with concurrent.futures.ThreadPoolExecutor() as executor:
-            #         future = executor.submit(create_raptor_index)
-            #         self.raptor_index = future.result(timeout=120)  # 2 minute timeout
-            #         print(f"RAPTOR index metadata: {self.raptor_index._collection.metadata}")  # Debug Chroma config
-            #         print(f"First 3 RAPTOR chunks: {raptor_chunks[:3]}")  # Verify chunk structure
-            # print("✅ RAPTOR index created successfully")
-        except Exception as e:
-            print(f"⚠️  RAPTOR index creation skipped (disabled): {str(e)}")
-            self.raptor_index = None
-        
-        # Save to cache (only serializable parts)
-        try:
-            cache_data = {
-                'documents': self.documents,
-# 'sparse_index': self.sparse_index,
-            }
-            self.save_to_cache(cache_key, cache_data)
-            print("💾 Saved indexes to cache")
-        except Exception as e:
-            print(f"Warning: Could not save indexes to cache: {str(e)}")
-        
-    def _rebuild_chroma_indexes(self, chunks, raptor_chunks):
-        """Rebuild Chroma indexes from cached data"""
-        print("🔄 Rebuilding Chroma indexes...")
+    def _load_or_create_dense_index(self, cache_key, known_embeddings=None):
+        """Open the dense matrix, or embed the chunk store into Chroma (resuming a partial build) and export it.
+
+        Chroma holds the resumable, batched build. Searches run on the exported
+        matrix, which is memory-mapped, so processes that open a finished index
+        share its vectors and search lists instead of each loading a Chroma HNSW index.
+        """
         # Get Ollama base URL from environment
         ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        embedding_model = os.getenv("EMBEDDING_MODEL", "jeffh/intfloat-multilingual-e5-large:Q8_0")
-        
-        # Generate cache key for Chroma directories
-        cache_key = self.get_cache_key(chunks, raptor_chunks)
-        
-        # Check if Chroma DB already exists to avoid rebuilding
-        chroma_persist_dir = os.path.join(CACHE_DIR, f"chroma_dense_{cache_key}")
-        if os.path.exists(chroma_persist_dir):
+        embedding_model = os.getenv("EMBEDDING_MODEL", "jeffh/intfloat-multilingual-e5-large:q8_0")
+        dense_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
+        self.embeddings = dense_embeddings
+        matrix_dir = self._matrix_dir(cache_key)
+        if DenseMatrix.exists(matrix_dir):
             print("Loading existing dense index from disk...")
-            dense_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            self.dense_index = Chroma(
-                persist_directory=chroma_persist_dir,
-                embedding_function=dense_embeddings,
-                collection_name="dense_index"
-            )
-        else:
-            # Dense embeddings index with Chroma instead of FAISS
-            dense_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            self.dense_index = Chroma.from_documents(
-                chunks,
-                dense_embeddings,
-                collection_name="dense_index",
-                persist_directory=chroma_persist_dir
-            )
+            return DenseMatrix(matrix_dir)
         
-        # Check if RAPTOR Chroma DB already exists to avoid rebuilding
-        chroma_raptor_dir = os.path.join(CACHE_DIR, f"chroma_raptor_{cache_key}")
-        if os.path.exists(chroma_raptor_dir):
-            print("Loading existing RAPTOR index from disk...")
-            raptor_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            self.raptor_index = Chroma(
-                persist_directory=chroma_raptor_dir,
-                embedding_function=raptor_embeddings,
-                collection_name="raptor_index"
-            )
+        # Only the chunk ID and source go into Chroma; everything else stays in the chunk store
+        builder = DenseIndexBuilder(self.chunk_store, dense_embeddings, self._dense_dir(cache_key),
+                                    known_embeddings=known_embeddings)
+        try:
+            try:
+                dense_index = self._export_dense_index(builder, matrix_dir)
+            except ValueError as e:
+                if not builder.read_checkpoint().get("legacy"):
+                    raise
+                # A legacy index that does not cover the chunk store is built again
+                print(f"⚠️ Legacy dense index {builder.persist_dir} is unusable, rebuilding: {str(e)}")
+                builder = DenseIndexBuilder(self.chunk_store, dense_embeddings, self._dense_dir(cache_key, legacy=False),
+                                            known_embeddings=known_embeddings)
+                dense_index = self._export_dense_index(builder, matrix_dir)
+            print("✅ Dense index created successfully")
+            return dense_index
+        except DenseIndexBuildIncomplete as e:
+            print(f"⏸️ {str(e)}")
+            raise
+        except Exception as e:
+            print(f"❌ Failed to create dense index: {str(e)}")
+            raise
+
+    def _export_dense_index(self, builder, matrix_dir):
+        """Finish (or resume) the Chroma build and export it to the dense matrix"""
+        if builder.is_complete():
+            vectorstore = builder.open()
         else:
-            # RAPTOR index (hierarchical)
-            raptor_embeddings = OllamaEmbeddings(model=embedding_model, base_url=ollama_base_url)
-            self.raptor_index = Chroma.from_documents(
-                raptor_chunks,
-                raptor_embeddings,
-                collection_name="raptor_index",
-                persist_directory=chroma_raptor_dir
-            )
+            print("Creating dense index...")
+            vectorstore = builder.build()
+        by_content = builder.read_checkpoint().get("legacy", False)
+        return DenseMatrix.write(self._stored_embeddings(vectorstore, by_content=by_content),
+                                 len(self.chunk_store), matrix_dir)
 
-    def hybrid_search(self, query, top_k=10):
-        if not self.dense_index:
-            raise ValueError("dense_index not initialized in hybrid_search()")
+    def _load_or_create_raptor_index(self, cache_key):
+        """Open the persisted RAPTOR tree, or cluster the dense embeddings into a new one"""
+        if os.getenv("RAPTOR_ENABLED", "1") != "1":
+            print("⚠️  RAPTOR index creation is disabled (RAPTOR_ENABLED=0)")
+            return None
+        raptor_dir = self._raptor_dir(cache_key)
+        try:
+            if RaptorTree.exists(raptor_dir):
+                print("Loading existing RAPTOR index from disk...")
+                return RaptorTree(raptor_dir, self.dense_index.embeddings)
+            print("Creating RAPTOR index...")
+            branching = int(os.getenv("RAPTOR_BRANCHING", "10"))
+            raptor_index = RaptorTree.build(self.dense_index.embeddings, raptor_dir, branching=branching)
+            print("✅ RAPTOR index created successfully")
+            return raptor_index
+        except Exception as e:
+            print(f"⚠️  RAPTOR index creation skipped: {str(e)}")
+            return None
+
+    def _stored_embeddings(self, vectorstore, batch_size=5000, by_content=False):
+        """Read the stored chunk embeddings back from Chroma as (rows, vectors) batches in chunk store rows.
+
+        Legacy collections (`by_content`) have random IDs; their chunk IDs are
+        computed from the stored source, start index and text.
+        """
+        collection = vectorstore._collection
+        include = ["embeddings", "metadatas", "documents"] if by_content else ["embeddings"]
+        offset = 0
+        while True:
+            batch = collection.get(include=include, limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            chunk_ids = batch["ids"]
+            if by_content:
+                chunk_ids = [chunk_id_for(Document(page_content=text, metadata=metadata or {}))
+                             for text, metadata in zip(batch["documents"], batch["metadatas"])]
+            rows = [self.chunk_store.row_of(chunk_id) for chunk_id in chunk_ids]
+            found = [i for i, row in enumerate(rows) if row is not None]
+            if found:
+                yield (np.array([rows[i] for i in found], dtype=np.int64),
+                       np.asarray([batch["embeddings"][i] for i in found], dtype=np.float32))
+            offset += len(batch["ids"])
+
+    def embed_query(self, query):
+        """Embed a query with the dense index's embedding model, memoizing recent queries"""
+        with self._query_embeddings_lock:
+            if query in self._query_embeddings:
+                self._query_embeddings.move_to_end(query)
+                CACHE_REQUESTS.inc(namespace="query_embedding", result="hit")
+                return self._query_embeddings[query]
+        CACHE_REQUESTS.inc(namespace="query_embedding", result="miss")
+        with model_call(self.embeddings, "embed"):
+            embedding = self.embeddings.embed_query(query)
+        with self._query_embeddings_lock:
+            self._query_embeddings[query] = embedding
+            while len(self._query_embeddings) > self._query_embeddings_size:
+                self._query_embeddings.popitem(last=False)
+        return embedding
+
+    def embed_queries(self, queries):
+        """Embed many queries with one batched call, reusing memoized embeddings"""
+        found = {}
+        with self._query_embeddings_lock:
+            for query in queries:
+                if query in self._query_embeddings:
+                    found[query] = self._query_embeddings[query]
+        missing = [query for query in dict.fromkeys(queries) if query not in found]
+        CACHE_REQUESTS.inc(len(queries) - len(missing), namespace="query_embedding", result="hit")
+        CACHE_REQUESTS.inc(len(missing), namespace="query_embedding", result="miss")
+        if missing:
+            # Ollama embeds queries and documents the same way, so one embed_documents call covers the batch
+            with model_call(self.embeddings, "embed"):
+                embeddings = self.embeddings.embed_documents(missing)
+            for query, embedding in zip(missing, embeddings):
+                found[query] = embedding
+            with self._query_embeddings_lock:
+                for query in missing:
+                    self._query_embeddings[query] = found[query]
+                while len(self._query_embeddings) > self._query_embeddings_size:
+                    self._query_embeddings.popitem(last=False)
+        return [found[query] for query in queries]
+
+    def chunk_embeddings(self, chunk_ids):
+        """Stored dense embeddings for chunk IDs, as {chunk_id: vector}; unknown IDs are skipped"""
+        if self.dense_index is None:
+            raise ValueError("dense_index not initialized in chunk_embeddings()")
+        rows = {chunk_id: self.chunk_store.row_of(chunk_id) for chunk_id in chunk_ids}
+        return {chunk_id: self.dense_index.vector(row) for chunk_id, row in rows.items() if row is not None}
+
+    def search(self, query, top_k=10):
+        """Dense search returning (chunk_id, score) pairs, best first"""
+        if self.dense_index is None:
+            raise ValueError("dense_index not initialized in search()")
+        return self.search_by_vector(self.embed_query(query), top_k)
+
+    def search_by_vector(self, embedding, top_k=10):
+        """Dense search for a precomputed query embedding"""
+        if self.dense_index is None:
+            raise ValueError("dense_index not initialized in search_by_vector()")
+        return [(self.chunk_store.chunk_id(row), score) for row, score in self.dense_index.search(embedding, top_k)]
+
+    def search_by_vectors(self, embeddings, top_k=10):
+        """Dense search for many query embeddings in one pass over the matrix; one hit list per embedding"""
+        if self.dense_index is None:
+            raise ValueError("dense_index not initialized in search_by_vectors()")
+        if not embeddings:
+            return []
+        return [[(self.chunk_store.chunk_id(row), score) for row, score in hits]
+                for hits in self.dense_index.search_many(embeddings, top_k)]
+
+    def raptor_search(self, embedding, top_k=10, beam=3):
+        """Chunks of the clusters closest to the query, as (chunk_id, cluster score) pairs (see RaptorTree.search)"""
+        if self.raptor_index is None:
+            return []
+        return [(self.chunk_store.chunk_id(row), score)
+                for row, score in self.raptor_index.search(embedding, top_k, beam)]
+
+    def get_documents(self, chunk_ids):
+        """Materialize Documents for chunk IDs from the chunk store"""
+        return self.chunk_store.get_documents(chunk_ids)
+
+    def sparse_search(self, query, top_k=10):
+        """BM25 search returning (chunk_id, score) pairs, best first"""
+        if self.sparse_index is None:
+            raise ValueError("sparse_index not initialized in sparse_search()")
+        return self.sparse_index.search(query, top_k)
+
+    def hybrid_hits(self, query, top_k=10):
+        """Dense and RAPTOR hits fused into one ranking of unique (chunk_id, score) pairs"""
+        if self.dense_index is None:
+            if self.sparse_index is not None:
+                print("🔎 Sparse-only search (dense index not built yet)")
+                return self.sparse_search(query, top_k*2)
+            raise ValueError("dense_index not initialized in hybrid_hits()")
         # RAPTOR index can be None if disabled
-        # if not self.raptor_index:
-        #     raise ValueError("raptor_index not initialized in hybrid_search()")
             
         print(f"🔎 Hybrid search - dense_index: {type(self.dense_index)}, raptor_index: {type(self.raptor_index)}")
-        # Dense retrieval
-        dense_results = self.dense_index.similarity_search(query, k=top_k*2)
+        # Embed the query once and reuse it for the dense and RAPTOR searches
+        query_embedding = self.embed_query(query)
         
-        # Sparse retrieval
-        tokenized_query = query.split()
+        # Dense retrieval
+        hits = self.search_by_vector(query_embedding, top_k*2)
         
-        # RAPTOR retrieval (skip if disabled)
+        # RAPTOR retrieval: descend the tree from the top-level clusters (skip if disabled)
         if self.raptor_index is not None:
-            raptor_results = self.raptor_index.similarity_search(query, k=top_k)
+            beam = int(os.getenv("RAPTOR_BEAM", "3"))
+            hits = fuse_raptor_hits(hits, self.raptor_search(query_embedding, top_k*2, beam))
         else:
             print("⚠️  RAPTOR retrieval skipped (disabled)")
-            raptor_results = []
         
-        # Combine results
-        all_results = list(dense_results) + raptor_results
-        return all_results[:top_k*3]
+        return hits[:top_k*3]
+
+    def hybrid_hits_batch(self, queries, top_k=10):
+        """hybrid_hits() for many queries: one embedding call and one dense query for the whole batch"""
+        if self.dense_index is None and self.sparse_index is not None:
+            return [self.sparse_search(query, top_k*2) for query in queries]
+        embeddings = self.embed_queries(queries)
+        beam = int(os.getenv("RAPTOR_BEAM", "3"))
+        results = []
+        for embedding, hits in zip(embeddings, self.search_by_vectors(embeddings, top_k*2)):
+            if self.raptor_index is not None:
+                hits = fuse_raptor_hits(hits, self.raptor_search(embedding, top_k*2, beam))
+            results.append(hits[:top_k*3])
+        return results
+
+    def hybrid_search(self, query, top_k=10):
+        """Documents for hybrid_hits(), best first"""
+        return self.get_documents([chunk_id for chunk_id, score in self.hybrid_hits(query, top_k)])
@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+import bisect
+import os
+import threading
+import time
+
+# Latency buckets in seconds, from cache hits to long generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """A metric family with a fixed set of label names, rendered in the Prometheus text format"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        """(suffix, labels, value) tuples"""
+        with self.lock:
+            return [("", list(zip(self.labelnames, key)), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_only(self, value, **labels):
+        """Set one label set and drop all others, e.g. for the current state of a state gauge"""
+        key = self._key(labels)
+        with self.lock:
+            self.values = {key: value}
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the block as in progress while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, total = self.values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = list(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append(("_bucket", labels + [("le", _format_value(bound))], cumulative))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    """All metrics of this process; collectors add metrics computed at scrape time"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        """collector() runs before each scrape and updates registered metrics read from elsewhere"""
+        self.collectors.append(collector)
+
+    def render(self):
+        """The Prometheus text exposition format (version 0.0.4)"""
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {str(e)}")
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "rag_stage_duration_seconds", "Wall time of query pipeline stages", ["graph", "stage"]))
+MODEL_CALLS = REGISTRY.register(Counter(
+    "rag_model_calls_total", "Calls to Ollama models", ["model", "kind", "status"]))
+MODEL_CALL_SECONDS = REGISTRY.register(Histogram(
+    "rag_model_call_duration_seconds", "Duration of calls to Ollama models", ["model", "kind"]))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "rag_cache_requests_total", "Cache lookups by cache and result (hit, miss, stale)", ["namespace", "result"]))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "rag_requests_in_flight", "HTTP requests being processed, including streamed responses", ["endpoint"]))
+REQUESTS = REGISTRY.register(Counter(
+    "rag_requests_total", "Finished HTTP requests", ["endpoint", "status"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "rag_request_duration_seconds", "HTTP request duration until the last byte was sent", ["endpoint"]))
+INGESTED_FILES = REGISTRY.register(Counter(
+    "rag_ingested_files_total", "Document files loaded for indexing", ["result"]))
+EMBEDDED_CHUNKS = REGISTRY.register(Counter(
+    "rag_embedded_chunks_total", "Chunks written to dense indexes, embedded by the model or reused", ["source"]))
+INGEST_THROUGHPUT = REGISTRY.register(Gauge(
+    "rag_ingest_chunks_per_second", "Embedding throughput of the last dense index build"))
+INDEX_BUILD_SECONDS = REGISTRY.register(Histogram(
+    "rag_index_build_duration_seconds", "Index builds: the first build or an incremental update", ["kind"]))
+PROCESS_START = REGISTRY.register(Gauge(
+    "rag_process_start_time_seconds", "Start time of this API worker process", ["pid"]))
+PROCESS_START.set(time.time(), pid=os.getpid())
+CORPUS_UPDATES = REGISTRY.register(Counter(
+    "rag_corpus_updates_total", "Incremental index updates installed"))
+CACHE_HIT_RATIO = REGISTRY.register(Gauge(
+    "rag_cache_hit_ratio", "Share of cache lookups answered from the cache", ["namespace"]))
+CACHE_MISS_RATIO = REGISTRY.register(Gauge(
+    "rag_cache_miss_ratio", "Share of cache lookups that missed", ["namespace"]))
+
+def cache_hit_ratios():
+    """Update rag_cache_hit_ratio and rag_cache_miss_ratio per cache from rag_cache_requests_total"""
+    totals = {}
+    for suffix, labels, value in CACHE_REQUESTS.samples():
+        labels = dict(labels)
+        totals.setdefault(labels["namespace"], {})[labels["result"]] = value
+    for namespace, results in totals.items():
+        lookups = sum(results.values())
+        # Stale answers are served from the cache too
+        CACHE_HIT_RATIO.set((results.get("hit", 0) + results.get("stale", 0)) / lookups, namespace=namespace)
+        CACHE_MISS_RATIO.set(results.get("miss", 0) / lookups, namespace=namespace)
+    return [CACHE_HIT_RATIO, CACHE_MISS_RATIO]
+
+REGISTRY.add_collector(cache_hit_ratios)
+
+def model_name(client):
+    return getattr(client, "model", None) or type(client).__name__
+
+@contextmanager
+def model_call(client, kind):
+    """Count and time one call to a model client; works around awaits too"""
+    model = model_name(client)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        MODEL_CALLS.inc(model=model, kind=kind, status=status)
+        MODEL_CALL_SECONDS.observe(time.perf_counter() - started, model=model, kind=kind)
+
+def timed_stage(graph, stage, fn):
+    """Wrap fn so each call is recorded in rag_stage_duration_seconds"""
+    def run(*args, **kwargs):
+        with STAGE_SECONDS.time(graph=graph, stage=stage):
+            return fn(*args, **kwargs)
+    return run
@@ -0,0 +1,24 @@
+import json
+import os
+
+def model_options(model, defaults=True):
+    """Ollama num_ctx/num_predict for a model.
+
+    MODEL_OPTIONS is a JSON object keyed by model name, e.g.
+    {"llama3:8b": {"num_ctx": 8192, "num_predict": 512}}. With defaults,
+    missing values fall back to OLLAMA_NUM_CTX / OLLAMA_NUM_PREDICT.
+    """
+    try:
+        configured = json.loads(os.getenv("MODEL_OPTIONS") or "{}")
+    except ValueError as e:
+        print(f"⚠️ Ignoring invalid MODEL_OPTIONS: {str(e)}")
+        configured = {}
+    options = {}
+    if defaults:
+        options = {
+            "num_ctx": int(os.getenv("OLLAMA_NUM_CTX", "4096")),
+            "num_predict": int(os.getenv("OLLAMA_NUM_PREDICT", "512"))
+        }
+    options.update({name: int(value) for name, value in configured.get(model, {}).items()
+                    if name in ("num_ctx", "num_predict")})
+    return options
@@ -1,62 +1,301 @@
-from rag_tool.document_processor import load_documents, chunk_text, raptor_clustering
-from rag_tool.indexing import MultiRepresentationIndex
-from rag_tool.retrieval import RetrievalSystem
+from rag_tool.document_processor import load_documents, load_files, chunk_text, scan_documents
+from rag_tool.indexing import MultiRepresentationIndex, retire_index
+from rag_tool.bulk_build import DenseIndexBuildIncomplete
+from rag_tool.sharding import ShardedIndex
+from rag_tool.retrieval import RetrievalSystem, resolve_mode
 from rag_tool.translation import OfflineTranslationSystem
+from rag_tool.deadline import Deadline
+from rag_tool.semantic_cache import create_semantic_cache
+from rag_tool.cache import VersionedCache, config_fingerprint
+from rag_tool.context_builder import ContextBuilder
+from rag_tool.prompt_builder import PromptBuilder
+from rag_tool.model_options import model_options
+from rag_tool.singleflight import SingleFlight
+from rag_tool.stage_graph import StageGraph
+from rag_tool.snapshot import IndexSnapshot, open_index, snapshot_key
+from rag_tool.metrics import CORPUS_UPDATES, INDEX_BUILD_SECONDS, STAGE_SECONDS, model_call
 from langchain_ollama import OllamaLLM
+import ollama
+import asyncio
+import concurrent.futures
 import os
 import hashlib
-import pickle
+import queue
+import threading
+import time
+import traceback
 
 # Cache directory
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+# Bump when the answer prompt changes so cached answers are invalidated
+PROMPT_VERSION = "2"
+
+# Phase of a pipeline serving an index snapshot published at each build stage, in build order
+SNAPSHOT_PHASES = {"sparse": "sparse_ready", "dense": "dense_ready", "full": "ready"}
+
+class ServingIndex:
+    """An index with the retriever, context builder and answer cache built for it.
+
+    The pipeline swaps the whole set with one reference assignment, and a
+    query reads it once when it starts, so every stage of that query sees
+    the same index version.
+    """
+
+    def __init__(self, index, retriever, context_builder, cache):
+        self.index = index
+        self.retriever = retriever
+        self.context_builder = context_builder
+        self.cache = cache
+
 class FocusedRAGPipeline:
     def __init__(self, data_path, language="ar"):
         self.data_path = data_path
         self.language = language
-        self.index = None
-        self.retriever = None
+        # The index being served with its retriever, context builder and answer cache
+        self.serving = None
         print("Initializing generator with llama3:8b model...")
         import os
         ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         generator_model = os.getenv("GENERATOR_MODEL", "llama3:8b")
         print(f"Using Ollama base URL for generator: {ollama_base_url}")
         print(f"Using generator model: {generator_model}")
-        self.generator = OllamaLLM(model=generator_model, base_url=ollama_base_url)
+        generator_options = model_options(generator_model)
+        print(f"Generator options: {generator_options}")
+        self.generator = OllamaLLM(model=generator_model, base_url=ollama_base_url, **generator_options)
+        # Instructions first, stable context order, question last; sized to the generator window
+        self.prompt_builder = PromptBuilder(language, generator_options["num_ctx"], generator_options["num_predict"])
+        self.generator_options = generator_options
+        # The generator model is loaded in Ollama during retrieval unless it was used within this many seconds
+        self.generator_warmup_interval = float(os.getenv("GENERATOR_WARMUP_INTERVAL", "240"))
+        self.generator_warm_until = 0.0
         self.translator = OfflineTranslationSystem()
+        # Share of the latency budget given to retrieval, which includes query translation
+        self.retrieval_budget_share = float(os.getenv("RETRIEVAL_BUDGET_SHARE", "0.5"))
+        # Query translations run in the background while retrieval already searches
+        self.background = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv("TRANSLATION_WORKERS", "4")))
+        # Serves answers of near-duplicate questions
+        self.semantic_cache = create_semantic_cache("query_semantic")
+        # Coalesces identical concurrent questions; blocking, async and streaming
+        # callers share one flight table, so any of them can follow any other
+        self.flights = SingleFlight("answer")
+        # Blocking steps of aquery() (searches, cache I/O); asyncio's default executor
+        # would cap the concurrent async requests at min(32, CPUs + 4)
+        self.async_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(os.getenv("ASYNC_QUERY_THREADS", "64")), thread_name_prefix="async-query")
+        self.query_graph = self.build_query_graph()
+        # Answers expire after ANSWER_CACHE_TTL seconds (unset: when the corpus or config changes).
+        # Within ANSWER_CACHE_STALE_TTL seconds past that, or after a corpus change, the old answer
+        # is served at once and regenerated in the background
+        answer_ttl = os.getenv("ANSWER_CACHE_TTL")
+        self.answer_ttl = float(answer_ttl) if answer_ttl else None
+        self.answer_stale_ttl = float(os.getenv("ANSWER_CACHE_STALE_TTL", "0"))
+        self.revalidation_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(os.getenv("ANSWER_REVALIDATION_WORKERS", "1")))
+        self.revalidating = set()
+        self.revalidation_lock = threading.Lock()
+        self.revalidations = 0
+        # Queries are served from the first usable index on (is_initialized);
+        # phase tracks the build: starting, waiting_for_index (another worker
+        # builds), loading_documents, sparse_ready, dense_ready, ready, or
+        # failed when no index could be built
         self.is_initialized = False
+        self.phase = "starting"
+        self.phase_times = {}
+        self.init_error = None
+        self.init_started = None
+        # Document files (path: mtime) the served index was built from; see update_corpus()
+        self.corpus_files = {}
+        self.corpus_lock = threading.Lock()
+        self.corpus_updates = 0
+        self.last_corpus_update = None
+        # A build that stops after sparse_ready (Ollama down, DENSE_BUILD_TIME_BUDGET) is
+        # resumed in the background, waiting INDEX_RETRY_DELAY seconds, doubled per failure
+        self.index_retry_delay = float(os.getenv("INDEX_RETRY_DELAY", "30"))
+        self.index_retry_max_delay = float(os.getenv("INDEX_RETRY_MAX_DELAY", "600"))
+        self.index_retries = 0
+        self.index_retry_timer = None
+        # Snapshot of the first build; see complete_index()
+        self.index_snapshot = None
     
-    def get_cache_key(self, question, target_lang=None):
+    def get_cache_key(self, question, target_lang=None, mode="deep"):
         """Generate a cache key based on question and parameters"""
-        hash_input = f"{question}_{target_lang}_{self.language}"
+        hash_input = f"{question}_{target_lang}_{self.language}_{mode}"
         return hashlib.md5(hash_input.encode()).hexdigest()
     
-    def save_to_cache(self, key, data):
+    @property
+    def index(self):
+        return self.serving.index if self.serving is not None else None
+    
+    @property
+    def retriever(self):
+        return self.serving.retriever if self.serving is not None else None
+    
+    @property
+    def context_builder(self):
+        return self.serving.context_builder if self.serving is not None else None
+    
+    @property
+    def cache(self):
+        """Versioned answer cache; created once the index (and so the corpus version) is known"""
+        return self.serving.cache if self.serving is not None else None
+    
+    def cache_fingerprint(self, retriever=None, context_builder=None):
+        """Everything cached answers depend on besides the question: retrieval, models and prompt"""
+        retriever = retriever or self.retriever
+        context_builder = context_builder or self.context_builder
+        return config_fingerprint(
+            retrieval=retriever.cache.fingerprint,
+            generator=os.getenv("GENERATOR_MODEL", "llama3:8b"),
+            translator=os.getenv("TRANSLATOR_MODEL", "mistral-nemo:latest"),
+            prompt=PROMPT_VERSION,
+            generator_options=f"{self.prompt_builder.num_ctx}_{self.prompt_builder.num_predict}",
+            context=f"{context_builder.token_budget}_{context_builder.lambda_mult}_"
+                    f"{context_builder.sentence_selection}_{context_builder.sentences_per_chunk}"
+        )
+    
+    def save_to_cache(self, key, data, cache=None):
         """Save query results to cache"""
-        cache_file = os.path.join(CACHE_DIR, f"query_{key}.pkl")
-        with open(cache_file, 'wb') as f:
-            pickle.dump(data, f)
-        return cache_file
-    
-    def load_from_cache(self, key):
-        """Load query results from cache"""
-        cache_file = os.path.join(CACHE_DIR, f"query_{key}.pkl")
-        if os.path.exists(cache_file):
+        return (cache or self.cache).save(key, data)
+    
+    def load_from_cache(self, key, cache=None):
+        """Load query results from the memory tier or disk; returns (result, stale)"""
+        return (cache or self.cache).lookup(key)
+    
+    def set_phase(self, phase):
+        self.phase = phase
+        self.phase_times[phase] = round(time.monotonic() - self.init_started, 3)
+        print(f"🚦 Pipeline phase: {phase} after {self.phase_times[phase]}s")
+    
+    def readiness(self):
+        """Initialization progress, as reported by /health"""
+        return {
+            "phase": self.phase,
+            "serving": self.is_initialized,
+            "search": ("dense" if self.index.dense_ready else "sparse") if self.is_initialized else None,
+            "phase_times": dict(self.phase_times),
+            "error": self.init_error,
+            "corpus": {"files": len(self.corpus_files), "updates": self.corpus_updates,
+                       "last_update": self.last_corpus_update}
+        }
+    
+    def install_index(self, index):
+        """Serve `index` with a new retriever, context builder and answer cache; returns the index it replaced"""
+        previous = self.serving
+        # The index version includes the stage, so results from a partial index get their own cache entries
+        retriever = RetrievalSystem(index, previous.retriever if previous else None)
+        context_builder = ContextBuilder(index)
+        # The replaced cache stays reachable, so its answers can be served stale while they are regenerated
+        cache = VersionedCache("query", self.cache_fingerprint(retriever, context_builder), ttl=self.answer_ttl,
+                               stale_ttl=self.answer_stale_ttl, previous=previous.cache if previous else None)
+        self.serving = ServingIndex(index, retriever, context_builder, cache)
+        return previous.index if previous is not None else None
+    
+    def retire(self, previous):
+        """Release a replaced index once queries that started before the swap are done with it"""
+        if previous is not None:
+            retire_index(previous, self.index)
+    
+    def active_semantic_cache(self, serving=None):
+        """The answer semantic cache, once query embeddings are available (dense index built)"""
+        return self.semantic_cache if (serving or self.serving).index.dense_ready else None
+    
+    def start_background_initialization(self):
+        """Run initialize() in a daemon thread and return it; progress is reported by readiness()"""
+        def run():
             try:
-                with open(cache_file, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                print(f"Error loading query cache {key}: {str(e)}")
-                # Remove corrupted cache file
-                os.remove(cache_file)
-        return None
+                self.initialize()
+            except Exception:
+                print(f"Traceback: {traceback.format_exc()}")
+        thread = threading.Thread(target=run, name="pipeline-init", daemon=True)
+        thread.start()
+        return thread
     
     def initialize(self):
+        """Load, chunk and index the documents.
+        
+        Queries are served as soon as the BM25 index is built (sparse_ready),
+        switch to dense search once the embeddings are in (dense_ready) and
+        add RAPTOR when everything is built (ready). If a later stage fails,
+        the pipeline keeps serving from the last stage that succeeded.
+        
+        The build is published as an index snapshot at sparse_ready and again
+        when it is complete. Other API worker processes, and later restarts
+        with unchanged documents, open that snapshot instead of building
+        again (see rag_tool.snapshot); only the process that published it
+        finishes an unfinished build.
+        """
         if self.is_initialized:
             return True
-            
+        try:
+            return self._initialize()
+        except Exception as e:
+            self.init_error = str(e)
+            if not self.is_initialized:
+                self.phase = "failed"
+            raise
+    
+    def _initialize(self):
+        self.init_started = time.monotonic()
         print("🔄 Initializing RAG pipeline...")
+        # Scanned before loading, so files changed during the build are picked up by update_corpus()
+        self.corpus_files = scan_documents(self.data_path)
+        self.index_snapshot = snapshot = IndexSnapshot(snapshot_key(self.corpus_files, self.language))
+        build_started = None
+        if not self.open_snapshot(snapshot):
+            # One process builds; other API workers wait here, then open what it published
+            self.set_phase("waiting_for_index")
+            with snapshot.lock:
+                if not self.open_snapshot(snapshot):
+                    build_started = time.monotonic()
+                    self.build_index()
+                    # Waiting workers open this and serve BM25 while this process builds the rest
+                    snapshot.own()
+                    snapshot.publish(self.index.snapshot())
+        if self.phase == "ready":
+            return True
+        try:
+            if not self.complete_index():
+                # Another worker finishes the build; reopen its snapshot once it has advanced
+                self.schedule_index_retry()
+                return True
+        except Exception as e:
+            print(f"❌ Failed to build indexes, serving from the {self.phase} index: {str(e)}")
+            self.schedule_index_retry(e)
+            raise
+        finally:
+            if build_started is not None:
+                INDEX_BUILD_SECONDS.observe(time.monotonic() - build_started, kind="initial")
+        print("✅ Pipeline initialized successfully")
+        return True
+    
+    def open_snapshot(self, snapshot):
+        """Serve a published index snapshot read-only; False when there is none or it cannot be opened.
+
+        An unfinished snapshot is served at its stage (sparse_ready or
+        dense_ready). A snapshot no further along than the served index is
+        not reopened.
+        """
+        descriptor = snapshot.read()
+        if descriptor is None:
+            return False
+        stages = list(SNAPSHOT_PHASES)
+        if self.is_initialized and stages.index(descriptor.get("stage", "full")) <= stages.index(self.index.stage):
+            return True
+        try:
+            index = open_index(descriptor, self.data_path)
+        except Exception as e:
+            print(f"⚠️ Could not open index snapshot {snapshot.key}, rebuilding: {str(e)}")
+            return False
+        self.retire(self.install_index(index))
+        self.is_initialized = True
+        self.set_phase(SNAPSHOT_PHASES[index.stage])
+        print(f"✅ Serving the {self.phase} index snapshot {snapshot.key}")
+        return True
+    
+    def build_index(self):
+        self.set_phase("loading_documents")
         try:
             print("Loading documents...")
             docs = load_documents(self.data_path, self.language)
@@ -74,144 +313,642 @@ class FocusedRAGPipeline:
             print(f"❌ Failed to chunk text: {str(e)}")
             raise
         
-        try:
-            print("Building RAPTOR hierarchy...")
-            raptor_chunks = raptor_clustering(chunks)
-            print(f"🌲 Built {len(raptor_chunks)} hierarchical clusters")
-        except Exception as e:
-            print(f"❌ Failed to build RAPTOR clusters: {str(e)}")
-            raise
+        # The RAPTOR tree is built by the index from the dense embeddings,
+        # so no separate flat cluster documents are needed here
+        raptor_chunks = []
         
         try:
             print("🏗️ Constructing indexes...")
-            self.index = MultiRepresentationIndex()
-            self.index.build_indexes(chunks, raptor_chunks)
-        except Exception as e:
-            print(f"❌ Failed to build indexes: {str(e)}")
-            raise
-        
-        try:
+            if os.getenv("INDEX_SHARDS") or os.getenv("INDEX_SHARD_STRATEGY"):
+                index = ShardedIndex(self.data_path)
+            else:
+                index = MultiRepresentationIndex()
+            index.build_sparse(chunks, raptor_chunks)
             print("🔍 Initializing retriever...")
-            self.retriever = RetrievalSystem(self.index)
+            self.install_index(index)
         except Exception as e:
-            print(f"❌ Failed to initialize retriever: {str(e)}")
+            print(f"❌ Failed to build the sparse index: {str(e)}")
             raise
-        
         self.is_initialized = True
-        print("✅ Pipeline initialized successfully")
+        self.set_phase("sparse_ready")
+    
+    def finish_index(self, snapshot=None):
+        """Run the build steps the served index is still missing, up to the ready phase.
+        
+        Each step runs on a copy of the served index, which is swapped in when
+        the step is done, and published to `snapshot` when one is given. The
+        dense build resumes from its last checkpoint.
+        """
+        if self.phase == "sparse_ready":
+            self.retire(self.install_index(self.index.successor("build_dense")))
+            self.set_phase("dense_ready")
+            if snapshot is not None:
+                self.publish_snapshot(snapshot)
+        if self.phase == "dense_ready":
+            self.retire(self.install_index(self.index.successor("build_raptor")))
+            self.set_phase("ready")
+            if snapshot is not None:
+                self.publish_snapshot(snapshot)
+        self.init_error = None
+        self.index_retries = 0
+    
+    def schedule_index_retry(self, error=None):
+        """Resume the stopped build in the background, backing off after each failure.
+
+        Without an error, the build is owned by another worker: its snapshot
+        is checked again after INDEX_RETRY_DELAY seconds.
+        """
+        if error is not None:
+            self.init_error = str(error)
+        if isinstance(error, DenseIndexBuildIncomplete):
+            # The build made progress up to its time budget; continue it soon
+            self.index_retries = 0
+        delay = min(self.index_retry_max_delay, self.index_retry_delay * 2 ** self.index_retries)
+        if error is not None:
+            self.index_retries += 1
+            print(f"🔁 Resuming the index build in {delay:.0f}s")
+        else:
+            print(f"🔁 Checking for a newer index snapshot in {delay:.0f}s")
+        self.index_retry_timer = threading.Timer(delay, self.retry_index)
+        self.index_retry_timer.daemon = True
+        self.index_retry_timer.start()
+    
+    def retry_index(self):
+        """Resume the build of the served index and publish it once it is complete"""
+        with self.corpus_lock:
+            if self.phase == "ready":
+                return
+            try:
+                if not self.complete_index():
+                    self.schedule_index_retry()
+            except Exception as e:
+                print(f"❌ Index build retry failed, serving from the {self.phase} index: {str(e)}")
+                self.schedule_index_retry(e)
+    
+    def complete_index(self):
+        """finish_index(), then publish the served index as the snapshot of its corpus scan.
+
+        Only the snapshot's owner (see IndexSnapshot.own) finishes the build;
+        other workers open the latest snapshot it published, and take the
+        build over if the owner has exited. Returns False while another
+        worker still owns the unfinished build.
+        """
+        snapshot = self.index_snapshot
+        owner = snapshot.own()
+        # An owner that took the build over resumes from the latest published stage
+        self.open_snapshot(snapshot)
+        if self.phase == "ready":
+            snapshot.disown()
+            return True
+        if not owner:
+            return False
+        self.finish_index(snapshot)
+        snapshot.disown()
+        print("✅ Index build completed")
         return True
     
-    def query(self, question, target_lang=None, return_original=False):
-        if not self.is_initialized:
-            raise RuntimeError("Pipeline not initialized")
-            
+    def publish_snapshot(self, snapshot):
+        with snapshot.lock:
+            snapshot.publish(self.index.snapshot())
+    
+    def update_corpus(self):
+        """Reindex the document files added, changed or removed since the served index was built.
+        
+        Only those files are loaded, chunked and embedded (see the index's
+        updated()); the new index is built next to the served one and swapped
+        in with one assignment, so queries never wait and never mix versions.
+        Like the first build, the result is published as an index snapshot:
+        the first API worker to get the build lock does the work and the
+        others open its snapshot. A served index whose build stopped early
+        is finished first. Returns True when a new index was installed.
+        """
+        with self.corpus_lock:
+            # The first build scans the files itself
+            if not self.is_initialized:
+                return False
+            if self.phase != "ready" and not self.complete_index():
+                print("⏳ Another worker is still building the index; the changed files are indexed by the next update")
+                return False
+            files = scan_documents(self.data_path)
+            changed = sorted(path for path in set(files) | set(self.corpus_files)
+                             if files.get(path) != self.corpus_files.get(path))
+            if not changed:
+                return False
+            started = time.monotonic()
+            print(f"📂 {len(changed)} document files changed, updating the index...")
+            # Keyed by this scan, the one `changed` came from; later changes are picked up by the next update
+            snapshot = IndexSnapshot(snapshot_key(files, self.language))
+            with snapshot.lock:
+                index = None
+                descriptor = snapshot.read()
+                if descriptor is not None:
+                    # Another worker already indexed this change
+                    try:
+                        index = open_index(descriptor, self.data_path)
+                    except Exception as e:
+                        print(f"⚠️ Could not open index snapshot {snapshot.key}, rebuilding: {str(e)}")
+                if index is None:
+                    new_chunks = chunk_text(load_files([path for path in changed if path in files]))
+                    index = self.index.updated(changed, new_chunks)
+                    if index is None:
+                        print("⚠️ No document chunks would be left; keeping the current index")
+                        self.corpus_files = files
+                        return False
+                    snapshot.publish(index.snapshot())
+            self.retire(self.install_index(index))
+            self.corpus_files = files
+            self.corpus_updates += 1
+            CORPUS_UPDATES.inc()
+            self.last_corpus_update = time.time()
+            INDEX_BUILD_SECONDS.observe(time.monotonic() - started, kind="update")
+            print(f"✅ Index updated for {len(changed)} changed files in {time.monotonic() - started:.1f}s")
+            return True
+    
+    def start_translation(self, question, query_language):
+        """Start translating the query in the background; None when it is already in the document language"""
+        if query_language == self.language:
+            return None
+        print(f"Translating query from {query_language} to {self.language}")
+        timing = {}
+        translation = self.background.submit(self.translate_in_background, question, timing)
+        # The translate_query stage only submits the translation; answer() reports this timing as `translate`
+        translation.timing = timing
+        return translation
+    
+    def translate_in_background(self, question, timing):
+        """Translate the query, recording its wall and CPU time as the query graph's translate stage"""
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            return self.translator.translate_query(question, self.language)
+        finally:
+            timing.update(wall=round(time.perf_counter() - wall_start, 4), cpu=round(time.thread_time() - cpu_start, 4))
+            STAGE_SECONDS.observe(timing["wall"], graph=self.query_graph.name, stage="translate")
+    
+    @staticmethod
+    def add_translation_timing(context, timings):
+        """Stage timings with the background query translation, once it has finished, as `translate`"""
+        timing = getattr(context["translate_query"], "timing", None)
+        return {**timings, "translate": dict(timing)} if timing else timings
+    
+    def finish_translation(self, question, translation, deadline):
+        """Wait for the translated query within the deadline; fall back to the untranslated query"""
+        if translation is None:
+            return question
+        try:
+            return translation.result(timeout=deadline.remaining())
+        except concurrent.futures.TimeoutError:
+            deadline.cut("translation")
+        except Exception as e:
+            print(f"⚠️ Query translation failed: {str(e)}")
+        # The multilingual embeddings and the generator still handle the original query
+        return question
+    
+    def flight_key(self, state, return_original, latency_budget):
+        """Requests with this key can share one in-flight computation"""
+        return f"{state['cache_key']}_{return_original}_{latency_budget}"
+    
+    def lookup_answer(self, question, target_lang, return_original, mode, serving=None):
+        """Return (cached answer or None, cache state used by save_answer).
+        
+        The state pins the index being served now; the rest of the query uses it.
+        """
+        serving = serving or self.serving
         # Generate cache key
-        cache_key = self.get_cache_key(question, target_lang)
+        cache_key = self.get_cache_key(question, target_lang, mode)
         print(f"🔍 Checking pipeline cache for key: {cache_key}")
+        state = {"cache_key": cache_key, "question": question, "question_embedding": None, "serving": serving,
+                 "scope": f"{serving.cache.fingerprint}_{target_lang}_{self.language}_{mode}_{return_original}"}
         
         # Try to load from cache first
-        cached_data = self.load_from_cache(cache_key)
+        cached_data, stale = self.load_from_cache(cache_key, serving.cache)
         if cached_data is not None:
-            print("✅ Loaded query response from cache")
-            return cached_data
+            if stale:
+                print("♻️ Serving a stale query response while it is regenerated")
+                self.revalidate(question, target_lang, return_original, mode, state)
+            else:
+                print("✅ Loaded query response from cache")
+            return cached_data, state
         else:
             print("🔄 Cache miss - processing query")
-            
-        print(f"❓ Query: {question}")
-        
-        # If return_original is True, return the original documents directly
-        if return_original:
-            # Detect query language
-            query_language = self.translator.detect_language(question)
-            
-            # Translate query if needed
-            translated_query = question
-            if query_language != self.language:
-                print(f"Translating query from {query_language} to {self.language}")
-                translated_query = self.translator.translate_query(question, self.language)
-            print(f"🌐 Query language: {query_language}, Document language: {self.language}")
-            print(f"🌐 Translated query: {translated_query}")
-            
-            # Retrieve relevant documents
-            context_docs = self.retriever.retrieve(translated_query)
-            print(f"🔍 Retrieved {len(context_docs)} documents")
-            
-            # Return original documents directly
-            original_content = "\n\n".join(
-                [f"Source: {doc.metadata.get('source', 'Unknown')}\n{doc.page_content}"
-                 for doc in context_docs]
-            )
-            
-            result = {
-                "original_response": original_content,
-                "translation": None,
-                "source_language": query_language
-            }
-            
-            # Save to cache
-            self.save_to_cache(cache_key, result)
-            print("💾 Saved query response to cache")
-            return result
-        
-        # Detect query language
-        query_language = self.translator.detect_language(question)
         
-        # Translate query if needed
-        translated_query = question
-        if query_language != self.language:
-            print(f"Translating query from {query_language} to {self.language}")
-            translated_query = self.translator.translate_query(question, self.language)
-        print(f"🌐 Query language: {query_language}, Document language: {self.language}")
-        print(f"🌐 Translated query: {translated_query}")
+        # Fall back to the answer of the nearest previously asked question
+        semantic_cache = self.active_semantic_cache(serving)
+        if semantic_cache is not None:
+            state["question_embedding"] = serving.index.embed_query(question)
+            cached_data = semantic_cache.lookup(state["question_embedding"], question, state["scope"])
+        return cached_data, state
+    
+    def revalidate(self, question, target_lang, return_original, mode, state):
+        """Regenerate a stale answer in the background; at most one refresh per question is queued"""
+        key = self.flight_key(state, return_original, None)
+        with self.revalidation_lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+            self.revalidations += 1
         
-        # Retrieve relevant documents
-        context_docs = self.retriever.retrieve(translated_query)
-        print(f"🔍 Retrieved {len(context_docs)} documents")
+        def refresh():
+            try:
+                # Shares the computation with a concurrent request for the same question
+                self.flights.do(key, self.answer, question, target_lang, return_original, mode, Deadline(), state)
+            except Exception as e:
+                print(f"⚠️ Could not regenerate stale answer: {str(e)}")
+            finally:
+                with self.revalidation_lock:
+                    self.revalidating.discard(key)
         
-        # Prepare context string with citations
-        context_str = "\n\n".join(
-            [f"📑 Source: {doc.metadata.get('source', 'Unknown')}\nContent: {doc.page_content}"
+        self.revalidation_pool.submit(refresh)
+    
+    def cache_stats(self):
+        """Answer cache hit, miss and stale counts"""
+        stats = self.cache.stats() if self.cache is not None else {}
+        stats["revalidations"] = self.revalidations
+        return stats
+    
+    def save_answer(self, state, result, deadline):
+        # Save to cache (answers built from cut stages are not cached)
+        if deadline.cut_stages:
+            return
+        self.save_to_cache(state["cache_key"], result, state["serving"].cache)
+        if self.semantic_cache is not None and state["question_embedding"] is not None:
+            self.semantic_cache.add(state["question_embedding"], state["question"], result, state["scope"])
+        print("💾 Saved query response to cache")
+    
+    def format_original(self, context_docs):
+        """The retrieved documents themselves, for return_original"""
+        return "\n\n".join(
+            [f"Source: {doc.metadata.get('source', 'Unknown')}\n{doc.page_content}"
              for doc in context_docs]
         )
+    
+    def build_prompt(self, translated_query, context_docs, serving=None):
+        # Diversify and compress the retrieved chunks to fit what the model window leaves for context
+        context_builder = (serving or self.serving).context_builder
+        context_docs = context_builder.build(translated_query, context_docs,
+                                             token_budget=self.prompt_builder.context_budget(translated_query))
+        return self.prompt_builder.build(translated_query, context_docs)
+    
+    def translate_response(self, response, target_lang):
+        # Add translation if requested
+        if target_lang and target_lang != self.language:
+            print(f"🌐 Translating response to {target_lang}...")
+            return self.translator.translate(response, target_lang)
+        return None
+    
+    def build_query_graph(self):
+        """The stages of answer() and aanswer().
         
-        # Prepare language-specific instructions
-        if self.language == "ar":
-            language_instruction = "- يجب أن تكون إجابتك باللغة العربية (العربية فقط)"
+        Language detection, query translation and retrieval form one chain;
+        translate_query only starts the translation, so retrieval searches the
+        raw query meanwhile. The generator model is loaded (warm_generator)
+        while that chain runs. The answer is then either the formatted
+        documents (return_original) or a generation, optionally translated.
+        """
+        generating = lambda ctx: not ctx["return_original"]
+        translating_answer = lambda ctx: generating(ctx) and bool(ctx["target_lang"]) and ctx["target_lang"] != self.language
+        graph = StageGraph("query")
+        graph.add("detect_language", lambda ctx: self.translator.detect_language(ctx["question"]))
+        graph.add("warm_generator", lambda ctx: self.warm_generator(), when=generating)
+        graph.add("translate_query", lambda ctx: self.start_translation(ctx["question"], ctx["detect_language"]),
+                  after=("detect_language",))
+        graph.add("retrieve", lambda ctx: ctx["serving"].retriever.retrieve(ctx["question"], mode=ctx["mode"],
+                                                                            deadline=ctx["retrieval_deadline"],
+                                                                            translation=ctx["translate_query"]),
+                  after=("translate_query",))
+        graph.add("finish_translation",
+                  lambda ctx: self.finish_translation(ctx["question"], ctx["translate_query"], ctx["retrieval_deadline"]),
+                  after=("retrieve",))
+        graph.add("format_original", lambda ctx: self.format_original(ctx["retrieve"]),
+                  after=("retrieve",), when=lambda ctx: ctx["return_original"])
+        graph.add("build_prompt", lambda ctx: self.build_prompt(ctx["finish_translation"], ctx["retrieve"], ctx["serving"]),
+                  after=("finish_translation",), when=generating)
+        graph.add("generate", lambda ctx: self.generate(ctx["build_prompt"], ctx.get("on_token")),
+                  after=("build_prompt", "warm_generator"), when=generating,
+                  afn=lambda ctx: self.agenerate(ctx["build_prompt"]))
+        graph.add("translate_answer", lambda ctx: self.translator.translate(ctx["generate"], ctx["target_lang"]),
+                  after=("generate",), when=translating_answer,
+                  afn=lambda ctx: self.translator.atranslate(ctx["generate"], ctx["target_lang"]))
+        return graph
+    
+    def stage_inputs(self, question, target_lang, return_original, mode, deadline, serving):
+        print(f"❓ Query: {question}")
+        return {
+            "serving": serving,
+            "question": question,
+            "target_lang": target_lang,
+            "return_original": return_original,
+            "mode": mode,
+            "deadline": deadline,
+            # Translation, expansion and searches share this part of the latency budget
+            "retrieval_deadline": deadline.sub(self.retrieval_budget_share)
+        }
+    
+    def skipped_stages(self, mode):
+        """Stages turned off by QUERY_SKIP_STAGES and QUERY_SKIP_STAGES_<MODE> (comma-separated names)"""
+        names = f"{os.getenv('QUERY_SKIP_STAGES', '')},{os.getenv(f'QUERY_SKIP_STAGES_{mode.upper()}', '')}"
+        return {name.strip() for name in names.split(",") if name.strip()}
+    
+    def stage_result(self, context, deadline):
+        if context["return_original"]:
+            response, translation = context["format_original"], None
         else:
-            language_instruction = f"- Answer in the original document language ({self.language})"
+            response, translation = context["generate"], context["translate_answer"]
+        return {
+            "original_response": response,
+            "translation": translation,
+            "source_language": context["detect_language"],
+            "cut_stages": list(deadline.cut_stages)
+        }
+    
+    def generate(self, prompt, on_token=None):
+        """Generate the answer; with on_token, stream it and pass each token to on_token as it arrives"""
+        with model_call(self.generator, "generate"):
+            if on_token is None:
+                return self.generator.invoke(prompt)
+            parts = []
+            for token in self.generator.stream(prompt):
+                parts.append(token)
+                on_token(token)
+            return "".join(parts)
+    
+    async def agenerate(self, prompt):
+        with model_call(self.generator, "generate"):
+            return await self.generator.ainvoke(prompt)
+    
+    def warm_generator(self):
+        """Load the generator model in Ollama unless it was used recently; returns whether a load was requested"""
+        now = time.monotonic()
+        if self.generator_warmup_interval <= 0 or now < self.generator_warm_until:
+            return False
+        self.generator_warm_until = now + self.generator_warmup_interval
+        try:
+            # An empty prompt only loads the model. The options must match the generation
+            # requests, or Ollama reloads the model with the new context size
+            with model_call(self.generator, "load"):
+                ollama.Client(host=self.generator.base_url).generate(model=self.generator.model, prompt="",
+                                                                     options=self.generator_options)
+            return True
+        except Exception as e:
+            print(f"⚠️ Could not warm up the generator model: {str(e)}")
+            return False
+    
+    def query(self, question, target_lang=None, return_original=False, mode=None, latency_budget=None):
+        if not self.is_initialized:
+            raise RuntimeError("Pipeline not initialized")
+        mode = resolve_mode(mode)
+        deadline = Deadline.from_env(latency_budget)
+        
+        cached_data, state = self.lookup_answer(question, target_lang, return_original, mode)
+        if cached_data is not None:
+            return cached_data
+        
+        # Identical questions that are already being answered share that computation
+        return self.flights.do(self.flight_key(state, return_original, latency_budget),
+                               self.answer, question, target_lang, return_original, mode, deadline, state)
+    
+    def answer(self, question, target_lang, return_original, mode, deadline, state):
+        """Compute, cache and return the answer after a cache miss"""
+        context, timings = self.query_graph.run(
+            self.stage_inputs(question, target_lang, return_original, mode, deadline, state["serving"]),
+            skip=self.skipped_stages(mode))
+        result = self.stage_result(context, deadline)
+        self.save_answer(state, result, deadline)
+        return {**result, "stage_timings": self.add_translation_timing(context, timings)}
+    
+    async def aquery(self, question, target_lang=None, return_original=False, mode=None, latency_budget=None):
+        """Async query(): model calls are awaited and blocking steps run in worker threads.
+
+        Language detection, the search fan-out, fusion and cache I/O run in
+        async_pool (ASYNC_QUERY_THREADS threads); generation and response
+        translation use the model clients' ainvoke. The event loop is never
+        blocked, so concurrent requests overlap.
+        """
+        if not self.is_initialized:
+            raise RuntimeError("Pipeline not initialized")
+        mode = resolve_mode(mode)
+        deadline = Deadline.from_env(latency_budget)
         
-        prompt = f"""
-        **INSTRUCTIONS**
-        - Answer concisely using ONLY the context below
-        - Cite sources using [Source: filename] notation
-        - If unsure, say "I couldn't find definitive information"
-        {language_instruction}
+        cached_data, state = await self.in_thread(self.lookup_answer, question, target_lang, return_original, mode)
+        if cached_data is not None:
+            return cached_data
         
-        **QUESTION**
-        {translated_query}
+        return await self.flights.ado(self.flight_key(state, return_original, latency_budget),
+                                      self.aanswer, question, target_lang, return_original, mode, deadline, state)
+    
+    async def aanswer(self, question, target_lang, return_original, mode, deadline, state):
+        """Async answer(); generation and response translation are awaited"""
+        context, timings = await self.query_graph.arun(
+            self.stage_inputs(question, target_lang, return_original, mode, deadline, state["serving"]),
+            skip=self.skipped_stages(mode), executor=self.async_pool)
+        result = self.stage_result(context, deadline)
+        await self.in_thread(self.save_answer, state, result, deadline)
+        return {**result, "stage_timings": self.add_translation_timing(context, timings)}
+    
+    async def in_thread(self, fn, *args):
+        """Run a blocking call in async_pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.async_pool, fn, *args)
+    
+    def query_batch(self, questions, target_lang=None, return_original=False, mode=None, max_concurrency=None,
+                    latency_budget=None):
+        """Answer many questions, yielding (index, result) as each one finishes.
         
-        **CONTEXT**
-        {context_str}
+        A question asked several times in the batch is answered once and
+        yielded for each of its indices. Cached answers are yielded first.
+        For the rest, all questions are embedded in one call and their
+        languages detected up front; translations start in the background
+        and retrieval runs as one batch (see RetrievalSystem.retrieve_batch).
+        Generations then run at most max_concurrency
+        (BATCH_GENERATION_CONCURRENCY) at a time, and are shared with
+        concurrent requests for the same question (see query()).
+        A failed question yields {"error": ...} instead of stopping the batch.
         
-        **ANSWER**
+        latency_budget (seconds, default BATCH_LATENCY_BUDGET) bounds the
+        waits for query translations and expansions of the whole batch; a
+        question whose translation is not ready by then uses the untranslated
+        query, like query() does, and its answer is not cached.
         """
+        if not self.is_initialized:
+            raise RuntimeError("Pipeline not initialized")
+        mode = resolve_mode(mode)
+        max_concurrency = int(max_concurrency or os.getenv("BATCH_GENERATION_CONCURRENCY", "2"))
+        if latency_budget is None:
+            latency_budget = float(os.getenv("BATCH_LATENCY_BUDGET", "300"))
+        deadline = Deadline(latency_budget)
+        # The whole batch is answered from the index being served now
+        serving = self.serving
+        indices = {}
+        for i, question in enumerate(questions):
+            indices.setdefault(question, []).append(i)
         
-        print("🤖 Generating response...")
-        response = self.generator.invoke(prompt)
+        # One embedding call for the semantic cache lookups of the whole batch
+        if self.active_semantic_cache(serving) is not None:
+            serving.index.embed_queries(list(indices))
+        states = {}
+        for question in indices:
+            cached_data, state = self.lookup_answer(question, target_lang, return_original, mode, serving)
+            if cached_data is not None:
+                for i in indices[question]:
+                    yield i, cached_data
+            else:
+                states[question] = state
+        if not states:
+            return
         
-        # Add translation if requested
-        translation = None
-        if target_lang and target_lang != self.language:
-            print(f"🌐 Translating response to {target_lang}...")
-            translation = self.translator.translate(response, target_lang)
+        pending = list(states)
+        languages = {question: self.translator.detect_language(question) for question in pending}
+        translations = {question: self.start_translation(question, languages[question]) for question in pending}
+        context_docs = serving.retriever.retrieve_batch(pending, mode=mode,
+                                                        translations=[translations[question] for question in pending],
+                                                        deadline=deadline)
         
-        result = {
-            "original_response": response,
-            "translation": translation,
-            "source_language": query_language
+        def answer_question(question, docs):
+            # Own cut stages, within the batch deadline
+            question_deadline = Deadline(expires_at=deadline.expires_at)
+            translated_query = self.finish_translation(question, translations[question], question_deadline)
+            if return_original:
+                response, translation = self.format_original(docs), None
+            else:
+                response = self.generate(self.build_prompt(translated_query, docs, serving))
+                translation = self.translate_response(response, target_lang)
+            result = {
+                "original_response": response,
+                "translation": translation,
+                "source_language": languages[question],
+                "cut_stages": list(question_deadline.cut_stages)
+            }
+            self.save_answer(states[question], result, question_deadline)
+            return result
+        
+        print(f"🤖 Generating {len(pending)} answers, {max_concurrency} at a time...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            futures = {pool.submit(self.flights.do, self.flight_key(states[question], return_original, None),
+                                   answer_question, question, docs): question
+                       for question, docs in zip(pending, context_docs)}
+            for future in concurrent.futures.as_completed(futures):
+                question = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"❌ Batch question {indices[question]} failed: {str(e)}")
+                    result = {"error": str(e)}
+                for i in indices[question]:
+                    yield i, result
+    
+    def query_stream(self, question, target_lang=None, return_original=False, mode=None, latency_budget=None):
+        """Like query(), but yields events as they become available.
+
+        {"type": "metadata", ...}  sources and languages, once retrieval is done
+        {"type": "token", "text"}  generated text as the generator streams it
+        {"type": "done", ...}      translation, cut stages, timing stats and stage timings
+
+        The answer is computed by the same query graph as query(). Time to first token and tokens per second are measured from the
+        start of the request and logged.
+        """
+        if not self.is_initialized:
+            raise RuntimeError("Pipeline not initialized")
+        started = time.monotonic()
+        mode = resolve_mode(mode)
+        deadline = Deadline.from_env(latency_budget)
+        
+        cached_data, state = self.lookup_answer(question, target_lang, return_original, mode)
+        if cached_data is not None:
+            yield from self.answer_events(cached_data, started, cached=True)
+            return
+        
+        # Subscribers to an identical in-flight stream receive all of its events; an identical
+        # query() or aquery() in flight is replayed as events once its answer lands
+        yield from self.flights.stream(self.flight_key(state, return_original, latency_budget),
+                                       self.stream_answer, question, target_lang, return_original, mode,
+                                       deadline, state, started, result_of=self.stream_result,
+                                       events_of=lambda result: self.answer_events(result, started, cached=False))
+    
+    @staticmethod
+    def answer_events(result, started, cached):
+        """query_stream() events of a finished answer: a cached one, or one computed by query() or aquery()"""
+        yield {"type": "metadata", "cached": cached, "source_language": result["source_language"], "sources": []}
+        yield {"type": "token", "text": result["original_response"]}
+        done = {"type": "done", "translation": result["translation"], "cut_stages": result.get("cut_stages", []),
+                "stats": {"time_to_first_token": round(time.monotonic() - started, 3), "cached": cached}}
+        if "stage_timings" in result:
+            done["stage_timings"] = result["stage_timings"]
+        yield done
+    
+    @staticmethod
+    def stream_result(events):
+        """The query() result of a finished stream, for query() and aquery() callers that joined it"""
+        metadata = next(event for event in events if event["type"] == "metadata")
+        done = events[-1]
+        return {
+            "original_response": "".join(event["text"] for event in events if event["type"] == "token"),
+            "translation": done["translation"],
+            "source_language": metadata["source_language"],
+            "cut_stages": done["cut_stages"],
+            "stage_timings": done["stage_timings"]
         }
+    
+    def stream_answer(self, question, target_lang, return_original, mode, deadline, state, started):
+        """Events of query_stream() after a cache miss.
+
+        The query graph runs in a background thread exactly as in answer();
+        its generate stage streams the generator's tokens, which are yielded
+        as they arrive.
+        """
+        events = queue.Queue()
+        inputs = self.stage_inputs(question, target_lang, return_original, mode, deadline, state["serving"])
+        inputs["on_token"] = lambda token: events.put({"type": "token", "text": token})
         
-        # Save to cache
-        self.save_to_cache(cache_key, result)
-        print("💾 Saved query response to cache")
-        return result
\ No newline at end of file
+        def on_stage(name, context):
+            # Retrieval and query translation are done; no token has been generated yet
+            if name == "finish_translation":
+                events.put({
+                    "type": "metadata",
+                    "cached": False,
+                    "source_language": context["detect_language"],
+                    "translated_query": context["finish_translation"],
+                    "sources": list(dict.fromkeys(doc.metadata.get("source", "Unknown") for doc in context["retrieve"] or [])),
+                    "retrieval_time": round(time.monotonic() - started, 3)
+                })
+        
+        def run():
+            try:
+                events.put(self.query_graph.run(inputs, skip=self.skipped_stages(mode), on_stage=on_stage))
+            except Exception as e:
+                events.put(e)
+        
+        print("🤖 Streaming response...")
+        threading.Thread(target=run, name="query-stream", daemon=True).start()
+        first_token_at = None
+        tokens = 0
+        while True:
+            event = events.get()
+            if isinstance(event, Exception):
+                raise event
+            if isinstance(event, tuple):
+                context, timings = event
+                break
+            if event["type"] == "token":
+                first_token_at = first_token_at or time.monotonic()
+                tokens += 1
+            yield event
+        result = self.stage_result(context, deadline)
+        if return_original:
+            first_token_at = time.monotonic()
+            tokens = 1
+            yield {"type": "token", "text": result["original_response"]}
+        finished_at = time.monotonic()
+        first_token_at = first_token_at or finished_at
+        
+        stats = {
+            "time_to_first_token": round(first_token_at - started, 3),
+            "generation_time": round(finished_at - first_token_at, 3),
+            "tokens": tokens,
+            # Decode rate after the first token, so prompt processing is not counted twice
+            "tokens_per_second": round((tokens - 1) / (finished_at - first_token_at), 2) if tokens > 1 and finished_at > first_token_at else None,
+            "total_time": round(finished_at - started, 3)
+        }
+        print(f"⏱️ Time to first token {stats['time_to_first_token']}s, {stats['tokens_per_second']} tokens/s")
+        
+        self.save_answer(state, result, deadline)
+        yield {"type": "done", "translation": result["translation"], "cut_stages": result["cut_stages"], "stats": stats,
+               "stage_timings": self.add_translation_timing(context, timings)}
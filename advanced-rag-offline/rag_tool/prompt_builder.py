@@ -0,0 +1,77 @@
+from rag_tool.chunk_store import chunk_id_for
+from rag_tool.context_builder import estimate_tokens
+import os
+
+class PromptBuilder:
+    """Assembles the answer prompt so consecutive prompts share the longest possible prefix.
+
+    Layout: fixed instructions, then the context chunks in a stable
+    (source, position) order, then the question. The instructions are
+    identical for every query, so Ollama can reuse their KV cache, and two
+    queries retrieving the same chunks produce the same context text.
+
+    The context gets whatever the model window leaves after the
+    instructions, the question and num_predict tokens for the answer, capped
+    at `token_budget`. Chunks arrive in priority order (see ContextBuilder);
+    the lowest priority ones are dropped if they do not fit.
+    """
+
+    def __init__(self, language, num_ctx, num_predict, token_budget=None):
+        self.language = language
+        self.num_ctx = num_ctx
+        self.num_predict = num_predict
+        self.token_budget = int(token_budget or os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+        self.instructions = self.instruction_block()
+
+    def instruction_block(self):
+        if self.language == "ar":
+            language_instruction = "- يجب أن تكون إجابتك باللغة العربية (العربية فقط)"
+        else:
+            language_instruction = f"- Answer in the original document language ({self.language})"
+        return (
+            "**INSTRUCTIONS**\n"
+            "- Answer concisely using ONLY the context below\n"
+            "- Cite sources using [Source: filename] notation\n"
+            "- If unsure, say \"I couldn't find definitive information\"\n"
+            f"{language_instruction}\n\n"
+            "**CONTEXT**\n"
+        )
+
+    @staticmethod
+    def question_block(question):
+        return f"\n\n**QUESTION**\n{question}\n\n**ANSWER**\n"
+
+    @staticmethod
+    def chunk_block(doc):
+        return f"📑 Source: {doc.metadata.get('source', 'Unknown')}\nContent: {doc.page_content}"
+
+    @staticmethod
+    def stable_key(doc):
+        start = doc.metadata.get("start_index", -1)
+        return (doc.metadata.get("source", "Unknown"), start if start is not None else -1, chunk_id_for(doc))
+
+    def context_budget(self, question):
+        """Tokens left for the context once instructions, question and answer are accounted for"""
+        fixed = estimate_tokens(self.instructions) + estimate_tokens(self.question_block(question))
+        return max(0, min(self.token_budget, self.num_ctx - self.num_predict - fixed))
+
+    def pack(self, question, docs):
+        """Keep chunks in priority order while they fit the budget"""
+        budget = self.context_budget(question)
+        packed = []
+        used_tokens = 0
+        for doc in docs:
+            # Blocks are joined by a blank line
+            tokens = estimate_tokens(self.chunk_block(doc) + "\n\n")
+            if used_tokens + tokens > budget:
+                continue
+            used_tokens += tokens
+            packed.append(doc)
+        if len(packed) < len(docs):
+            print(f"✂️ Dropped {len(docs) - len(packed)} chunks to fit the {budget}-token context budget")
+        return packed
+
+    def build(self, question, docs):
+        packed = sorted(self.pack(question, docs), key=self.stable_key)
+        context_str = "\n\n".join(self.chunk_block(doc) for doc in packed)
+        return self.instructions + context_str + self.question_block(question)
@@ -1,35 +1,158 @@
 from langchain_ollama import OllamaLLM
 from langchain_core.prompts import ChatPromptTemplate
+from rag_tool.model_options import model_options
+from rag_tool.metrics import CACHE_REQUESTS, model_call
 import json
 import os
+import re
+import hashlib
+import pickle
+
+# Cache directory
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Bump when the expansion prompt changes so cached retrievals are invalidated
+EXPANSION_PROMPT_VERSION = "1"
+
+PARAPHRASE_KEYS = ("paraphrases", "queries", "variants", "versions")
+SUB_QUESTION_KEYS = ("sub_questions", "subquestions", "sub-questions", "questions")
+
+def normalize_query(query):
+    """Lowercase and collapse whitespace so trivially different queries share a key"""
+    return " ".join(query.lower().split())
+
+def _string_list(value):
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [item.strip() for item in value if isinstance(item, str) and item.strip()]
+
+def parse_expansion(text):
+    """Parse an expansion response into (paraphrases, sub_questions), or None.
+
+    Accepts a JSON object with paraphrase/sub-question lists, a bare JSON
+    array (treated as paraphrases), either of those wrapped in markdown
+    code fences or surrounded by prose, and as a last resort a bulleted or
+    numbered list.
+    """
+    text = text.strip()
+    text = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", text).strip()
+
+    candidates = [text]
+    object_match = re.search(r"\{.*\}", text, re.DOTALL)
+    if object_match:
+        candidates.append(object_match.group(0))
+    array_match = re.search(r"\[.*\]", text, re.DOTALL)
+    if array_match:
+        candidates.append(array_match.group(0))
+
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(data, list):
+            paraphrases = _string_list(data)
+            if paraphrases:
+                return paraphrases, []
+        elif isinstance(data, dict):
+            paraphrases = next((_string_list(data[k]) for k in PARAPHRASE_KEYS if k in data), [])
+            sub_questions = next((_string_list(data[k]) for k in SUB_QUESTION_KEYS if k in data), [])
+            if paraphrases or sub_questions:
+                return paraphrases, sub_questions
+
+    lines = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s+", "", line).strip().strip('"')
+             for line in text.splitlines() if re.match(r"^\s*(?:[-*•]|\d+[.)])\s+", line)]
+    lines = [line for line in lines if line]
+    if lines:
+        return lines, []
+    return None
 
 class QueryTransformer:
     def __init__(self):
         ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         query_transformer_model = os.getenv("QUERY_TRANSFORMER_MODEL", "llama3:8b")
-        self.llm = OllamaLLM(model=query_transformer_model, base_url=ollama_base_url, temperature=0.3)
-    
-    def multi_query(self, query):
-        prompt = ChatPromptTemplate.from_template("""
-        Generate 3 different versions of the user's question for document retrieval.
-        Focus on different aspects and synonyms. Return ONLY a JSON array:
-        ["query1", "query2", "query3"]
-        
-        Original: {query}""")
-        chain = prompt | self.llm
-        try:
-            return json.loads(chain.invoke({"query": query}).strip())
-        except:
-            return [query]
-    
-    def decompose_query(self, query):
+        self.model = query_transformer_model
+        self.llm = OllamaLLM(model=query_transformer_model, base_url=ollama_base_url, temperature=0.3,
+                             **model_options(query_transformer_model, defaults=False))
+        self.retries = int(os.getenv("EXPANSION_RETRIES", "1"))
+
+    def get_cache_key(self, query):
+        """Generate a cache key based on the normalized query, model and prompt version"""
+        hash_input = f"{normalize_query(query)}_{self.model}_{EXPANSION_PROMPT_VERSION}"
+        return hashlib.md5(hash_input.encode()).hexdigest()
+
+    def save_to_cache(self, key, data):
+        """Save query expansion to cache"""
+        cache_file = os.path.join(CACHE_DIR, f"expansion_{key}.pkl")
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(tmp_file, cache_file)
+        return cache_file
+
+    def load_from_cache(self, key):
+        """Load query expansion from cache"""
+        cache_file = os.path.join(CACHE_DIR, f"expansion_{key}.pkl")
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    return pickle.load(f)
+            except Exception as e:
+                print(f"Error loading expansion cache {key}: {str(e)}")
+                # Remove corrupted cache file
+                os.remove(cache_file)
+        return None
+
+    def expand(self, query):
+        """Generate paraphrases and sub-questions for a query in one LLM call"""
+        cache_key = self.get_cache_key(query)
+        cached_data = self.load_from_cache(cache_key)
+        if cached_data is not None:
+            CACHE_REQUESTS.inc(namespace="expansion", result="hit")
+            print("🔀 Loaded query expansion from cache")
+            return cached_data
+        CACHE_REQUESTS.inc(namespace="expansion", result="miss")
+
         prompt = ChatPromptTemplate.from_template("""
-        Break this complex question into 2-4 standalone sub-questions. 
-        Return ONLY a JSON array: ["subq1", "subq2", ...]
-        
+        Prepare the user's question for document retrieval. Return ONLY a JSON object:
+        {{"paraphrases": ["...", "...", "..."], "sub_questions": ["...", "..."]}}
+        - paraphrases: 3 different versions of the question, focusing on different aspects and synonyms
+        - sub_questions: if the question is complex, 2-4 standalone sub-questions; otherwise an empty list
+
         Question: {query}""")
         chain = prompt | self.llm
-        try:
-            return json.loads(chain.invoke({"query": query}).strip())
-        except:
-            return [query]
\ No newline at end of file
+        for attempt in range(self.retries + 1):
+            try:
+                with model_call(self.llm, "expand"):
+                    parsed = parse_expansion(chain.invoke({"query": query}))
+            except Exception as e:
+                print(f"⚠️ Query expansion call failed: {str(e)}")
+                parsed = None
+            if parsed is not None:
+                paraphrases, sub_questions = parsed
+                result = {"paraphrases": paraphrases, "sub_questions": sub_questions}
+                self.save_to_cache(cache_key, result)
+                return result
+            print(f"⚠️ Could not parse query expansion (attempt {attempt + 1})")
+        # Failures are not cached, so the next request tries again
+        return {"paraphrases": [query], "sub_questions": [query]}
+
+    def expanded_queries(self, query):
+        """All distinct expansion queries, excluding the original query itself"""
+        expansion = self.expand(query)
+        seen = {normalize_query(query)}
+        queries = []
+        for q in expansion["paraphrases"] + expansion["sub_questions"]:
+            if normalize_query(q) not in seen:
+                seen.add(normalize_query(q))
+                queries.append(q)
+        return queries
+
+    def multi_query(self, query):
+        return self.expand(query)["paraphrases"]
+
+    def decompose_query(self, query):
+        return self.expand(query)["sub_questions"] or [query]
@@ -0,0 +1,199 @@
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from rag_tool.dense_matrix import normalize_rows
+from rag_tool.versioned_dir import current_version, new_version, publish_version
+import numpy as np
+import json
+import math
+import os
+import shutil
+
+def _cluster(embeddings, n_clusters):
+    """Split rows into at most n_clusters groups, returning a label per row"""
+    if len(embeddings) <= n_clusters:
+        return np.arange(len(embeddings))
+    if len(embeddings) > 5000:
+        model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=4096, n_init=1, random_state=0)
+    else:
+        model = KMeans(n_clusters=n_clusters, n_init=1, random_state=0)
+    return model.fit_predict(embeddings)
+
+def _height(n, branching):
+    """Enough levels that each bottom cluster holds about `branching` chunks"""
+    return max(1, math.ceil(math.log(max(n, 2)) / math.log(branching)) - 1)
+
+class RaptorTree:
+    """Level-aware RAPTOR index over chunk embeddings.
+
+    Level 0 is the chunks themselves: the tree does not store their
+    embeddings but reads the rows of the normalized dense matrix
+    (DenseMatrix.embeddings) it was built from. Every higher level holds
+    cluster nodes whose embedding is the normalized centroid of their
+    members, with parent and child links to the neighbouring levels.
+    The top level is small (at most `branching` nodes).
+
+    The tree directory holds immutable versions like a ChunkStore; each
+    level of a version lives in its own directory:
+        level_<n>/embeddings.npy      float32 node embeddings (n > 0)
+        level_<n>/parents.npy         parent node in level n + 1 (-1 at the top)
+        level_<n>/child_offsets.npy   CSR offsets into children.npy (n > 0)
+        level_<n>/children.npy        child nodes in level n - 1 (n > 0)
+
+    Search starts at the top level, keeps the `beam` best nodes and only
+    descends into their children, so a query costs about
+    height * beam * branching dot products regardless of corpus size.
+    """
+
+    def __init__(self, directory, leaves):
+        self.directory = directory
+        self.path = current_version(directory)
+        with open(os.path.join(self.path, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["count"] != len(leaves):
+            raise ValueError(f"RAPTOR tree covers {manifest['count']} chunks, the dense index {len(leaves)}")
+        self.height = manifest["height"]
+        self.branching = manifest["branching"]
+        self.embeddings = [leaves]
+        self.parents = []
+        self.child_offsets = []
+        self.children = []
+        for level in range(self.height + 1):
+            level_dir = os.path.join(self.path, f"level_{level}")
+            self.parents.append(np.load(os.path.join(level_dir, "parents.npy"), mmap_mode="r"))
+            if level == 0:
+                self.child_offsets.append(None)
+                self.children.append(None)
+            else:
+                self.embeddings.append(np.load(os.path.join(level_dir, "embeddings.npy"), mmap_mode="r"))
+                self.child_offsets.append(np.load(os.path.join(level_dir, "child_offsets.npy"), mmap_mode="r"))
+                self.children.append(np.load(os.path.join(level_dir, "children.npy"), mmap_mode="r"))
+
+    @classmethod
+    def exists(cls, directory):
+        """Check if a complete tree exists in directory"""
+        return os.path.exists(os.path.join(current_version(directory), "manifest.json"))
+
+    @classmethod
+    def build(cls, leaves, directory, branching=10):
+        """Build a tree over normalized leaf embeddings (one per chunk row) and open it"""
+        n = len(leaves)
+        if n == 0:
+            raise ValueError("Cannot build a RAPTOR tree without embeddings")
+        height = _height(n, branching)
+        print(f"🌳 Building RAPTOR tree over {n} chunks ({height} levels, branching {branching})")
+
+        # Split top-down: every group of rows is clustered into up to
+        # `branching` child nodes, starting from an implicit root.
+        groups = [np.arange(n)]
+        levels = []
+        for depth in range(height):
+            members, parents, centroids = [], [], []
+            for group_id, rows in enumerate(groups):
+                labels = _cluster(leaves[rows], branching)
+                for label in np.unique(labels):
+                    node_rows = rows[labels == label]
+                    members.append(node_rows)
+                    parents.append(-1 if depth == 0 else group_id)
+                    centroids.append(leaves[node_rows].mean(axis=0))
+            levels.append({"members": members, "parents": np.array(parents, dtype=np.int64),
+                           "embeddings": normalize_rows(np.vstack(centroids))})
+            groups = members
+
+        tmp_dir = new_version(directory)
+        # levels[0] is the top of the tree, stored as level `height`
+        leaf_parents = np.full(n, -1, dtype=np.int64)
+        for node, rows in enumerate(levels[-1]["members"]):
+            leaf_parents[rows] = node
+        cls._save_level(tmp_dir, 0, None, leaf_parents)
+        for depth, info in enumerate(levels):
+            if depth + 1 < len(levels):
+                child_parents = levels[depth + 1]["parents"]
+                order = np.argsort(child_parents, kind="stable")
+                bounds = np.searchsorted(child_parents[order], np.arange(len(info["members"]) + 1))
+                child_lists = [order[bounds[node]:bounds[node + 1]] for node in range(len(info["members"]))]
+            else:
+                child_lists = info["members"]
+            cls._save_level(tmp_dir, height - depth, info["embeddings"], info["parents"], child_lists)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"height": height, "branching": branching, "count": n}, f)
+
+        publish_version(directory, tmp_dir)
+        return cls(directory, leaves)
+
+    def updated(self, rows, leaves, directory):
+        """A tree over `leaves`, which are leaf rows `rows` of this tree followed by new chunks, opened.
+
+        The cluster levels are copied: kept chunks stay in their bottom
+        cluster and new chunks join the one with the nearest centroid, so no
+        clustering runs. Returns None when the number of chunks calls for a
+        tree of another height; the caller builds a new tree then.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        n = len(leaves)
+        if n == 0 or _height(n, self.branching) != self.height:
+            return None
+        bottom = np.asarray(self.embeddings[1])
+        leaf_parents = np.empty(n, dtype=np.int64)
+        leaf_parents[:len(rows)] = self.parents[0][rows]
+        for start in range(len(rows), n, 65536):
+            end = min(start + 65536, n)
+            leaf_parents[start:end] = np.argmax(np.asarray(leaves[start:end]) @ bottom.T, axis=1)
+        order = np.argsort(leaf_parents, kind="stable")
+        bounds = np.searchsorted(leaf_parents[order], np.arange(len(bottom) + 1))
+
+        tmp_dir = new_version(directory)
+        self._save_level(tmp_dir, 0, None, leaf_parents)
+        self._save_level(tmp_dir, 1, bottom, np.asarray(self.parents[1]),
+                         [order[bounds[node]:bounds[node + 1]] for node in range(len(bottom))])
+        for level in range(2, self.height + 1):
+            shutil.copytree(os.path.join(self.path, f"level_{level}"), os.path.join(tmp_dir, f"level_{level}"))
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"height": self.height, "branching": self.branching, "count": n}, f)
+
+        publish_version(directory, tmp_dir)
+        return RaptorTree(directory, leaves)
+
+    @staticmethod
+    def _save_level(tree_dir, level, embeddings, parents, child_lists=None):
+        level_dir = os.path.join(tree_dir, f"level_{level}")
+        os.makedirs(level_dir)
+        if embeddings is not None:
+            np.save(os.path.join(level_dir, "embeddings.npy"), np.asarray(embeddings, dtype=np.float32))
+        np.save(os.path.join(level_dir, "parents.npy"), parents)
+        if child_lists is not None:
+            offsets = np.zeros(len(child_lists) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(c) for c in child_lists])
+            children = np.concatenate(child_lists).astype(np.int64) if child_lists else np.zeros(0, dtype=np.int64)
+            np.save(os.path.join(level_dir, "child_offsets.npy"), offsets)
+            np.save(os.path.join(level_dir, "children.npy"), children)
+
+    def close(self):
+        """Nothing to release; level arrays are memory-mapped read-only"""
+        pass
+
+    def node_children(self, level, node):
+        start, end = int(self.child_offsets[level][node]), int(self.child_offsets[level][node + 1])
+        return np.asarray(self.children[level][start:end])
+
+    def search(self, query_embedding, top_k=10, beam=3):
+        """Chunks of the bottom-level clusters closest to the query, as (row, cluster score) pairs.
+
+        Chunks are ranked by how close their cluster, i.e. their topic, is to
+        the query, and by their own score within a cluster. A chunk on the
+        query's topic therefore ranks high here even when its own embedding
+        ranks low in the dense search.
+        """
+        query = normalize_rows(query_embedding).reshape(-1)
+        frontier = np.arange(len(self.embeddings[self.height]))
+        for level in range(self.height, 1, -1):
+            scores = np.asarray(self.embeddings[level][frontier]) @ query
+            best = frontier[np.argsort(-scores)[:beam]]
+            frontier = np.concatenate([self.node_children(level, node) for node in best])
+        scores = np.asarray(self.embeddings[1][frontier]) @ query
+        results = []
+        for i in np.argsort(-scores):
+            rows = np.sort(self.node_children(1, frontier[i]))
+            leaf_scores = np.asarray(self.embeddings[0][rows]) @ query
+            results.extend((int(rows[j]), float(scores[i])) for j in np.argsort(-leaf_scores))
+            if len(results) >= top_k:
+                break
+        return results[:top_k]
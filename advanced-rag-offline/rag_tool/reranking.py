@@ -0,0 +1,164 @@
+from langchain_ollama.embeddings import OllamaEmbeddings
+from rag_tool.chunk_store import chunk_id_for
+from rag_tool.query_transformer import normalize_query
+from rag_tool.metrics import CACHE_REQUESTS, model_call
+from collections import OrderedDict
+import abc
+import numpy as np
+import os
+import re
+import threading
+
+RERANKERS = ("none", "bi_encoder", "lexical")
+
+class RerankCache:
+    """Thread-safe LRU of (reranker, query, chunk_id) -> score"""
+
+    def __init__(self, capacity=None):
+        self.capacity = int(capacity or os.getenv("RERANK_CACHE_SIZE", "10000"))
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.scores:
+                CACHE_REQUESTS.inc(namespace="rerank", result="miss")
+                return None
+            self.scores.move_to_end(key)
+            CACHE_REQUESTS.inc(namespace="rerank", result="hit")
+            return self.scores[key]
+
+    def put(self, key, score):
+        with self.lock:
+            self.scores[key] = score
+            self.scores.move_to_end(key)
+            while len(self.scores) > self.capacity:
+                self.scores.popitem(last=False)
+
+class Reranker(abc.ABC):
+    """Scores (query, chunk) pairs and reorders fused candidates.
+
+    Subclasses implement score_batch(query, texts), or score_docs(query,
+    docs) when they score more than the text. Only chunks without a cached
+    score are sent to the scorer, in batches of `batch_size`.
+    """
+
+    name = "base"
+
+    def __init__(self, batch_size=None, cache=None):
+        self.batch_size = int(batch_size or os.getenv("RERANK_BATCH_SIZE", "16"))
+        self.cache = cache if cache is not None else RerankCache()
+
+    @abc.abstractmethod
+    def score_batch(self, query, texts):
+        """One relevance score per text, higher is better"""
+
+    def score_docs(self, query, docs):
+        """One relevance score per Document, higher is better"""
+        return self.score_batch(query, [doc.page_content for doc in docs])
+
+    def rerank(self, query, docs, top_k=None):
+        """Return docs sorted by rerank score (kept in metadata['rerank_score']), cut to top_k"""
+        normalized = normalize_query(query)
+        keys = [(self.name, normalized, chunk_id_for(doc)) for doc in docs]
+        scores = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            print(f"📊 Reranking {len(missing)} chunks ({len(docs) - len(missing)} cached)")
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            batch_scores = self.score_docs(query, [docs[i] for i in batch])
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                self.cache.put(keys[i], scores[i])
+
+        for doc, score in zip(docs, scores):
+            doc.metadata["rerank_score"] = score
+        # Stable sort keeps the fusion order between equal scores
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])
+        return [docs[i] for i in order][:top_k]
+
+class BiEncoderReranker(Reranker):
+    """Cosine similarity between query and chunk embeddings of an Ollama embedding model.
+
+    Ollama has no endpoint that scores (query, text) pairs, so cross-encoder
+    models such as bge-reranker cannot be served this way; their embeddings
+    are not trained for cosine similarity. RERANKER_MODEL must be an
+    embedding model and defaults to EMBEDDING_MODEL. The query and each
+    batch of chunk texts are embedded in one call.
+
+    When the model is the one the index was embedded with, re-embedding
+    would only reproduce the stored vectors, so the stored chunk embeddings
+    and the index's memoized query embedding are used and no model is called.
+    """
+
+    def __init__(self, model=None, base_url=None, batch_size=None, cache=None, index=None):
+        super().__init__(batch_size, cache)
+        embedding_model = os.getenv("EMBEDDING_MODEL", "jeffh/intfloat-multilingual-e5-large:q8_0")
+        self.model = model or os.getenv("RERANKER_MODEL") or embedding_model
+        self.name = f"bi_encoder:{self.model}"
+        if "rerank" in self.model.lower():
+            print(f"⚠️ RERANKER_MODEL {self.model} looks like a cross-encoder; its embedding similarities are not meaningful")
+        # The index whose stored embeddings come from the same model, if any
+        self.index = index if self.model == embedding_model else None
+        base_url = base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+        self.embeddings = OllamaEmbeddings(model=self.model, base_url=base_url)
+
+    def score_docs(self, query, docs):
+        if self.index is None or not self.index.dense_ready:
+            return super().score_docs(query, docs)
+        chunk_ids = [chunk_id_for(doc) for doc in docs]
+        stored = self.index.chunk_embeddings(chunk_ids)
+        if len(stored) < len(set(chunk_ids)):
+            return super().score_docs(query, docs)
+        query_vector = np.asarray(self.index.embed_query(query), dtype=np.float32)
+        return self.cosine(query_vector, np.asarray([stored[chunk_id] for chunk_id in chunk_ids], dtype=np.float32))
+
+    def score_batch(self, query, texts):
+        with model_call(self.embeddings, "rerank"):
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+            text_vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        return self.cosine(query_vector, text_vectors)
+
+    @staticmethod
+    def cosine(query_vector, text_vectors):
+        norms = np.linalg.norm(text_vectors, axis=1) * np.linalg.norm(query_vector)
+        return text_vectors @ query_vector / np.maximum(norms, 1e-12)
+
+class LexicalReranker(Reranker):
+    """Deterministic term-overlap scorer; needs no model, used in tests and as a cheap fallback"""
+
+    name = "lexical"
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"\w+", text.lower())
+
+    def score_batch(self, query, texts):
+        query_terms = set(self.tokenize(query))
+        scores = []
+        for text in texts:
+            terms = self.tokenize(text)
+            if not terms or not query_terms:
+                scores.append(0.0)
+                continue
+            # Query coverage, with a small bonus for term density
+            covered = query_terms & set(terms)
+            density = sum(1 for term in terms if term in query_terms) / len(terms)
+            scores.append(len(covered) / len(query_terms) + 0.1 * density)
+        return scores
+
+def create_reranker(kind=None, index=None):
+    """Build the reranker named by RERANKER (none, bi_encoder or lexical); None when disabled.
+
+    `index` is the index being searched; the bi-encoder reads its stored embeddings when it can.
+    """
+    kind = kind or os.getenv("RERANKER", "none")
+    if kind not in RERANKERS:
+        raise ValueError(f"Unknown reranker: {kind}. Expected one of {', '.join(RERANKERS)}")
+    if kind == "bi_encoder":
+        return BiEncoderReranker(index=index)
+    if kind == "lexical":
+        return LexicalReranker()
+    return None
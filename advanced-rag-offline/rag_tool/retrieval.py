@@ -1,63 +1,104 @@
-from rag_tool.query_transformer import QueryTransformer
+from rag_tool.query_transformer import QueryTransformer, EXPANSION_PROMPT_VERSION, normalize_query
+from rag_tool.retrieval_executor import ConcurrentRetrievalExecutor, RankAccumulator
+from rag_tool.reranking import create_reranker
+from rag_tool.semantic_cache import create_semantic_cache
+from rag_tool.cache import VersionedCache, config_fingerprint
+from rag_tool.singleflight import SingleFlight
+from rag_tool.metrics import STAGE_SECONDS, timed_stage
 from langchain_ollama import OllamaLLM
+import concurrent.futures
 import numpy as np
 import os
 import hashlib
-import pickle
 from pathlib import Path
 
-# Cache directory
-CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
-os.makedirs(CACHE_DIR, exist_ok=True)
+# Retrieval depth modes:
+#   fast      one hybrid search, no LLM expansion
+#   balanced  expand only when needs_expansion() says the query is complex
+#   deep      always expand (multi-query + decomposition)
+RETRIEVAL_MODES = ("fast", "balanced", "deep")
+
+# Words that usually signal a multi-part or comparative question
+COMPLEX_QUERY_TERMS = {
+    "and", "or", "compare", "comparison", "versus", "vs", "difference", "differences",
+    "between", "both", "why", "how", "impact", "relationship", "explain",
+    "مقارنة", "الفرق", "بين", "لماذا", "كيف", "العلاقة", "تأثير"
+}
+
+def needs_expansion(query):
+    """Cheap heuristic: does this query benefit from LLM expansion?"""
+    words = query.lower().replace("?", " ").replace("؟", " ").replace(",", " ").split()
+    if len(words) >= 12:
+        return True
+    if query.count("?") + query.count("؟") > 1:
+        return True
+    return any(word in COMPLEX_QUERY_TERMS for word in words)
+
+def resolve_mode(mode=None):
+    """Validate a retrieval mode, falling back to RETRIEVAL_MODE from the environment"""
+    mode = mode or os.getenv("RETRIEVAL_MODE", "deep")
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}. Expected one of {', '.join(RETRIEVAL_MODES)}")
+    return mode
 
 class RetrievalSystem:
-    def __init__(self, index):
+    def __init__(self, index, previous=None):
         self.index = index
+        self.executor = ConcurrentRetrievalExecutor()
+        # Optional rerank stage: the top rerank_candidates fused chunks are rescored
+        # and only the best rerank_top_k go to the generator
+        self.reranker = create_reranker(index=index)
+        self.rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "20"))
+        self.rerank_top_k = int(os.getenv("RERANK_TOP_K", "4"))
+        # Serves retrievals of near-duplicate queries; needs query embeddings, so not on a BM25-only index
+        self.semantic_cache = create_semantic_cache("retrieval_semantic") if getattr(index, "dense_ready", True) else None
+        # `previous` is the retriever this one replaces; its cache entries are collected
+        self.cache = VersionedCache("retrieval", self.cache_fingerprint(),
+                                    previous=previous.cache if previous is not None else None)
+        # Identical concurrent retrievals share one computation
+        self.flights = SingleFlight("retrieval")
         print(f"🛠️ RetrievalSystem initialized with index: {type(index)}")
         # Check if RAPTOR is enabled
         if hasattr(index, 'raptor_index') and index.raptor_index is None:
             print("⚠️  RAPTOR retrieval is currently disabled")
     
-    def get_cache_key(self, query, top_k=10):
+    def get_cache_key(self, query, top_k=10, mode="deep"):
         """Generate a cache key based on query and parameters"""
-        hash_input = f"{query}_{top_k}"
+        reranker = self.reranker.name if self.reranker is not None else "none"
+        hash_input = f"{query}_{top_k}_{mode}_{reranker}"
         return hashlib.md5(hash_input.encode()).hexdigest()
     
+    def cache_fingerprint(self):
+        """Everything cached retrievals depend on besides the query: corpus version, models and settings"""
+        return config_fingerprint(
+            corpus=getattr(self.index, "version", None),
+            query_transformer=os.getenv("QUERY_TRANSFORMER_MODEL", "llama3:8b"),
+            expansion_prompt=EXPANSION_PROMPT_VERSION,
+            reranker=self.reranker.name if self.reranker is not None else "none",
+            rerank=f"{self.rerank_candidates}_{self.rerank_top_k}",
+            fusion=f"{os.getenv('FUSION_METHOD', 'rrf')}_{os.getenv('FUSION_RRF_K', '60')}",
+            raptor_beam=os.getenv("RAPTOR_BEAM", "3")
+        )
+    
     def save_to_cache(self, key, data):
         """Save retrieval results to cache"""
-        cache_file = os.path.join(CACHE_DIR, f"retrieval_{key}.pkl")
-        with open(cache_file, 'wb') as f:
-            pickle.dump(data, f)
-        return cache_file
+        return self.cache.save(key, data)
     
     def load_from_cache(self, key):
-        """Load retrieval results from cache"""
-        cache_file = os.path.join(CACHE_DIR, f"retrieval_{key}.pkl")
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                print(f"Error loading retrieval cache {key}: {str(e)}")
-                # Remove corrupted cache file
-                os.remove(cache_file)
-        return None
-    
-    def reciprocal_rank_fusion(self, rankings, k=60):
-        fused_scores = {}
-        doc_map = {}  # Map to store doc_id -> doc mappings
-        for rank, docs in enumerate(rankings):
-            for i, doc in enumerate(docs):
-                doc_id = id(doc)
-                doc_map[doc_id] = doc  # Store the actual document
-                fused_scores[doc_id] = fused_scores.get(doc_id, 0) + 1/(k + i + rank + 1)
-        # Return both scores and documents
-        sorted_docs = sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
-        return [(doc_id, score, doc_map[doc_id]) for doc_id, score in sorted_docs]
+        """Load retrieval results from the memory tier or disk"""
+        return self.cache.load(key)
     
-    def retrieve(self, query, top_k=10):
+    def retrieve(self, query, top_k=10, mode=None, deadline=None, translation=None):
+        """Retrieve the top_k chunks for query.
+
+        translation is an optional Future of the query translated to the
+        document language. The raw query is searched right away (the
+        embeddings are multilingual) and the translated query is searched
+        and fused as soon as the translation finishes.
+        """
+        mode = resolve_mode(mode)
         # Generate cache key
-        cache_key = self.get_cache_key(query, top_k)
+        cache_key = self.get_cache_key(query, top_k, mode)
         print(f"🔍 Checking retrieval cache for key: {cache_key}")
         
         # Try to load from cache first
@@ -68,30 +109,180 @@ class RetrievalSystem:
         else:
             print("🔄 Retrieval cache miss - processing retrieval")
         
-        print("🔍 Retrieving documents...")
-        # Generate queries
-        transformer = QueryTransformer()
+        # Fall back to the nearest previously retrieved query
+        scope = f"{self.cache.fingerprint}_{top_k}_{mode}"
+        query_embedding = None
+        if self.semantic_cache is not None:
+            query_embedding = self.index.embed_query(query)
+            cached_data = self.semantic_cache.lookup(query_embedding, query, scope)
+            if cached_data is not None:
+                return cached_data
         
-        # Original query retrieval
-        original_results = self.index.hybrid_search(query, top_k*3)
+        return self.flights.do(cache_key, self.retrieve_uncached, query, top_k, mode, deadline, translation,
+                               cache_key, scope, query_embedding)
+    
+    def wants_expansion(self, query, mode):
+        return mode == "deep" or (mode == "balanced" and needs_expansion(query))
+    
+    def retrieve_uncached(self, query, top_k, mode, deadline, translation, cache_key, scope, query_embedding):
+        """Search, fuse and rerank after a cache miss, and cache the results"""
+        print(f"🔍 Retrieving documents ({mode} mode)...")
+        expansions = {}
+        if self.wants_expansion(query, mode):
+            # Generate queries
+            transformer = QueryTransformer()
+            expansions["expand"] = transformer.expanded_queries
+        if translation is not None:
+            expansions["translation"] = lambda raw_query: [translation.result()]
         
-        # Multi-query retrieval
-        multi_queries = transformer.multi_query(query)
-        multi_results = [self.index.hybrid_search(q, top_k) for q in multi_queries]
+        # The original search and one combined multi-query/decomposition call run
+        # concurrently; expansion searches are fused (RAG-Fusion) as each one completes
+        cut_before = len(deadline.cut_stages) if deadline is not None else 0
+        accumulator = self.executor.run(query, self.index.hybrid_hits, expansions, top_k=top_k, deadline=deadline,
+                                        primary=("translation",))
         
-        # Query decomposition
-        sub_queries = transformer.decompose_query(query)
-        decomposed_results = [self.index.hybrid_search(q, top_k) for q in sub_queries]
+        # Rerank against the document-language query when the translation is ready
+        rerank_query = query
+        if translation is not None and translation.done() and not translation.cancelled() and translation.exception() is None:
+            rerank_query = translation.result()
+        results = self.finish_retrieval(accumulator, rerank_query, top_k, deadline)
         
-        # RAG-Fusion
-        all_rankings = [original_results] + multi_results + decomposed_results
-        fused = self.reciprocal_rank_fusion(all_rankings)
-        fused_docs = [doc for doc_id, score, doc in fused[:top_k*2]]
+        # Partial results from a cut retrieval are not cached
+        if deadline is not None and len(deadline.cut_stages) > cut_before:
+            print("⏱️ Retrieval was cut by the deadline; not caching partial results")
+            return results
         
-        # No reranking, just take top results from fusion
-        results = fused_docs[:top_k]
+        self.save_results(cache_key, query, results, scope, query_embedding)
+        return results
+    
+    @staticmethod
+    def remaining(deadline):
+        """Seconds left until deadline, or None (no timeout) without one"""
+        return deadline.remaining() if deadline is not None else None
+    
+    def finish_retrieval(self, accumulator, rerank_query, top_k, deadline=None):
+        """Fuse the rankings, materialize the best chunks and rerank them"""
+        with STAGE_SECONDS.time(graph="retrieval", stage="fuse"):
+            fused = accumulator.fused()
+        print(f"🔀 Fused {accumulator.rankings} rankings into {len(fused)} unique chunks")
+        
+        # Only the chunks that can make the cut are materialized
+        candidates = max(top_k, self.rerank_candidates) if self.reranker is not None else top_k
+        fused = fused[:candidates]
+        results = self.index.get_documents([chunk_id for chunk_id, score in fused])
+        for doc, (chunk_id, score) in zip(results, fused):
+            doc.metadata["fusion_score"] = score
         
+        if self.reranker is not None:
+            rerank_top_k = min(top_k, self.rerank_top_k)
+            rerank = timed_stage("retrieval", "rerank", self.reranker.rerank)
+            if deadline is not None:
+                # Past the deadline, fall back to the fusion order
+                results = deadline.run("rerank", rerank, rerank_query, results, rerank_top_k,
+                                       fallback=results[:rerank_top_k])
+            else:
+                results = rerank(rerank_query, results, rerank_top_k)
+        return results
+    
+    def save_results(self, cache_key, query, results, scope, query_embedding):
         # Save to cache
         self.save_to_cache(cache_key, results)
+        if self.semantic_cache is not None:
+            self.semantic_cache.add(query_embedding, query, results, scope)
         print("💾 Saved retrieval results to cache")
-        return results
\ No newline at end of file
+    
+    def retrieve_batch(self, queries, top_k=10, mode=None, translations=None, deadline=None):
+        """Retrieve for many queries at once; returns one document list per query.
+        
+        Each query gets what retrieve() would return: the exact and semantic
+        caches are checked first, the query and its translation are searched
+        top_k*3 deep and expansions top_k deep, and the rankings are fused
+        and reranked the same way. Identical queries are retrieved once.
+        Expansion and translation calls run concurrently; then every
+        distinct search of the batch (search query and depth, deduplicated
+        across questions) is embedded in one call and run in one pass per depth.
+        Translations and expansions still running at `deadline` are cut: the
+        query is searched without them and its results are not cached.
+        """
+        mode = resolve_mode(mode)
+        translations = translations or [None] * len(queries)
+        results = [None] * len(queries)
+        scope = f"{self.cache.fingerprint}_{top_k}_{mode}"
+        misses = {}
+        for i, query in enumerate(queries):
+            cached_data = self.load_from_cache(self.get_cache_key(query, top_k, mode))
+            if cached_data is not None:
+                results[i] = cached_data
+            else:
+                misses.setdefault(query, []).append(i)
+        # Fall back to the nearest previously retrieved query, with one embedding call for all misses
+        query_embeddings = {}
+        if misses and self.semantic_cache is not None:
+            query_embeddings = dict(zip(misses, self.index.embed_queries(list(misses))))
+            for query in list(misses):
+                cached_data = self.semantic_cache.lookup(query_embeddings[query], query, scope)
+                if cached_data is not None:
+                    for i in misses.pop(query):
+                        results[i] = cached_data
+        if not misses:
+            return results
+        print(f"🔍 Batch retrieval for {len(misses)} distinct queries ({len(queries) - sum(map(len, misses.values()))} cached)")
+        
+        # Per query, its searches as (search query, depth) in order, like ConcurrentRetrievalExecutor.run
+        searches = {query: [(query, top_k*3)] for query in misses}
+        translated = {}
+        cut = set()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.executor.max_workers)
+        try:
+            transformer = QueryTransformer()
+            expansions = {query: pool.submit(transformer.expanded_queries, query)
+                          for query in misses if self.wants_expansion(query, mode)}
+            for query, indices in misses.items():
+                translation = translations[indices[0]]
+                if translation is not None:
+                    try:
+                        translated[query] = translation.result(timeout=self.remaining(deadline))
+                        searches[query].append((translated[query], top_k*3))
+                    except concurrent.futures.TimeoutError:
+                        deadline.cut("translation")
+                        cut.add(query)
+                    except Exception as e:
+                        print(f"⚠️ Query translation failed: {str(e)}")
+            for query, future in expansions.items():
+                try:
+                    searches[query].extend((expanded_query, top_k) for expanded_query in future.result(timeout=self.remaining(deadline)))
+                except concurrent.futures.TimeoutError:
+                    deadline.cut("expand")
+                    cut.add(query)
+                except Exception as e:
+                    print(f"⚠️ Query expansion failed: {str(e)}")
+        finally:
+            # Never wait for a cut expansion; it finishes in the background
+            pool.shutdown(wait=False)
+        for query in misses:
+            # A query that was already searched, up to case and whitespace, is not searched again
+            unique = {}
+            for search_query, depth in searches[query]:
+                unique.setdefault(normalize_query(search_query), (search_query, depth))
+            searches[query] = list(unique.values())
+        
+        by_depth = {}
+        for search_query, depth in dict.fromkeys(search for searches_of in searches.values() for search in searches_of):
+            by_depth.setdefault(depth, []).append(search_query)
+        print(f"🔎 Batch search: {sum(map(len, by_depth.values()))} unique searches")
+        hits = {}
+        for depth, search_queries in by_depth.items():
+            for search_query, search_hits in zip(search_queries, self.index.hybrid_hits_batch(search_queries, depth)):
+                hits[(search_query, depth)] = search_hits
+        
+        for query, indices in misses.items():
+            accumulator = RankAccumulator()
+            for search in searches[query]:
+                accumulator.add(hits[search])
+            docs = self.finish_retrieval(accumulator, translated.get(query, query), top_k)
+            # Partial results of a cut query are not cached
+            if query not in cut:
+                self.save_results(self.get_cache_key(query, top_k, mode), query, docs, scope, query_embeddings.get(query))
+            for i in indices:
+                results[i] = docs
+        return results
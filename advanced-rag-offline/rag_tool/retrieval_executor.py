@@ -0,0 +1,99 @@
+import concurrent.futures
+import os
+from rag_tool.fusion import fuse
+from rag_tool.query_transformer import normalize_query
+from rag_tool.metrics import timed_stage
+
+class RankAccumulator:
+    """Collects rankings of (chunk_id, score) pairs as they complete, in any order"""
+
+    def __init__(self, method=None, k=None):
+        self.method = method
+        self.k = k
+        self.hits = []
+        self.weights = []
+
+    @property
+    def rankings(self):
+        return len(self.hits)
+
+    def add(self, hits, weight=1.0):
+        self.hits.append(list(hits))
+        self.weights.append(weight)
+
+    def fused(self):
+        """Deduplicated (chunk_id, score) pairs, best first"""
+        return fuse(self.hits, method=self.method, k=self.k, weights=self.weights)
+
+class ConcurrentRetrievalExecutor:
+    """Fans out the searches and query expansions of one retrieval.
+
+    The original-query search and every expansion call (including waiting
+    for a background query translation) start together.
+    As soon as an expansion returns, searches for its queries are
+    submitted; every finished search is fused immediately. At most
+    `max_workers` searches or LLM calls run at once, so the critical path
+    is one expansion call plus one round of searches.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = int(max_workers or os.getenv("RETRIEVAL_MAX_CONCURRENCY", "4"))
+
+    def run(self, query, search_fn, expansions, top_k=10, accumulator=None, deadline=None, primary=()):
+        """Search query and its expansions concurrently and return the fused accumulator.
+
+        search_fn(query, k) returns a ranked list of (chunk_id, score) pairs.
+        expansions maps a stage name to fn(query) returning a list of queries;
+        queries from `primary` stages (e.g. the translated query) are searched
+        as deeply as the original. A query that was already searched, up to
+        case and whitespace, is not searched again.
+        When the deadline passes, unfinished expansions and searches are cut
+        and only the rankings that already finished are fused. The original
+        search is always waited for, so there is at least one ranking.
+        """
+        accumulator = accumulator or RankAccumulator()
+        search_fn = timed_stage("retrieval", "search", search_fn)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        searched = {normalize_query(query)}
+        try:
+            pending = {executor.submit(search_fn, query, top_k*3): ("search", "original")}
+            for name, expand in expansions.items():
+                pending[executor.submit(timed_stage("retrieval", name, expand), query)] = ("expand", name)
+
+            while pending:
+                timeout = deadline.remaining() if deadline is not None else None
+                if deadline is not None and deadline.expired():
+                    original = [f for f, (kind, name) in pending.items() if name == "original"]
+                    for future, (kind, name) in list(pending.items()):
+                        if name != "original":
+                            future.cancel()
+                            deadline.cut(name if kind == "expand" else f"search:{name}")
+                            del pending[future]
+                    if not original:
+                        break
+                    timeout = None
+                done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, name = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # The original search is required; expansions and their searches are best effort
+                        if name == "original":
+                            raise
+                        print(f"⚠️ Retrieval stage {kind}:{name} failed: {str(e)}")
+                        continue
+                    if kind == "expand":
+                        print(f"🔀 {name} produced {len(result)} queries")
+                        depth = top_k*3 if name in primary else top_k
+                        for expanded_query in result:
+                            if normalize_query(expanded_query) in searched:
+                                continue
+                            searched.add(normalize_query(expanded_query))
+                            pending[executor.submit(search_fn, expanded_query, depth)] = ("search", name)
+                    else:
+                        accumulator.add(result)
+        finally:
+            # Abandoned calls finish in the background instead of blocking the request
+            executor.shutdown(wait=False, cancel_futures=True)
+        return accumulator
@@ -0,0 +1,113 @@
+from rag_tool.metrics import CACHE_REQUESTS
+import numpy as np
+import os
+import re
+import threading
+
+def guard_tokens(query):
+    """Tokens that must match exactly for two queries to share an answer (anything with a digit)"""
+    return frozenset(token for token in re.findall(r"\w+(?:[-./]\w+)*", query.lower()) if re.search(r"\d", token))
+
+class SemanticCache:
+    """Near-duplicate query cache over query embeddings.
+
+    Embeddings are L2-normalized into a preallocated matrix, so a lookup is
+    one matrix-vector product. A cached entry is served when its cosine
+    similarity is at least `threshold`, it has the same `scope` (e.g.
+    target language and mode), and its identifiers and numbers match, so
+    "item 7C" never answers "item 7D". Near matches rejected by that guard
+    are counted as false hits. When full, the least recently used entry is
+    evicted. Lookups are counted in the metrics under `name`.
+    """
+
+    def __init__(self, threshold=None, capacity=None, name="semantic"):
+        self.name = name
+        self.threshold = float(threshold if threshold is not None else os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+        self.capacity = int(capacity or os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+        self.matrix = None
+        self.entries = [None] * self.capacity
+        self.last_used = np.zeros(self.capacity, dtype=np.int64)
+        self.size = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.false_hits = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def lookup(self, embedding, query, scope=""):
+        """Return the cached value of the nearest matching query, or None"""
+        vector = self._normalize(embedding)
+        with self.lock:
+            self.clock += 1
+            if self.size == 0 or self.matrix.shape[1] != vector.shape[0]:
+                self.misses += 1
+                CACHE_REQUESTS.inc(namespace=self.name, result="miss")
+                return None
+            similarities = self.matrix[:self.size] @ vector
+            tokens = guard_tokens(query)
+            rejected = False
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                cached_query, cached_scope, cached_tokens, value = self.entries[i]
+                if cached_scope != scope:
+                    continue
+                if cached_tokens != tokens:
+                    rejected = True
+                    continue
+                self.last_used[i] = self.clock
+                self.hits += 1
+                CACHE_REQUESTS.inc(namespace=self.name, result="hit")
+                print(f"🧠 Semantic cache hit ({similarities[i]:.3f}): {cached_query}")
+                return value
+            if rejected:
+                self.false_hits += 1
+            self.misses += 1
+            CACHE_REQUESTS.inc(namespace=self.name, result="miss")
+            return None
+
+    def add(self, embedding, query, value, scope=""):
+        vector = self._normalize(embedding)
+        with self.lock:
+            self.clock += 1
+            if self.matrix is None or self.matrix.shape[1] != vector.shape[0]:
+                # First entry, or the embedding model changed: start over
+                self.matrix = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                self.size = 0
+            if self.size < self.capacity:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(np.argmin(self.last_used[:self.size]))
+            self.matrix[slot] = vector
+            self.entries[slot] = (query, scope, guard_tokens(query), value)
+            self.last_used[slot] = self.clock
+
+    def clear(self):
+        with self.lock:
+            self.matrix = None
+            self.entries = [None] * self.capacity
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.size,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "false_hits": self.false_hits,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+def create_semantic_cache(name="semantic"):
+    """A SemanticCache, or None when SEMANTIC_CACHE_ENABLED is 0"""
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "0":
+        return None
+    return SemanticCache(name=name)
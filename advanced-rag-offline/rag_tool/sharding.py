@@ -0,0 +1,357 @@
+from rag_tool.indexing import MultiRepresentationIndex, fuse_raptor_hits, retire_index
+from collections import OrderedDict
+from pathlib import Path
+import concurrent.futures
+import hashlib
+import heapq
+import os
+import threading
+
+# Chunk IDs whose shard is remembered from search hits, for get_documents()
+HIT_ROUTES = 65536
+
+class ShardedIndex:
+    """A set of MultiRepresentationIndex shards searched concurrently.
+
+    Chunks are partitioned by source file, either by the top-level
+    subdirectory of the documents path ("subtree") or by a hash of the
+    source path ("hash"), so all chunks of one file land in one shard.
+    Shards are built in parallel, searched in parallel, and their ranked
+    hits are heap-merged into a single top-k. Each shard can be rebuilt or
+    reloaded on its own.
+
+    `shards` is never changed in place: installing a shard swaps in a new
+    dict, so a search iterating the shards keeps a consistent set. Hits
+    remember the shard they came from, and get_documents() reads each
+    chunk ID from that shard only.
+    """
+
+    def __init__(self, data_path=None, strategy=None, num_shards=None, max_workers=None):
+        self.data_path = data_path
+        self.strategy = strategy or os.getenv("INDEX_SHARD_STRATEGY", "hash")
+        self.num_shards = int(num_shards or os.getenv("INDEX_SHARDS", "4"))
+        if self.strategy not in ("subtree", "hash"):
+            raise ValueError(f"Unknown shard strategy: {self.strategy}")
+        self.max_workers = int(max_workers or os.getenv("INDEX_SHARD_WORKERS", str(min(8, os.cpu_count() or 1))))
+        self.shards = {}
+        self.shard_keys = {}
+        self._routes = OrderedDict()
+        self._routes_lock = threading.Lock()
+        # Build progress, as in MultiRepresentationIndex
+        self.stage = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    @property
+    def raptor_index(self):
+        """The first shard RAPTOR tree, or None when RAPTOR is disabled everywhere"""
+        for shard in self.shards.values():
+            if shard.raptor_index is not None:
+                return shard.raptor_index
+        return None
+
+    @property
+    def version(self):
+        """Corpus version over all shards; changes when any shard is rebuilt"""
+        hash_input = "|".join(f"{shard_id}={self.shard_keys[shard_id]}" for shard_id in sorted(self.shard_keys))
+        if self.stage != "full":
+            hash_input += f"|{self.stage}"
+        return hashlib.md5(hash_input.encode()).hexdigest()[:12]
+
+    @property
+    def dense_ready(self):
+        return bool(self.shards) and all(shard.dense_ready for shard in self.shards.values())
+
+    def shard_for(self, source):
+        """Return the shard ID for a document source path"""
+        if self.strategy == "subtree":
+            try:
+                relative = Path(source).resolve().relative_to(Path(self.data_path).resolve())
+            except (TypeError, ValueError):
+                relative = Path(source)
+            # Files directly under the documents path share the root shard
+            return relative.parts[0] if len(relative.parts) > 1 else "_root"
+        digest = hashlib.md5(str(source).encode("utf-8")).hexdigest()
+        return f"shard_{int(digest, 16) % self.num_shards:02d}"
+
+    def partition(self, chunks):
+        """Group chunks by shard ID, preserving chunk order within a shard"""
+        partitions = {}
+        for chunk in chunks:
+            partitions.setdefault(self.shard_for(chunk.metadata.get("source", "Unknown")), []).append(chunk)
+        return partitions
+
+    def build_indexes(self, chunks, raptor_chunks):
+        self.build_sparse(chunks, raptor_chunks)
+        self.build_dense()
+        self.build_raptor()
+
+    def build_sparse(self, chunks, raptor_chunks):
+        chunk_partitions = self.partition(chunks)
+        raptor_partitions = self.partition(raptor_chunks)
+        print(f"🧱 Building {len(chunk_partitions)} index shards ({self.strategy})...")
+
+        def build_shard_sparse(shard_id, shard_chunks, shard_raptor_chunks):
+            print(f"🧱 Building shard {shard_id} with {len(shard_chunks)} chunks")
+            shard = MultiRepresentationIndex()
+            shard.build_sparse(shard_chunks, shard_raptor_chunks)
+            return shard
+
+        futures = {
+            self._executor.submit(build_shard_sparse, shard_id, shard_chunks, raptor_partitions.get(shard_id, [])): shard_id
+            for shard_id, shard_chunks in chunk_partitions.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            shard_id = futures[future]
+            # Propagate the first shard failure, like the single index does
+            self._install_shard(shard_id, future.result())
+        self.stage = "sparse"
+
+    def build_dense(self):
+        self._each_shard("build_dense")
+        self.stage = "dense"
+
+    def build_raptor(self):
+        self._each_shard("build_raptor")
+        self.stage = "full"
+        print(f"✅ Built {len(self.shards)} index shards")
+
+    def _each_shard(self, method):
+        """Run a build step on all shards in parallel, propagating the first failure"""
+        futures = [self._executor.submit(getattr(shard, method)) for shard in self.shards.values()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    def _build_shard(self, shard_id, chunks, raptor_chunks):
+        print(f"🧱 Building shard {shard_id} with {len(chunks)} chunks")
+        shard = MultiRepresentationIndex()
+        shard.build_indexes(chunks, raptor_chunks)
+        return shard
+
+    def _install_shard(self, shard_id, shard):
+        # Swap the reference first; searches that already picked the replaced
+        # shard keep reading it until it is retired
+        previous = self.shards.get(shard_id)
+        self.shards = {**self.shards, shard_id: shard}
+        self.shard_keys = {**self.shard_keys, shard_id: shard.cache_key}
+        if previous is not None and previous is not shard:
+            retire_index(previous, shard)
+
+    def copy(self):
+        """A new ShardedIndex over copies of the shards (see MultiRepresentationIndex.copy)"""
+        index = ShardedIndex(self.data_path, strategy=self.strategy, num_shards=self.num_shards,
+                             max_workers=self.max_workers)
+        for shard_id, shard in self.shards.items():
+            index._install_shard(shard_id, shard.copy())
+        index.stage = self.stage
+        return index
+
+    def successor(self, step):
+        """A copy() with one build step run on all shards; this index keeps serving meanwhile,
+        so searches never see some shards advanced and others not"""
+        index = self.copy()
+        try:
+            getattr(index, step)()
+        except Exception:
+            index._executor.shutdown(wait=False)
+            raise
+        return index
+
+    def rebuild_shard(self, shard_id, chunks, raptor_chunks=None):
+        """Rebuild one shard from its chunks and swap it in"""
+        self._install_shard(shard_id, self._build_shard(shard_id, chunks, raptor_chunks or []))
+
+    def reload_shard(self, shard_id):
+        """Reopen one shard from its cached artifacts on disk"""
+        if shard_id not in self.shard_keys:
+            raise KeyError(f"Unknown shard: {shard_id}")
+        shard = MultiRepresentationIndex()
+        if not shard.load_indexes(self.shard_keys[shard_id]):
+            raise RuntimeError(f"No cached index found for shard {shard_id}")
+        self._install_shard(shard_id, shard)
+
+    def load_indexes(self, shard_keys, stage="full"):
+        """Open all shards from their cached artifacts in parallel, at build stage `stage`"""
+        def load_shard(shard_id, cache_key):
+            shard = MultiRepresentationIndex()
+            if not shard.load_indexes(cache_key, stage):
+                raise RuntimeError(f"No cached index found for shard {shard_id}")
+            return shard
+
+        futures = {
+            self._executor.submit(load_shard, shard_id, cache_key): shard_id
+            for shard_id, cache_key in shard_keys.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            self._install_shard(futures[future], future.result())
+        self.stage = stage
+
+    def snapshot(self):
+        """Descriptor other processes use to open these shards read-only (see rag_tool.snapshot)"""
+        return {
+            "type": "sharded",
+            "strategy": self.strategy,
+            "num_shards": self.num_shards,
+            "shard_keys": dict(self.shard_keys),
+            "stage": self.stage
+        }
+
+    def updated(self, changed_sources, new_chunks):
+        """A new ShardedIndex with the chunks of `changed_sources` replaced by `new_chunks`.
+
+        Only the shards those files belong to are rebuilt (see
+        MultiRepresentationIndex.updated); the others are shared with this
+        index, which keeps serving until the caller swaps it out. Shards
+        left without chunks are dropped. Returns None when no shard is left.
+        """
+        successor = ShardedIndex(self.data_path, strategy=self.strategy, num_shards=self.num_shards,
+                                 max_workers=self.max_workers)
+        affected = {self.shard_for(source) for source in changed_sources}
+        new_partitions = self.partition(new_chunks)
+        affected.update(new_partitions)
+
+        def update_shard(shard_id):
+            shard_chunks = new_partitions.get(shard_id, [])
+            if shard_id not in self.shards:
+                return self._build_shard(shard_id, shard_chunks, []) if shard_chunks else None
+            print(f"🧱 Updating shard {shard_id}")
+            return self.shards[shard_id].updated(changed_sources, shard_chunks)
+
+        futures = {successor._executor.submit(update_shard, shard_id): shard_id for shard_id in affected}
+        for shard_id, shard in self.shards.items():
+            if shard_id not in affected:
+                successor._install_shard(shard_id, shard)
+        for future in concurrent.futures.as_completed(futures):
+            shard = future.result()
+            if shard is not None:
+                successor._install_shard(futures[future], shard)
+        if not successor.shards:
+            successor.close()
+            return None
+        successor.stage = "full"
+        print(f"✅ Updated {len(affected)} of {len(successor.shards)} index shards")
+        return successor
+
+    def release(self, successor=None):
+        """Unmap the shards of a replaced index, except what `successor` still uses"""
+        successors = successor.shards if successor is not None else {}
+        for shard_id, shard in self.shards.items():
+            if successors.get(shard_id) is not shard:
+                shard.release(successors.get(shard_id))
+        self._executor.shutdown(wait=False)
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+        self._executor.shutdown(wait=False)
+
+    def embed_query(self, query):
+        shard = next(iter(self.shards.values()))
+        return shard.embed_query(query)
+
+    def chunk_embeddings(self, chunk_ids):
+        embeddings = {}
+        for shard in self.shards.values():
+            embeddings.update(shard.chunk_embeddings(chunk_ids))
+        return embeddings
+
+    def search(self, query, top_k=10):
+        """Search all shards concurrently and heap-merge the top_k hits"""
+        if not self.shards:
+            raise ValueError("No index shards built in search()")
+        return self.search_by_vector(self.embed_query(query), top_k)
+
+    def search_by_vector(self, embedding, top_k=10):
+        return self._merge_shard_hits("search_by_vector", embedding, top_k)
+
+    def raptor_search(self, embedding, top_k=10, beam=3):
+        return self._merge_shard_hits("raptor_search", embedding, top_k, beam)
+
+    def search_by_vectors(self, embeddings, top_k=10):
+        shards = self.shards
+        futures = {shard_id: self._executor.submit(shard.search_by_vectors, embeddings, top_k)
+                   for shard_id, shard in shards.items()}
+        per_shard = {shard_id: future.result() for shard_id, future in futures.items()}
+        return [self._merge_hits({shard_id: hits[i] for shard_id, hits in per_shard.items()}, top_k)
+                for i in range(len(embeddings))]
+
+    def embed_queries(self, queries):
+        shard = next(iter(self.shards.values()))
+        return shard.embed_queries(queries)
+
+    def _merge_shard_hits(self, method, embedding, top_k, *args):
+        futures = {shard_id: self._executor.submit(getattr(shard, method), embedding, top_k, *args)
+                   for shard_id, shard in self.shards.items()}
+        return self._merge_hits({shard_id: future.result() for shard_id, future in futures.items()}, top_k)
+
+    def _merge_hits(self, shard_hits, top_k):
+        """Merge {shard_id: hits} into one top_k, remembering the shard of each hit"""
+        # Each shard returns hits best-first, so a k-way heap merge gives the global order
+        tagged = [[(chunk_id, score, shard_id) for chunk_id, score in hits] for shard_id, hits in shard_hits.items()]
+        merged = heapq.merge(*tagged, key=lambda hit: hit[1], reverse=True)
+        results = []
+        routes = {}
+        for chunk_id, score, shard_id in merged:
+            if chunk_id in routes:
+                continue
+            routes[chunk_id] = shard_id
+            results.append((chunk_id, score))
+            if len(results) == top_k:
+                break
+        with self._routes_lock:
+            self._routes.update(routes)
+            for chunk_id in routes:
+                self._routes.move_to_end(chunk_id)
+            while len(self._routes) > HIT_ROUTES:
+                self._routes.popitem(last=False)
+        return results
+
+    def get_documents(self, chunk_ids):
+        """Materialize Documents for chunk IDs, reading each from the shard its hit came from.
+
+        IDs without a remembered shard, or no longer in it after a shard
+        was rebuilt, are looked up in each shard's chunk store index.
+        """
+        shards = self.shards
+        with self._routes_lock:
+            routes = {chunk_id: self._routes.get(chunk_id) for chunk_id in chunk_ids}
+        documents = []
+        for chunk_id in chunk_ids:
+            shard = shards.get(routes[chunk_id])
+            if shard is None or chunk_id not in shard.chunk_store:
+                shard = next((shard for shard in shards.values() if chunk_id in shard.chunk_store), None)
+            if shard is not None:
+                documents.extend(shard.get_documents([chunk_id]))
+        return documents
+
+    def sparse_search(self, query, top_k=10):
+        # BM25 scores of different shards use per-shard IDF, so the merge is approximate
+        futures = {shard_id: self._executor.submit(shard.sparse_search, query, top_k)
+                   for shard_id, shard in self.shards.items()}
+        return self._merge_hits({shard_id: future.result() for shard_id, future in futures.items()}, top_k)
+
+    def hybrid_hits(self, query, top_k=10):
+        if not self.dense_ready:
+            print(f"🔎 Sparse-only search over {len(self.shards)} shards (dense index not built yet)")
+            return self.sparse_search(query, top_k*2)
+        print(f"🔎 Sharded hybrid search over {len(self.shards)} shards")
+        query_embedding = self.embed_query(query)
+        hits = self.search_by_vector(query_embedding, top_k*2)
+        if self.raptor_index is not None:
+            hits = fuse_raptor_hits(hits, self.raptor_search(query_embedding, top_k*2, int(os.getenv("RAPTOR_BEAM", "3"))))
+        return hits[:top_k*3]
+
+    def hybrid_hits_batch(self, queries, top_k=10):
+        if not self.dense_ready:
+            return [self.sparse_search(query, top_k*2) for query in queries]
+        embeddings = self.embed_queries(queries)
+        beam = int(os.getenv("RAPTOR_BEAM", "3"))
+        results = []
+        for embedding, hits in zip(embeddings, self.search_by_vectors(embeddings, top_k*2)):
+            if self.raptor_index is not None:
+                hits = fuse_raptor_hits(hits, self.raptor_search(embedding, top_k*2, beam))
+            results.append(hits[:top_k*3])
+        return results
+
+    def hybrid_search(self, query, top_k=10):
+        return self.get_documents([chunk_id for chunk_id, score in self.hybrid_hits(query, top_k)])
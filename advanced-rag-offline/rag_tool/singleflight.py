@@ -0,0 +1,153 @@
+import asyncio
+import concurrent.futures
+import threading
+
+class _Flight:
+    """One in-flight computation; `future` lands with its result or error"""
+
+    def __init__(self, broadcast=None):
+        self.future = concurrent.futures.Future()
+        self.task = None
+        # Events as they are produced, when the leader is a stream
+        self.broadcast = broadcast
+
+class _Broadcast:
+    """Events of one stream, replayed to every subscriber from the start"""
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def subscribe(self):
+        position = 0
+        while True:
+            with self.condition:
+                while position >= len(self.events) and not self.finished:
+                    self.condition.wait()
+                pending = self.events[position:]
+                position = len(self.events)
+                finished, error = self.finished, self.error
+            yield from pending
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one computation.
+
+    do()      blocking calls; followers wait for the leader's result or error
+    ado()     coroutines; the computation runs as its own task, so a
+              cancelled (disconnected) caller does not cancel the others
+    stream()  generators; one producer thread, every subscriber gets all events
+
+    All three share one table of flights, so callers of any form coalesce:
+    a blocking caller can wait for an async leader, and the reverse. A
+    blocking or async caller that joins a stream gets result_of(events)
+    once the stream finishes. A stream that joins a blocking or async
+    computation yields events_of(result) once it lands. Both converters
+    are passed to stream().
+
+    Only calls that overlap in time are coalesced; results are not kept
+    afterwards (that is what the caches are for).
+    """
+
+    def __init__(self, name="request"):
+        self.name = name
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def _join(self, key, broadcast=None):
+        """The flight for key and whether the caller leads it (must compute and land it)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                print(f"🔗 Joining in-flight {self.name} {key[:12]}")
+                return flight, False
+            flight = self.flights[key] = _Flight(broadcast)
+            return flight, True
+
+    def _land(self, key, flight, result=None, error=None):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+
+    def do(self, key, fn, *args):
+        flight, leader = self._join(key)
+        if not leader:
+            return flight.future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, result)
+        return result
+
+    async def ado(self, key, fn, *args):
+        flight, leader = self._join(key)
+        if leader:
+            flight.task = asyncio.ensure_future(fn(*args))
+            flight.task.add_done_callback(lambda finished: self._task_done(key, flight, finished))
+        # Shielded, so a cancelled caller does not cancel the computation others wait for
+        return await asyncio.shield(asyncio.wrap_future(flight.future))
+
+    def _task_done(self, key, flight, task):
+        if task.cancelled():
+            self._land(key, flight, error=concurrent.futures.CancelledError())
+        else:
+            self._land(key, flight, task.result() if task.exception() is None else None, task.exception())
+
+    def stream(self, key, generator_fn, *args, result_of=list, events_of=None):
+        """Events of generator_fn(*args), shared with every concurrent caller of key.
+
+        result_of(events) is the result blocking and async callers get from
+        this stream; events_of(result) turns the result of a blocking or
+        async leader into this caller's events.
+        """
+        flight, leader = self._join(key, _Broadcast())
+        if leader:
+            threading.Thread(target=self._pump, args=(key, flight, result_of, generator_fn, args), daemon=True).start()
+        if flight.broadcast is not None:
+            return flight.broadcast.subscribe()
+        if events_of is None:
+            raise ValueError(f"stream() needs events_of to join the computation of {key[:12]}")
+        return self._result_events(flight, events_of)
+
+    @staticmethod
+    def _result_events(flight, events_of):
+        yield from events_of(flight.future.result())
+
+    def _pump(self, key, flight, result_of, generator_fn, args):
+        # Keeps producing even if the subscriber that started it disconnects
+        error = None
+        try:
+            for event in generator_fn(*args):
+                flight.broadcast.publish(event)
+        except Exception as e:
+            error = e
+        result = None
+        if error is None:
+            try:
+                result = result_of(flight.broadcast.events)
+            except Exception as e:
+                error = e
+        flight.broadcast.finish(error)
+        self._land(key, flight, result, error)
@@ -0,0 +1,99 @@
+from rag_tool.cache import config_fingerprint
+from rag_tool.indexing import MultiRepresentationIndex
+from rag_tool.sharding import ShardedIndex
+from filelock import FileLock, Timeout
+import hashlib
+import json
+import os
+import time
+
+# Cache directory
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+def snapshot_key(files, language):
+    """Identifies an index build without loading the documents: the scanned document files
+    (path: mtime, from scan_documents), the embedding model and the index layout.
+
+    Callers pass the same scan they decide what to index from, so a file
+    changing in between cannot publish an index under a key it does not match.
+    """
+    documents = hashlib.md5(json.dumps(sorted(files.items())).encode()).hexdigest()
+    return config_fingerprint(
+        documents=documents,
+        language=language,
+        embedding=os.getenv("EMBEDDING_MODEL", "jeffh/intfloat-multilingual-e5-large:q8_0"),
+        shards=os.getenv("INDEX_SHARDS", ""),
+        shard_strategy=os.getenv("INDEX_SHARD_STRATEGY", ""),
+        raptor=os.getenv("RAPTOR_ENABLED", "1"),
+        raptor_branching=os.getenv("RAPTOR_BRANCHING", "10")
+    )
+
+def open_index(descriptor, data_path=None):
+    """Open a published index read-only from its snapshot descriptor, at the build stage it was published at"""
+    stage = descriptor.get("stage", "full")
+    if descriptor["type"] == "sharded":
+        index = ShardedIndex(data_path, strategy=descriptor["strategy"], num_shards=descriptor["num_shards"])
+        index.load_indexes(descriptor["shard_keys"], stage)
+        return index
+    index = MultiRepresentationIndex()
+    if not index.load_indexes(descriptor["cache_key"], stage):
+        raise RuntimeError(f"Index artifacts for {descriptor['cache_key']} are missing")
+    return index
+
+class IndexSnapshot:
+    """A finished index build shared by every API worker process.
+
+    The builder holds an inter-process file lock while it builds, then
+    publishes a small manifest naming the index artifacts (chunk store,
+    dense matrix and RAPTOR tree, all keyed by content). Other workers
+    wait on the lock instead of building the same index again, and then
+    open the published artifacts; all three are memory-mapped read-only,
+    so their pages are shared between processes.
+
+    The builder publishes the snapshot as soon as the BM25 stage is built,
+    releases the build lock and finishes the dense index and RAPTOR tree
+    as the snapshot's owner (own()); the other workers serve the unfinished
+    snapshot meanwhile. Ownership is a second file lock, held across build
+    retries and released by the OS if the owner exits, so exactly one live
+    process finishes a build.
+    """
+
+    def __init__(self, key, cache_dir=None):
+        self.key = key
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.manifest_path = os.path.join(self.cache_dir, f"snapshot_{key}.json")
+        self.lock = FileLock(os.path.join(self.cache_dir, "index_build.lock"))
+        # Acquired and released by different threads (the build, then a retry timer)
+        self.owner_lock = FileLock(os.path.join(self.cache_dir, f"snapshot_{key}.owner.lock"), thread_local=False)
+
+    def own(self):
+        """Become the process that finishes this snapshot's build; False while another live process is"""
+        try:
+            self.owner_lock.acquire(timeout=0)
+        except Timeout:
+            return False
+        return True
+
+    def disown(self):
+        if self.owner_lock.is_locked:
+            self.owner_lock.release(force=True)
+
+    def read(self):
+        """The published index descriptor, or None"""
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)["index"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable index snapshot {self.key}: {str(e)}")
+            return None
+
+    def publish(self, descriptor):
+        manifest = {"key": self.key, "created_at": time.time(), "builder_pid": os.getpid(), "index": descriptor}
+        tmp_file = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self.manifest_path)
+        print(f"📸 Published index snapshot {self.key}")
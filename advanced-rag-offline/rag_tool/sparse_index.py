@@ -0,0 +1,26 @@
+from rag_tool.reranking import LexicalReranker
+from rank_bm25 import BM25Okapi
+import numpy as np
+
+class SparseIndex:
+    """In-memory BM25 index over the chunk store.
+
+    Built in seconds from the chunk texts, so queries can be answered while
+    the dense index is still being embedded. Returns (chunk_id, score)
+    hits like the dense searches; chunks sharing no term with the query are
+    left out.
+    """
+
+    def __init__(self, chunk_store):
+        self.chunk_ids = [chunk_store.chunk_id(row) for row in range(len(chunk_store))]
+        self.bm25 = BM25Okapi([LexicalReranker.tokenize(text) or [""] for text in chunk_store.iter_texts()])
+
+    def search(self, query, top_k=10):
+        tokens = LexicalReranker.tokenize(query)
+        if not tokens or not self.chunk_ids:
+            return []
+        scores = np.asarray(self.bm25.get_scores(tokens))
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.lexsort((best, -scores[best]))]
+        return [(self.chunk_ids[row], float(scores[row])) for row in best if scores[row] > 0]
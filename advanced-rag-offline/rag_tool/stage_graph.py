@@ -0,0 +1,181 @@
+from rag_tool.metrics import STAGE_SECONDS
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+class Stage:
+    def __init__(self, name, fn, after=(), when=None, afn=None):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.when = when
+        self.afn = afn
+
+class StageGraph:
+    """A small DAG of pipeline stages; independent stages run concurrently.
+
+    A stage is fn(context) -> value. The context holds the run inputs and
+    the value of every finished stage under its name. A stage starts as
+    soon as all stages in `after` are done. Stages named in `skip`, or
+    whose when(context) is false, do not run and leave None in the context;
+    stages after them still run. Stages can only depend on stages added
+    before them, so the graph is acyclic by construction.
+
+    run() executes stages in worker threads. arun() awaits a stage's async
+    `afn` when it has one and runs the others in `executor` (the event
+    loop's default executor when None). run() calls on_stage(name, context)
+    as each stage finishes or is skipped, before the stages after it start,
+    so a caller can report partial results while the graph runs. Wall
+    and CPU time (thread CPU time; None for awaited stages) are returned per
+    stage, accumulated for stats() and observed in the stage latency
+    histogram of the metrics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, fn, after=(), when=None, afn=None):
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        unknown = [dependency for dependency in after if dependency not in self.stages]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages: {unknown}")
+        self.stages[name] = Stage(name, fn, after, when, afn)
+        return self
+
+    def _start_ready(self, pending, done, context, skip, timings, on_stage=None):
+        """Pop the stages whose dependencies are done; skipped ones complete immediately"""
+        ready = []
+        progressed = True
+        while progressed:
+            progressed = False
+            for name, stage in list(pending.items()):
+                if not all(dependency in done for dependency in stage.after):
+                    continue
+                del pending[name]
+                if name in skip or (stage.when is not None and not stage.when(context)):
+                    context[name] = None
+                    done.add(name)
+                    timings[name] = {"skipped": True}
+                    if on_stage is not None:
+                        on_stage(name, context)
+                    progressed = True
+                else:
+                    ready.append(stage)
+        return ready
+
+    @staticmethod
+    def _timed(stage, context, started):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        value = stage.fn(context)
+        return value, {
+            "start": round(wall_start - started, 4),
+            "wall": round(time.perf_counter() - wall_start, 4),
+            "cpu": round(time.thread_time() - cpu_start, 4)
+        }
+
+    @staticmethod
+    async def _atimed(stage, context, started):
+        wall_start = time.perf_counter()
+        value = await stage.afn(context)
+        return value, {
+            "start": round(wall_start - started, 4),
+            "wall": round(time.perf_counter() - wall_start, 4),
+            "cpu": None
+        }
+
+    def _check_skip(self, skip):
+        unknown = set(skip) - set(self.stages)
+        if unknown:
+            raise ValueError(f"Cannot skip unknown stages: {sorted(unknown)}")
+        return set(skip)
+
+    def run(self, inputs, skip=(), on_stage=None):
+        """Run the graph; returns (context, timings)"""
+        skip = self._check_skip(skip)
+        context = dict(inputs)
+        timings = {}
+        pending = dict(self.stages)
+        done = set()
+        running = {}
+        started = time.perf_counter()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.stages)),
+                                                     thread_name_prefix=f"{self.name}-stage")
+        try:
+            while True:
+                for stage in self._start_ready(pending, done, context, skip, timings, on_stage):
+                    running[pool.submit(self._timed, stage, context, started)] = stage.name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    context[name], timings[name] = future.result()
+                    done.add(name)
+                    if on_stage is not None:
+                        on_stage(name, context)
+        finally:
+            # On a failure, do not wait for stages that are still running
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.record(timings, time.perf_counter() - started)
+        return context, timings
+
+    async def arun(self, inputs, skip=(), executor=None):
+        """Async run(); returns (context, timings)"""
+        skip = self._check_skip(skip)
+        context = dict(inputs)
+        timings = {}
+        pending = dict(self.stages)
+        done = set()
+        running = {}
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                for stage in self._start_ready(pending, done, context, skip, timings):
+                    if stage.afn is not None:
+                        task = asyncio.ensure_future(self._atimed(stage, context, started))
+                    else:
+                        task = loop.run_in_executor(executor, self._timed, stage, context, started)
+                    running[task] = stage.name
+                if not running:
+                    break
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    name = running.pop(task)
+                    context[name], timings[name] = task.result()
+                    done.add(name)
+        finally:
+            for task in running:
+                task.cancel()
+        self.record(timings, time.perf_counter() - started)
+        return context, timings
+
+    def record(self, timings, total):
+        ran = {name: timing for name, timing in timings.items() if not timing.get("skipped")}
+        print(f"⏱️ {self.name} stages in {total:.3f}s: " +
+              ", ".join(f"{name} {timing['wall']:.3f}s" for name, timing in ran.items()))
+        with self.lock:
+            for name, timing in ran.items():
+                STAGE_SECONDS.observe(timing["wall"], graph=self.name, stage=name)
+                totals = self.totals.setdefault(name, {"runs": 0, "wall": 0.0, "cpu": 0.0})
+                totals["runs"] += 1
+                totals["wall"] += timing["wall"]
+                totals["cpu"] += timing["cpu"] or 0.0
+
+    def stats(self):
+        """Runs and mean wall/CPU seconds per stage since startup"""
+        with self.lock:
+            return {
+                name: {
+                    "runs": totals["runs"],
+                    "mean_wall": round(totals["wall"] / totals["runs"], 4),
+                    "mean_cpu": round(totals["cpu"] / totals["runs"], 4)
+                }
+                for name, totals in self.totals.items()
+            }
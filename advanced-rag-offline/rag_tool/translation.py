@@ -1,6 +1,8 @@
 from langchain_ollama import OllamaLLM
 from langchain_ollama.embeddings import OllamaEmbeddings
-import langid
+from rag_tool.model_options import model_options
+from rag_tool.metrics import model_call
+from langid.langid import LanguageIdentifier, model as langid_model
 
 class OfflineTranslationSystem:
     def __init__(self):
@@ -10,8 +12,11 @@ class OfflineTranslationSystem:
         print(f"Using Ollama base URL for translator: {ollama_base_url}")
         translator_model = os.getenv("TRANSLATOR_MODEL", "mistral-nemo:latest")
         print(f"Using translator model: {translator_model}")
-        self.translator = OllamaLLM(model=translator_model, base_url=ollama_base_url)
-        self.detector = langid
+        self.translator = OllamaLLM(model=translator_model, base_url=ollama_base_url,
+                                    **model_options(translator_model, defaults=False))
+        # Load the language identifier model now; langid loads it lazily on first use,
+        # and concurrent first requests would each decompress it
+        self.detector = LanguageIdentifier.from_modelstring(langid_model)
         self.supported_languages = {
             "en": "English",
             "es": "Spanish",
@@ -28,8 +33,8 @@ class OfflineTranslationSystem:
         lang, _ = self.detector.classify(text)
         return lang
     
-    def translate(self, text, target_lang):
-        prompt = f"""
+    def translation_prompt(self, text, target_lang):
+        return f"""
         <|im_start|>system
         You are a professional translator. Rules:
         1. Translate exactly without adding/removing content
@@ -43,7 +48,16 @@ class OfflineTranslationSystem:
         <|im_end|>
         <|im_start|>assistant
         """
-        return self.translator.invoke(prompt).strip()
+    
+    def translate(self, text, target_lang):
+        with model_call(self.translator, "translate"):
+            return self.translator.invoke(self.translation_prompt(text, target_lang)).strip()
+    
+    async def atranslate(self, text, target_lang):
+        """Async translate(); awaits the model without holding a thread"""
+        with model_call(self.translator, "translate"):
+            response = await self.translator.ainvoke(self.translation_prompt(text, target_lang))
+        return response.strip()
     
     def translate_query(self, query, doc_language):
         q_lang = self.detect_language(query)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import time
+
+# Names the published version inside a versioned directory
+POINTER = "CURRENT"
+
+def current_version(directory):
+    """The directory holding the files of the published version.
+
+    Directories written before versioning hold their files directly and
+    are returned as they are.
+    """
+    try:
+        with open(os.path.join(directory, POINTER), "r", encoding="utf-8") as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return directory
+
+def new_version(directory):
+    """Create an empty directory for the next version; nothing reads it until publish_version()"""
+    # Names sort by creation time, which publish_version() relies on to prune
+    path = os.path.join(directory, f"v{time.time_ns()}_{os.getpid()}")
+    os.makedirs(path)
+    return path
+
+def publish_version(directory, version_dir):
+    """Point `directory` at a finished version in one rename.
+
+    Readers opening the directory see either the old or the new version,
+    never a missing or partial one, and readers that already opened the
+    old version keep their files. Versions older than the replaced one
+    are deleted; the replaced one stays for readers that resolved the
+    pointer just before the swap.
+    """
+    replaced = current_version(directory)
+    previous = os.path.basename(replaced) if replaced != directory else None
+    tmp_file = os.path.join(directory, f"{POINTER}.{os.getpid()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(version_dir))
+    os.replace(tmp_file, os.path.join(directory, POINTER))
+    if previous is None:
+        return
+    for name in os.listdir(directory):
+        if name.startswith("v") and name < previous and os.path.isdir(os.path.join(directory, name)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
@@ -4,6 +4,7 @@
 DEFAULT_DOCS_PATH="/app/documents"
 DEFAULT_DOCS_LANG="en"
 DEFAULT_PORT=8000
+DEFAULT_API_WORKERS=1
 DEFAULT_GENERATOR_MODEL="llama3:8b"
 DEFAULT_QUERY_TRANSFORMER_MODEL="llama3:8b"
 DEFAULT_TRANSLATOR_MODEL="mistral-nemo:12b"
@@ -13,6 +14,7 @@ DEFAULT_EMBEDDING_MODEL="jeffh/intfloat-multilingual-e5-large-instruct:Q8_0"
 DOCS_PATH="${DOCS_PATH:-${1:-$DEFAULT_DOCS_PATH}}"
 DOCS_LANG="${DOCS_LANG:-${2:-$DEFAULT_DOCS_LANG}}"
 PORT="${PORT:-${3:-$DEFAULT_PORT}}"
+API_WORKERS="${API_WORKERS:-$DEFAULT_API_WORKERS}"
 GENERATOR_MODEL="${GENERATOR_MODEL:-$DEFAULT_GENERATOR_MODEL}"
 QUERY_TRANSFORMER_MODEL="${QUERY_TRANSFORMER_MODEL:-$DEFAULT_QUERY_TRANSFORMER_MODEL}"
 TRANSLATOR_MODEL="${TRANSLATOR_MODEL:-$DEFAULT_TRANSLATOR_MODEL}"
@@ -28,6 +30,7 @@ fi
 echo "🚀 Starting RAG API on port $PORT"
 echo "📁 Document path: $DOCS_PATH"
 echo "🌐 Document language: $DOCS_LANG"
+echo "👷 API workers: $API_WORKERS"
 echo "🔒 Privacy: All processing offline"
 echo "🔤 Translation: Enabled ($TRANSLATOR_MODEL model)"
 echo "🧠 Generator model: $GENERATOR_MODEL"
@@ -81,4 +84,4 @@ fi
 
 # Start the API
 echo "🚀 Starting the RAG API server..."
-uvicorn web_api:app --host 0.0.0.0 --port $PORT --env-file <(env | grep -E 'DOCS_PATH|DOCS_LANG|OLLAMA_BASE_URL|GENERATOR_MODEL|QUERY_TRANSFORMER_MODEL|TRANSLATOR_MODEL|EMBEDDING_MODEL') 2>&1 | tee rag_api.log
\ No newline at end of file
+uvicorn web_api:app --host 0.0.0.0 --port $PORT --workers $API_WORKERS --env-file <(env | grep -E 'DOCS_PATH|DOCS_LANG|OLLAMA_BASE_URL|GENERATOR_MODEL|QUERY_TRANSFORMER_MODEL|TRANSLATOR_MODEL|EMBEDDING_MODEL') 2>&1 | tee rag_api.log
\ No newline at end of file
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Tests for the resumable, checkpointed dense index build
+"""
+
+import os
+import pytest
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rag_tool import indexing
+from rag_tool.bulk_build import DenseIndexBuilder
+from rag_tool.chunk_store import ChunkStore
+from rag_tool.indexing import MultiRepresentationIndex
+
+class CrashingBuilder(DenseIndexBuilder):
+    """Builder that dies after committing a fixed number of batches"""
+    def __init__(self, *args, crash_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crash_after = crash_after
+        self.batches = 0
+
+    def _add_batch(self, vectorstore, texts, metadatas, ids, max_retries=3, base_delay=5):
+        if self.crash_after is not None and self.batches == self.crash_after:
+            raise RuntimeError("simulated crash")
+        self.batches += 1
+        super()._add_batch(vectorstore, texts, metadatas, ids, max_retries, base_delay)
+
+def make_store(tmp_path, n=25):
+    chunks = [Document(page_content=f"chunk {i}", metadata={"source": "a.pdf", "start_index": i}) for i in range(n)]
+    return ChunkStore.build(chunks, str(tmp_path / "store"))
+
+def test_build_resumes_after_crash(tmp_path):
+    store = make_store(tmp_path)
+    persist_dir = str(tmp_path / "dense")
+    embeddings = DeterministicFakeEmbedding(size=8)
+
+    first = CrashingBuilder(store, embeddings, persist_dir, batch_size=10, crash_after=2)
+    with pytest.raises(RuntimeError):
+        first.build()
+    assert first.read_checkpoint() == {"committed": 20, "total": 25, "complete": False}
+    assert not first.is_complete()
+
+    second = CrashingBuilder(store, embeddings, persist_dir, batch_size=10)
+    index = second.build()
+    # Only the last, uncommitted batch is embedded again
+    assert second.batches == 1
+    assert second.is_complete()
+    assert index._collection.count() == 25
+    store.close()
+
+def test_completed_build_is_reopened(tmp_path):
+    store = make_store(tmp_path, n=5)
+    persist_dir = str(tmp_path / "dense")
+    DenseIndexBuilder(store, DeterministicFakeEmbedding(size=8), persist_dir, batch_size=2).build()
+
+    again = CrashingBuilder(store, DeterministicFakeEmbedding(size=8), persist_dir, batch_size=2)
+    again.build()
+    assert again.batches == 0
+    store.close()
+
+def test_known_embeddings_are_not_recomputed(tmp_path):
+    store = make_store(tmp_path, n=6)
+    embeddings = DeterministicFakeEmbedding(size=8)
+    known = {store.chunk_id(row): embeddings.embed_query(store.text(row)) for row in range(4)}
+
+    builder = CrashingBuilder(store, embeddings, str(tmp_path / "dense"), batch_size=3,
+                              known_embeddings=lambda ids: {i: known[i] for i in ids if i in known})
+    index = builder.build()
+    # The first batch is fully known; the second embeds only its last two chunks
+    assert builder.batches == 1
+    assert builder.reused == 4
+    assert index._collection.count() == 6
+    stored = index._collection.get(ids=[store.chunk_id(0)], include=["embeddings", "documents"])
+    assert list(stored["embeddings"][0]) == pytest.approx(known[store.chunk_id(0)])
+    assert stored["documents"] == [store.text(0)]
+    store.close()
+
+def test_empty_persist_dir_is_not_a_finished_build(tmp_path):
+    store = make_store(tmp_path, n=5)
+    persist_dir = tmp_path / "dense"
+    # A build that crashed right after creating its directory
+    persist_dir.mkdir()
+    builder = CrashingBuilder(store, DeterministicFakeEmbedding(size=8), str(persist_dir), batch_size=2)
+    assert not builder.is_complete()
+    builder.build()
+    assert builder.batches == 3
+    assert builder.is_complete() and "legacy" not in builder.read_checkpoint()
+    store.close()
+
+class QueryOnlyEmbeddings(DeterministicFakeEmbedding):
+    def embed_documents(self, texts):
+        raise AssertionError("Chunks embedded again")
+
+def test_legacy_dense_dir_is_exported_without_embedding(make_chunks, tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: QueryOnlyEmbeddings(size=8))
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    embeddings = DeterministicFakeEmbedding(size=8)
+    index = MultiRepresentationIndex()
+    index.build_sparse(make_chunks(), [])
+    # Older releases wrote the Chroma index to cache/dense_<key> with random IDs and no checkpoint
+    sanitized_key = index.cache_key.replace(":", "_").replace("/", "-")[:50]
+    Chroma.from_documents(make_chunks(), embeddings, collection_name="dense_index",
+                          persist_directory=str(tmp_path / f"dense_{sanitized_key}"))
+    index.build_dense()
+    chunk_id, score = index.search_by_vector(embeddings.embed_query(make_chunks()[2].page_content), top_k=1)[0]
+    assert index.get_documents([chunk_id])[0].page_content == make_chunks()[2].page_content
+    assert not os.path.exists(tmp_path / f"chroma_dense_{sanitized_key}")
+    index.release()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for the versioned answer/retrieval cache
+"""
+
+import os
+from rag_tool.cache import VersionedCache, config_fingerprint
+
+def test_memory_tier_serves_without_disk(tmp_path):
+    cache = VersionedCache("query", "v1", cache_dir=str(tmp_path))
+    cache.save("k", {"answer": 1})
+    os.remove(cache.path("k"))
+    assert cache.load("k") == {"answer": 1}
+
+def test_disk_tier_survives_restart(tmp_path):
+    VersionedCache("query", "v1", cache_dir=str(tmp_path)).save("k", "answer")
+    assert VersionedCache("query", "v1", cache_dir=str(tmp_path)).load("k") == "answer"
+
+def test_new_fingerprint_misses_and_collects_replaced_entries(tmp_path):
+    old = VersionedCache("query", "v1", cache_dir=str(tmp_path))
+    old.save("k", "stale answer")
+    (tmp_path / "retrieval_v1_k.pkl").write_bytes(b"other prefix")
+
+    new = VersionedCache("query", "v2", cache_dir=str(tmp_path), previous=old)
+    assert new.load("k") is None
+    new.save("k", "fresh answer")
+    assert sorted(os.listdir(tmp_path)) == ["query.fingerprint", "query_v2_k.pkl", "retrieval_v1_k.pkl"]
+
+def test_gc_keeps_fingerprints_of_other_workers(tmp_path):
+    # Another worker process still serves v1
+    VersionedCache("query", "v1", cache_dir=str(tmp_path)).save("k", "v1 answer")
+    (tmp_path / "query_legacykey.pkl").write_bytes(b"legacy")
+    worker = VersionedCache("query", "v2", cache_dir=str(tmp_path))
+    worker.save("k", "v2 answer")
+    assert (tmp_path / "query_v1_k.pkl").exists() and (tmp_path / "query_legacykey.pkl").exists()
+
+    # Until nobody wrote them for CACHE_ORPHAN_TTL
+    for name in ("query_v1_k.pkl", "query_legacykey.pkl"):
+        os.utime(tmp_path / name, (0, 0))
+    assert worker.gc() == 2
+
+def test_lru_capacity(tmp_path):
+    cache = VersionedCache("query", "v1", capacity=2, cache_dir=str(tmp_path))
+    for key in "abc":
+        cache.save(key, key)
+    assert list(cache.memory) == ["b", "c"]
+
+def test_config_fingerprint_is_order_independent():
+    assert config_fingerprint(a=1, b="x") == config_fingerprint(b="x", a=1)
+    assert config_fingerprint(a=1) != config_fingerprint(a=2)
+
+def test_expired_entries_miss(tmp_path):
+    cache = VersionedCache("query", "v1", cache_dir=str(tmp_path), ttl=60)
+    cache.save("k", "answer")
+    cache.save("short", "answer", ttl=0)
+    cache.memory["k"].saved_at -= 120
+    assert cache.load("k") is None
+    assert cache.load("short") is None
+    assert cache.stats()["expired"] == 2
+
+def test_stale_entries_are_flagged(tmp_path):
+    cache = VersionedCache("query", "v1", cache_dir=str(tmp_path), ttl=60, stale_ttl=600)
+    cache.save("k", "answer")
+    assert cache.lookup("k") == ("answer", False)
+    cache.memory["k"].saved_at -= 120
+    assert cache.lookup("k") == ("answer", True)
+    cache.memory["k"].saved_at -= 1200
+    assert cache.lookup("k") == (None, False)
+    assert (cache.stats()["hits"], cache.stats()["stale"], cache.stats()["misses"]) == (1, 1, 1)
+
+def test_previous_fingerprint_served_stale_and_kept_by_gc(tmp_path):
+    old = VersionedCache("query", "v1", cache_dir=str(tmp_path))
+    old.save("k", "old answer")
+    os.remove(old.path("k"))
+    new = VersionedCache("query", "v2", cache_dir=str(tmp_path), stale_ttl=600, previous=old)
+    # From the replaced cache's memory tier
+    assert new.lookup("k") == ("old answer", True)
+    assert new.load("k") is None
+
+    VersionedCache("query", "v1", cache_dir=str(tmp_path)).save("j", "old answer")
+    after_restart = VersionedCache("query", "v2", cache_dir=str(tmp_path), stale_ttl=600)
+    after_restart.save("other", "fresh")
+    # From disk, under the fingerprint recorded before the restart
+    assert after_restart.previous_fingerprint == "v1"
+    assert after_restart.lookup("j") == ("old answer", True)
+    # Opening another cache of the served fingerprint keeps the previous one
+    assert VersionedCache("query", "v2", cache_dir=str(tmp_path)).previous_fingerprint == "v1"
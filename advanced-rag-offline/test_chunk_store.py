@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Tests for the memory-mapped columnar chunk store
+"""
+
+import os
+import shutil
+import pytest
+from langchain_core.documents import Document
+from rag_tool.chunk_store import ChunkStore, chunk_id_for
+
+def test_chunk_store_round_trip(make_chunks, tmp_path):
+    """Texts and metadata survive a build/open round trip"""
+    chunks = make_chunks()
+    store_dir = str(tmp_path / "store")
+    ChunkStore.build(chunks, store_dir).close()
+
+    store = ChunkStore(store_dir)
+    assert len(store) == 3
+    assert [store.text(row) for row in range(3)] == [c.page_content for c in chunks]
+    assert store.metadata(1)["language"] == "ar"
+    assert store.metadata(2)["start_index"] == 896
+    # Sources are interned: two distinct values for three rows
+    assert store.vocabularies["source"] == ["a.pdf", "b.pdf"]
+    store.close()
+
+def test_chunk_store_lookup_by_id(make_chunks, tmp_path):
+    """Documents are materialized by stable chunk ID and unknown IDs are skipped"""
+    chunks = make_chunks()
+    store = ChunkStore.build(chunks, str(tmp_path / "store"))
+    chunk_id = chunk_id_for(chunks[2])
+
+    assert chunk_id in store
+    assert "0000000000000000" not in store
+    docs = store.get_documents([chunk_id, "0000000000000000"])
+    assert len(docs) == 1
+    assert docs[0].page_content == "Minutes of the security committee meeting"
+    assert docs[0].metadata["chunk_id"] == chunk_id
+    store.close()
+
+def test_empty_chunk_store(tmp_path):
+    """An empty corpus produces a valid, empty store"""
+    store = ChunkStore.build([], str(tmp_path / "store"))
+    assert len(store) == 0
+    assert store.row_of("0000000000000000") is None
+    store.close()
+
+def test_closed_store_raises(make_chunks, tmp_path):
+    """Reading a text after close() fails instead of returning an empty chunk"""
+    store = ChunkStore.build(make_chunks(), str(tmp_path / "store"))
+    store.close()
+    with pytest.raises(ValueError):
+        store.text(0)
+
+def test_rebuild_publishes_a_new_version_atomically(make_chunks, tmp_path, monkeypatch):
+    """Readers always find a complete store while it is rebuilt, and open readers keep theirs"""
+    store_dir = str(tmp_path / "store")
+    chunks = make_chunks()
+    reader = ChunkStore.build(chunks, store_dir)
+    replace = os.replace
+
+    def checked_replace(src, dst):
+        # Right before the swap, the old version is still published
+        assert ChunkStore(store_dir).text(0) == chunks[0].page_content
+        replace(src, dst)
+    monkeypatch.setattr(os, "replace", checked_replace)
+    rebuilt = [Document(page_content="Revised agenda", metadata={"source": "a.pdf", "start_index": 0})]
+    ChunkStore.build(rebuilt, store_dir).close()
+    monkeypatch.setattr(os, "replace", replace)
+    assert reader.text(0) == chunks[0].page_content
+    assert ChunkStore(store_dir).text(0) == "Revised agenda"
+
+    # Versions older than the replaced one are deleted
+    ChunkStore.build(chunks, store_dir).close()
+    assert len([name for name in os.listdir(store_dir) if name.startswith("v")]) == 2
+    reader.close()
+
+def test_unversioned_store_opens(make_chunks, tmp_path):
+    """Stores written before versioning hold their files directly in the store directory"""
+    store = ChunkStore.build(make_chunks(), str(tmp_path / "store"))
+    shutil.copytree(store.path, str(tmp_path / "legacy"))
+    store.close()
+    assert ChunkStore.exists(str(tmp_path / "legacy"))
+    assert ChunkStore(str(tmp_path / "legacy")).text(2) == "Minutes of the security committee meeting"
+
+def test_store_built_from_kept_rows(make_chunks, tmp_path):
+    """Kept rows are copied from another store and new chunks appended"""
+    chunks = make_chunks()
+    base = ChunkStore.build(chunks, str(tmp_path / "base"))
+    new = Document(page_content="Parking lot notice", metadata={"source": "c.pdf", "language": "en", "start_index": 4})
+    kept = base.rows_of_sources(["a.pdf"])
+    assert list(kept) == [0, 2]
+
+    store = ChunkStore.build_from(base, kept, [new], str(tmp_path / "store"))
+    assert [store.text(row) for row in range(3)] == [chunks[0].page_content, chunks[2].page_content, "Parking lot notice"]
+    assert [store.metadata(row)["source"] for row in range(3)] == ["a.pdf", "a.pdf", "c.pdf"]
+    assert store.metadata(1)["start_index"] == 896
+    # b.pdf is gone, so it leaves the vocabulary
+    assert store.vocabularies["source"] == ["a.pdf", "c.pdf"]
+    assert store.get_documents([chunk_id_for(chunks[2])])[0].page_content == chunks[2].page_content
+    assert store.row_of(chunk_id_for(new)) == 2
+    store.close()
+    base.close()
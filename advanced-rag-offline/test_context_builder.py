@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Tests for MMR selection and context compression
+"""
+
+from langchain_core.documents import Document
+from rag_tool.context_builder import ContextBuilder, estimate_tokens, mmr_select
+
+class FakeIndex:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def chunk_embeddings(self, chunk_ids):
+        return {chunk_id: self.embeddings[chunk_id] for chunk_id in chunk_ids if chunk_id in self.embeddings}
+
+    def embed_query(self, query):
+        return [1.0, 0.0]
+
+def make_doc(chunk_id, text, source="a.txt", start_index=-1):
+    return Document(page_content=text, metadata={"chunk_id": chunk_id, "source": source, "start_index": start_index})
+
+def test_mmr_pushes_near_duplicates_back():
+    embeddings = [[1.0, 0.1], [1.0, 0.11], [0.7, 0.7]]
+    assert mmr_select([1.0, 0.0], embeddings, lambda_mult=0.3) == [0, 2, 1]
+    assert mmr_select([1.0, 0.0], embeddings, lambda_mult=1.0) == [0, 1, 2]
+
+def test_overlap_with_selected_neighbour_is_trimmed():
+    text = "abcdefghij" * 3
+    first = make_doc("1", text[:20], start_index=0)
+    second = make_doc("2", text[15:30], start_index=15)
+    builder = ContextBuilder(FakeIndex({}), token_budget=1000)
+    context = builder.build("q", [first, second], query_embedding=[1.0, 0.0])
+    assert [doc.page_content for doc in context] == [text[:20], text[20:30]]
+    # Retrieved documents are left untouched
+    assert second.page_content == text[15:30]
+
+def test_token_budget_limits_context():
+    docs = [make_doc(str(i), "x" * 400, start_index=i * 1000) for i in range(5)]
+    context = ContextBuilder(FakeIndex({}), token_budget=250).build("q", docs, query_embedding=[1.0, 0.0])
+    assert len(context) == 2
+    assert sum(estimate_tokens(doc.page_content) for doc in context) <= 250
+
+def test_sentence_selection_keeps_matching_sentences_in_order():
+    text = "The weather was mild. Item 7C was approved. Lunch was served. The committee approved item 7C unanimously."
+    builder = ContextBuilder(FakeIndex({}), sentence_selection=True, sentences_per_chunk=2)
+    context = builder.build("item 7C approved", [make_doc("1", text)], query_embedding=[1.0, 0.0])
+    assert context[0].page_content == "Item 7C was approved. The committee approved item 7C unanimously."
+
+def test_token_estimate_counts_arabic_conservatively():
+    assert estimate_tokens("x" * 400) == 100
+    # Arabic splits into far more tokens per character than English
+    assert estimate_tokens("ميزانية" * 100) == 350
+    assert estimate_tokens("وافقت اللجنة على الميزانية") > len("وافقت اللجنة على الميزانية") / 4
+
+def test_token_budget_limits_arabic_context():
+    docs = [make_doc(str(i), "ميزانية " * 50, start_index=i * 1000) for i in range(5)]
+    context = ContextBuilder(FakeIndex({}), token_budget=250).build("q", docs, query_embedding=[1.0, 0.0])
+    # 400 characters of Arabic fill about 200 tokens, so only one chunk fits
+    assert len(context) == 1
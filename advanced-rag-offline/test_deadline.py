@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Tests for latency budgets and partial retrieval
+"""
+
+import time
+from rag_tool.deadline import Deadline
+from rag_tool.retrieval_executor import ConcurrentRetrievalExecutor
+
+def test_unlimited_deadline_runs_to_completion():
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    assert deadline.run("translation", lambda q: q.upper(), "q") == "Q"
+    assert deadline.cut_stages == []
+
+def test_run_returns_fallback_on_timeout():
+    deadline = Deadline(0.05)
+    result = deadline.run("translation", lambda q: time.sleep(0.5) or "late", "q", fallback="q")
+    assert result == "q"
+    assert deadline.cut_stages == ["translation"]
+
+def test_sub_deadline_shares_cut_stages():
+    deadline = Deadline(1.0)
+    stage = deadline.sub(0.1)
+    assert stage.remaining() <= 0.1
+    stage.cut("expand")
+    assert deadline.cut_stages == ["expand"]
+
+def test_executor_returns_partial_results_at_deadline():
+    def search(query, k):
+        return [(f"{query}-hit", 1.0)]
+
+    def slow_expansion(query):
+        time.sleep(0.5)
+        return [f"{query}-a"]
+
+    deadline = Deadline(0.05)
+    started = time.time()
+    accumulator = ConcurrentRetrievalExecutor(max_workers=2).run("q", search, {"expand": slow_expansion},
+                                                                  deadline=deadline)
+    assert time.time() - started < 0.3
+    assert accumulator.rankings == 1
+    assert deadline.cut_stages == ["expand"]
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for the memory-mapped dense matrix that serves dense searches
+"""
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rag_tool import indexing
+from rag_tool.dense_matrix import DenseMatrix, normalize_rows
+from rag_tool.indexing import MultiRepresentationIndex
+
+def test_blocked_search_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(1000, 12))
+    queries = rng.normal(size=(3, 12))
+    # Small blocks, so the top rows are merged across many of them
+    matrix = DenseMatrix.build(embeddings, str(tmp_path / "dense"))
+    matrix.block_rows = 64
+    expected = normalize_rows(queries) @ normalize_rows(embeddings).T
+    for query, hits in zip(expected, matrix.search_many(queries, top_k=7)):
+        assert [row for row, score in hits] == list(np.argsort(-query)[:7])
+        assert np.allclose([score for row, score in hits], np.sort(query)[::-1][:7], atol=1e-5)
+    assert [row for row, score in matrix.search(queries[0], top_k=7)] == list(np.argsort(-expected[0])[:7])
+    assert len(matrix.search(queries[0], top_k=5000)) == 1000
+    assert isinstance(matrix.embeddings, np.memmap)
+
+def test_existing_matrix_is_kept(tmp_path):
+    first = DenseMatrix.build(np.eye(3), str(tmp_path / "dense"))
+    # A second builder of the same index finds the directory published and opens it
+    second = DenseMatrix.build(np.eye(3), str(tmp_path / "dense"))
+    assert second.count == first.count == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["dense"]
+
+def test_matrix_is_written_in_row_batches(tmp_path):
+    embeddings = np.random.default_rng(1).normal(size=(10, 4))
+    # Batches arrive in any row order, as Chroma returns them
+    batches = [(np.array([7, 2, 9]), embeddings[[7, 2, 9]]), (np.array([0, 1, 3, 4, 5, 6, 8]), embeddings[[0, 1, 3, 4, 5, 6, 8]])]
+    matrix = DenseMatrix.write(iter(batches), 10, str(tmp_path / "dense"))
+    assert np.allclose(np.asarray(matrix.embeddings), normalize_rows(embeddings))
+    with pytest.raises(ValueError, match="9 of 10"):
+        DenseMatrix.write(iter([(np.arange(9), embeddings[:9])]), 10, str(tmp_path / "partial"))
+
+def test_large_matrix_scans_only_probed_lists(tmp_path, monkeypatch):
+    monkeypatch.setenv("DENSE_ANN_MIN_ROWS", "1000")
+    monkeypatch.setenv("DENSE_ANN_PROBE", "4")
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 16)) * 5
+    embeddings = centers[np.arange(4000) % 20] + rng.normal(size=(4000, 16))
+    matrix = DenseMatrix.build(embeddings, str(tmp_path / "dense"))
+    assert len(matrix.centroids) == 63
+    assert sorted(matrix.list_rows) == list(range(4000))
+    queries = embeddings[:20] + rng.normal(scale=0.1, size=(20, 16))
+    exact = np.argsort(-(normalize_rows(queries) @ normalize_rows(embeddings).T), axis=1)[:, :10]
+    hits = matrix.search_many(queries, top_k=10)
+    recall = np.mean([len(set(row for row, score in found) & set(expected)) / 10 for found, expected in zip(hits, exact)])
+    assert recall >= 0.9
+    # Each query scans about 4 of the 63 lists
+    assert sum(len(rows) for rows, block in matrix._candidate_blocks(normalize_rows(queries[:1]))) < 400
+
+def test_matrix_name_taken_by_other_files_is_an_error(tmp_path):
+    legacy = tmp_path / "dense"
+    legacy.mkdir()
+    (legacy / "chroma.sqlite3").write_text("")
+    with pytest.raises(OSError):
+        DenseMatrix.build(np.eye(3), str(legacy))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["dense"]
+
+def test_opening_a_built_index_skips_chroma(tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    built = MultiRepresentationIndex()
+    built.build_indexes([
+        Document(page_content="The committee approved the budget", metadata={"source": "a.pdf", "start_index": 0}),
+        Document(page_content="Minutes of the security meeting", metadata={"source": "b.pdf", "start_index": 0}),
+    ], [])
+
+    def no_chroma(*args, **kwargs):
+        raise AssertionError("Chroma opened to serve a finished index")
+    monkeypatch.setattr(indexing, "DenseIndexBuilder", no_chroma)
+    index = MultiRepresentationIndex()
+    assert index.load_indexes(built.cache_key)
+    chunk_id, score = index.search("Minutes of the security meeting", top_k=1)[0]
+    assert index.get_documents([chunk_id])[0].page_content == "Minutes of the security meeting"
+    assert abs(score - 1.0) < 1e-5
+    assert set(index.chunk_embeddings([chunk_id])) == {chunk_id}
+    # Older releases kept their Chroma index in cache/dense_*; the matrix must not take that name
+    assert not any(p.name.startswith("dense_") for p in tmp_path.iterdir())
+    index.release()
+    built.release()
+
+def test_search_lists_are_reused(tmp_path, monkeypatch):
+    monkeypatch.setenv("DENSE_ANN_MIN_ROWS", "1000")
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(2000, 16))
+    matrix = DenseMatrix.build(embeddings, str(tmp_path / "dense"))
+    labels = matrix.labels()
+    assert sorted(labels[matrix.list_rows[matrix.list_offsets[3]:matrix.list_offsets[4]]]) == [3] * int(
+        matrix.list_offsets[4] - matrix.list_offsets[3])
+
+    # Kept rows keep their lists; only the new rows are assigned
+    kept = np.arange(500, 2000)
+    new = rng.normal(size=(10, 16))
+    batches = [(np.arange(len(kept)), matrix.embeddings[kept]), (np.arange(len(kept), len(kept) + 10), new)]
+    monkeypatch.setattr(DenseMatrix, "_train_centroids", staticmethod(lambda embeddings: pytest.fail("retrained")))
+    updated = DenseMatrix.write(batches, len(kept) + 10, str(tmp_path / "updated"), centroids=matrix.centroids,
+                                labels=np.concatenate([labels[kept], np.full(10, -1)]))
+    assert np.array_equal(updated.labels()[:len(kept)], labels[kept])
+    assert np.array_equal(updated.labels()[len(kept):], np.argmax(normalize_rows(new) @ np.asarray(matrix.centroids).T, axis=1))
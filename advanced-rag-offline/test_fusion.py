@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Tests for chunk-ID based rank fusion
+"""
+
+import pytest
+from rag_tool.fusion import dedupe_hits, fuse
+
+def test_rrf_merges_same_chunk_across_rankings():
+    fused = fuse([[("a", 0.9), ("b", 0.8)], [("b", 0.7), ("c", 0.6)]], method="rrf", k=60)
+    assert [chunk_id for chunk_id, score in fused] == ["b", "a", "c"]
+    assert fused[0][1] == pytest.approx(1/62 + 1/61)
+    assert fused[1][1] == pytest.approx(1/61)
+
+def test_duplicates_within_a_ranking_count_once():
+    fused = fuse([[("a", 0.9), ("a", 0.5), ("b", 0.4)]], method="rrf", k=60)
+    assert fused == [("a", pytest.approx(1/61)), ("b", pytest.approx(1/63))]
+
+def test_weighted_fusion_normalizes_scores():
+    fused = fuse([[("a", 10.0), ("b", 0.0)], [("b", 0.9), ("c", 0.1)]], method="weighted", weights=[1.0, 2.0])
+    assert dict(fused) == pytest.approx({"a": 1.0, "b": 2.0, "c": 0.0})
+    assert fused[0][0] == "b"
+
+def test_empty_rankings_keep_weights_aligned():
+    assert fuse([[], []]) == []
+    fused = fuse([[], [("a", 1.0)]], method="weighted", weights=[5.0, 1.0])
+    assert fused == [("a", pytest.approx(1.0))]
+
+def test_ties_are_deterministic():
+    assert [c for c, s in fuse([[("b", 1.0)], [("a", 1.0)]], method="rrf")] == ["a", "b"]
+
+def test_dedupe_hits_keeps_best_position():
+    assert dedupe_hits([("a", 0.9), ("b", 0.8), ("a", 0.95)]) == [("a", 0.9), ("b", 0.8)]
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Tests for incremental index updates when document files change
+"""
+
+import os
+import time
+import pytest
+from pathlib import Path
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rag_tool import indexing, pipeline
+from rag_tool.chunk_store import ChunkStore
+from rag_tool.indexing import MultiRepresentationIndex
+from rag_tool.sharding import ShardedIndex
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    embedded: list = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+def chunk(source, text):
+    return Document(page_content=text, metadata={"source": source, "start_index": 0, "language": "en"})
+
+def sources(index):
+    return sorted({index.chunk_store.metadata(row)["source"] for row in range(len(index.chunk_store))})
+
+def setup_index(tmp_path, monkeypatch):
+    embeddings = CountingEmbeddings(size=16, embedded=[])
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: embeddings)
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    return embeddings
+
+def test_update_embeds_only_changed_files(tmp_path, monkeypatch):
+    embeddings = setup_index(tmp_path, monkeypatch)
+    index = MultiRepresentationIndex()
+    index.build_indexes([chunk("a.pdf", "alpha apples"), chunk("b.pdf", "bravo bananas"), chunk("c.pdf", "charlie cherries")], [])
+    embeddings.embedded.clear()
+
+    # Kept chunks are copied column by column, never materialized
+    document = ChunkStore.document
+    monkeypatch.setattr(ChunkStore, "document", lambda self, row: pytest.fail("materialized a kept chunk"))
+    updated = index.updated(["a.pdf", "b.pdf", "d.pdf"], [chunk("b.pdf", "bravo blueberries"), chunk("d.pdf", "delta dates")])
+    monkeypatch.setattr(ChunkStore, "document", document)
+    assert embeddings.embedded == ["bravo blueberries", "delta dates"]
+    assert sources(updated) == ["b.pdf", "c.pdf", "d.pdf"]
+    assert updated.stage == "full" and updated.version != index.version
+    assert updated.get_documents([updated.search("delta dates", top_k=1)[0][0]])[0].page_content == "delta dates"
+    # The served index is left as it was until it is swapped out
+    assert sources(index) == ["a.pdf", "b.pdf", "c.pdf"]
+    assert index.updated(["a.pdf", "b.pdf", "c.pdf"], []) is None
+    updated.release()
+    index.release()
+
+def test_sharded_update_rebuilds_affected_shards(tmp_path, monkeypatch):
+    setup_index(tmp_path, monkeypatch)
+    index = ShardedIndex("/docs", strategy="subtree", max_workers=2)
+    index.build_indexes([chunk("/docs/reports/a.pdf", "annual report"), chunk("/docs/minutes/b.pdf", "board minutes")], [])
+
+    updated = index.updated(["/docs/minutes/b.pdf", "/docs/letters/c.pdf"], [chunk("/docs/letters/c.pdf", "cover letter")])
+    assert sorted(updated.shards) == ["letters", "reports"]
+    # Unchanged shards are shared, not rebuilt
+    assert updated.shards["reports"] is index.shards["reports"]
+    assert sorted(index.shards) == ["minutes", "reports"]
+    index.release(updated)
+    assert updated.get_documents([updated.search("annual report", top_k=1)[0][0]])[0].page_content == "annual report"
+    updated.close()
+
+def test_file_changed_during_update_is_indexed_by_the_next_update(make_pipeline, monkeypatch):
+    rag = make_pipeline({"a.pdf": "alpha apples are red", "b.pdf": "bravo bananas are yellow"})
+    docs_dir = Path(rag.data_path)
+    scan = pipeline.scan_documents
+
+    def scan_then_add_file(path):
+        files = scan(path)
+        # A file appears right after the update scanned the directory
+        if not (docs_dir / "c.pdf").exists():
+            (docs_dir / "c.pdf").write_text("charlie cherries are dark")
+        return files
+    monkeypatch.setattr(pipeline, "scan_documents", scan_then_add_file)
+
+    (docs_dir / "b.pdf").write_text("bravo blueberries are blue")
+    os.utime(docs_dir / "b.pdf", (time.time() + 10, time.time() + 10))
+    assert rag.update_corpus()
+    assert sources(rag.index) == [str(docs_dir / "a.pdf"), str(docs_dir / "b.pdf")]
+    # The new file is not mistaken for part of the index published by the first update
+    assert rag.update_corpus()
+    assert sources(rag.index) == [str(docs_dir / name) for name in ("a.pdf", "b.pdf", "c.pdf")]
+
+def test_stopped_dense_build_is_finished_by_retry_and_update(tmp_path, make_pipeline, monkeypatch):
+    monkeypatch.setenv("INDEX_RETRY_DELAY", "3600")
+    monkeypatch.setenv("INDEX_RETRY_MAX_DELAY", "86400")
+    build_dense = MultiRepresentationIndex.build_dense
+    ollama_down = [True]
+
+    def failing_build_dense(self, *args, **kwargs):
+        if ollama_down[0]:
+            raise ConnectionError("Ollama is not reachable")
+        return build_dense(self, *args, **kwargs)
+    monkeypatch.setattr(MultiRepresentationIndex, "build_dense", failing_build_dense)
+
+    docs_dir = tmp_path / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "a.pdf").write_text("alpha apples are red")
+    rag = pipeline.FocusedRAGPipeline(str(docs_dir), "en")
+    try:
+        rag.initialize()
+    except ConnectionError:
+        pass
+    # BM25 keeps serving, and a retry is scheduled
+    assert rag.phase == "sparse_ready" and rag.init_error
+    first_retry = rag.index_retry_timer
+    assert first_retry.interval == 3600
+    first_retry.cancel()
+
+    rag.retry_index()
+    assert rag.phase == "sparse_ready"
+    # Backs off after each failure
+    assert rag.index_retry_timer is not first_retry and rag.index_retry_timer.interval == 7200
+    rag.index_retry_timer.cancel()
+
+    ollama_down[0] = False
+    (docs_dir / "b.pdf").write_text("bravo bananas are yellow")
+    assert rag.update_corpus()
+    assert rag.phase == "ready" and rag.init_error is None
+    assert sources(rag.index) == [str(docs_dir / "a.pdf"), str(docs_dir / "b.pdf")]
+
+def test_waiting_worker_serves_the_unfinished_build(tmp_path, make_pipeline, monkeypatch):
+    monkeypatch.setenv("INDEX_RETRY_DELAY", "3600")
+    monkeypatch.setenv("INDEX_RETRY_MAX_DELAY", "86400")
+    build_dense = MultiRepresentationIndex.build_dense
+    dense_builds = []
+
+    def failing_build_dense(self, *args, **kwargs):
+        dense_builds.append(1)
+        if len(dense_builds) == 1:
+            raise ConnectionError("Ollama is not reachable")
+        return build_dense(self, *args, **kwargs)
+    monkeypatch.setattr(MultiRepresentationIndex, "build_dense", failing_build_dense)
+
+    docs_dir = tmp_path / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "a.pdf").write_text("alpha apples are red")
+    builder = pipeline.FocusedRAGPipeline(str(docs_dir), "en")
+    with pytest.raises(ConnectionError):
+        builder.initialize()
+    builder.index_retry_timer.cancel()
+
+    # Another worker opens the BM25 snapshot and leaves the build to the builder
+    worker = pipeline.FocusedRAGPipeline(str(docs_dir), "en")
+    assert worker.initialize()
+    assert worker.phase == "sparse_ready" and worker.init_error is None
+    assert not worker.index.dense_ready
+    assert len(dense_builds) == 1
+    worker.index_retry_timer.cancel()
+    worker.retry_index()
+    assert worker.phase == "sparse_ready" and len(dense_builds) == 1
+    worker.index_retry_timer.cancel()
+
+    # The builder finishes and publishes; the worker then opens the finished snapshot
+    builder.retry_index()
+    assert builder.phase == "ready"
+    worker.retry_index()
+    assert worker.phase == "ready" and worker.index.dense_ready
+    assert len(dense_builds) == 2
+
+def test_waiting_worker_takes_over_an_abandoned_build(tmp_path, make_pipeline, monkeypatch):
+    monkeypatch.setenv("INDEX_RETRY_DELAY", "3600")
+    build_dense = MultiRepresentationIndex.build_dense
+    ollama_down = [True]
+
+    def failing_build_dense(self, *args, **kwargs):
+        if ollama_down[0]:
+            raise ConnectionError("Ollama is not reachable")
+        return build_dense(self, *args, **kwargs)
+    monkeypatch.setattr(MultiRepresentationIndex, "build_dense", failing_build_dense)
+
+    docs_dir = tmp_path / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "a.pdf").write_text("alpha apples are red")
+    builder = pipeline.FocusedRAGPipeline(str(docs_dir), "en")
+    with pytest.raises(ConnectionError):
+        builder.initialize()
+    builder.index_retry_timer.cancel()
+    # The builder process exits, which releases its ownership
+    builder.index_snapshot.disown()
+
+    ollama_down[0] = False
+    worker = pipeline.FocusedRAGPipeline(str(docs_dir), "en")
+    assert worker.initialize()
+    assert worker.phase == "ready" and worker.index.dense_ready
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tests for the Prometheus metrics served at /metrics
+"""
+
+import pytest
+from rag_tool.metrics import Counter, Gauge, Histogram, MetricsRegistry, CACHE_REQUESTS, MODEL_CALLS, cache_hit_ratios, model_call
+
+class FakeModel:
+    model = "fake-model"
+
+def test_counter_and_gauge_rendering():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("test_total", "Test counter", ["kind"]))
+    gauge = registry.register(Gauge("test_in_flight", "Test gauge"))
+    counter.inc(kind="a")
+    counter.inc(2, kind='quo"te')
+    with gauge.track():
+        assert gauge.value() == 1
+    assert gauge.value() == 0
+    text = registry.render()
+    assert "# TYPE test_total counter" in text
+    assert 'test_total{kind="a"} 1\n' in text
+    assert 'test_total{kind="quo\\"te"} 2\n' in text
+    assert "test_in_flight 0\n" in text
+    with pytest.raises(ValueError):
+        counter.inc(other="x")
+    with pytest.raises(ValueError):
+        registry.register(Counter("test_total", "Duplicate"))
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.register(Histogram("test_seconds", "Test histogram", ["stage"], buckets=(0.1, 1.0)))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, stage="s")
+    text = registry.render()
+    assert 'test_seconds_bucket{stage="s",le="0.1"} 1\n' in text
+    assert 'test_seconds_bucket{stage="s",le="1"} 3\n' in text
+    assert 'test_seconds_bucket{stage="s",le="+Inf"} 4\n' in text
+    assert 'test_seconds_count{stage="s"} 4\n' in text
+    assert 'test_seconds_sum{stage="s"} 4.25\n' in text
+    assert histogram.count(stage="s") == 4
+
+def test_cache_hit_ratios():
+    CACHE_REQUESTS.inc(3, namespace="test_ratio", result="hit")
+    CACHE_REQUESTS.inc(1, namespace="test_ratio", result="stale")
+    CACHE_REQUESTS.inc(4, namespace="test_ratio", result="miss")
+    hits, misses = cache_hit_ratios()
+    assert hits.value(namespace="test_ratio") == 0.5
+    assert misses.value(namespace="test_ratio") == 0.5
+
+def test_collectors_update_registered_metrics():
+    registry = MetricsRegistry()
+    phase = registry.register(Gauge("test_phase", "Test state gauge", ["phase"]))
+    state = {"phase": "starting"}
+    registry.add_collector(lambda: phase.set_only(1, phase=state["phase"]))
+    assert 'test_phase{phase="starting"} 1\n' in registry.render()
+    state["phase"] = "ready"
+    text = registry.render()
+    assert 'test_phase{phase="ready"} 1\n' in text
+    assert "starting" not in text
+    assert text.count("# TYPE test_phase gauge") == 1
+    # The ratio gauges are updated in place, not recreated per scrape
+    assert cache_hit_ratios()[0] is cache_hit_ratios()[0]
+
+def test_model_call_counts_errors():
+    before = MODEL_CALLS.value(model="fake-model", kind="test", status="error")
+    with model_call(FakeModel(), "test"):
+        pass
+    with pytest.raises(RuntimeError):
+        with model_call(FakeModel(), "test"):
+            raise RuntimeError("model unavailable")
+    assert MODEL_CALLS.value(model="fake-model", kind="test", status="ok") >= 1
+    assert MODEL_CALLS.value(model="fake-model", kind="test", status="error") == before + 1
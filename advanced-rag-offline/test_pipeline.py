@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Tests for answering queries through the pipeline with fake Ollama models
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+DOCUMENTS = {
+    "budget.pdf": "The committee approved the budget for the new library.",
+    "security.pdf": "Minutes of the security meeting about the server room.",
+    "parking.pdf": "The parking lot will be repaved next spring.",
+}
+
+def test_batch_answers_duplicate_questions_once(make_pipeline, fake_models, monkeypatch):
+    rag = make_pipeline(DOCUMENTS)
+    detected = []
+    detect_language = rag.translator.detect_language
+    monkeypatch.setattr(rag.translator, "detect_language", lambda text: detected.append(text) or detect_language(text))
+    fake_models.calls.clear()
+    questions = ["Who approved the budget?", "When is the parking lot repaved?", "Who approved the budget?"]
+    results = dict(rag.query_batch(questions, mode="fast"))
+    assert sorted(results) == [0, 1, 2]
+    assert results[0] is results[2]
+    assert results[0]["original_response"] == fake_models.answer
+    assert len(fake_models.calls) == 2
+    assert sorted(detected) == sorted(set(questions))
+
+def test_concurrent_async_queries_overlap(make_pipeline, fake_models, monkeypatch):
+    rag = make_pipeline(DOCUMENTS)
+    fake_models.delay = 0.5
+    threads = set()
+    retrieve = rag.serving.retriever.retrieve
+    monkeypatch.setattr(rag.serving.retriever, "retrieve",
+                        lambda *args, **kwargs: threads.add(threading.current_thread().name) or retrieve(*args, **kwargs))
+    questions = ["Who approved the budget?", "When is the parking lot repaved?",
+                 "What was discussed at the security meeting?", "Which library got a budget?"]
+
+    async def ask_all():
+        return await asyncio.gather(*(rag.aquery(question, mode="fast") for question in questions))
+    started = time.monotonic()
+    results = asyncio.run(ask_all())
+    # Four generations of 0.5s each, awaited together
+    assert time.monotonic() - started < 1.5
+    assert [result["original_response"] for result in results] == [fake_models.answer] * 4
+    assert len(fake_models.calls) == 4
+    # Blocking stages run in the pipeline's own pool, not asyncio's default executor
+    assert threads and all(name.startswith("async-query") for name in threads)
+
+def test_identical_async_queries_generate_once(make_pipeline, fake_models):
+    rag = make_pipeline(DOCUMENTS)
+    fake_models.delay = 0.2
+    fake_models.calls.clear()
+
+    async def ask_three_times():
+        return await asyncio.gather(*(rag.aquery("Who approved the budget?", mode="fast") for _ in range(3)))
+    results = asyncio.run(ask_three_times())
+    assert len(fake_models.calls) == 1
+    assert results[0] is results[1] is results[2]
+    assert not rag.flights.flights
+
+def test_batch_and_async_query_generate_once(make_pipeline, fake_models):
+    rag = make_pipeline(DOCUMENTS)
+    fake_models.delay = 0.3
+    fake_models.calls.clear()
+
+    async def ask_both():
+        batch = asyncio.get_running_loop().run_in_executor(
+            None, lambda: dict(rag.query_batch(["Who approved the budget?"], mode="fast")))
+        return await asyncio.gather(rag.aquery("Who approved the budget?", mode="fast"), batch)
+    answer, batch = asyncio.run(ask_both())
+    # One generation, shared between the batch and the /invoke-style request
+    assert len(fake_models.calls) == 1
+    # The very same result object, not a copy served from the answer cache
+    assert batch[0] is answer
+    assert answer["original_response"] == fake_models.answer
+
+def test_query_joins_an_identical_stream(make_pipeline, fake_models):
+    rag = make_pipeline(DOCUMENTS)
+    fake_models.delay = 0.3
+    fake_models.calls.clear()
+    stream = rag.query_stream("Who approved the budget?", mode="fast")
+    first = next(stream)
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        follower = pool.submit(rag.query, "Who approved the budget?", mode="fast")
+        events = [first, *stream]
+        answer = follower.result()
+    assert len(fake_models.calls) == 1
+    # The blocking caller gets the streamed answer, assembled from its events
+    assert answer["original_response"] == "".join(event["text"] for event in events if event["type"] == "token")
+    assert answer["stage_timings"] == events[-1]["stage_timings"]
+    assert not rag.flights.flights
+
+def test_background_translation_is_timed(make_pipeline, fake_models):
+    # English questions over an Arabic corpus are translated while retrieval runs
+    rag = make_pipeline(DOCUMENTS, language="ar")
+    fake_models.delay = 0.3
+    result = rag.query("Who approved the budget?", mode="fast")
+    timings = result["stage_timings"]
+    # translate_query only starts the translation; translate is the translation itself
+    assert timings["translate_query"]["wall"] < 0.1
+    assert timings["translate"]["wall"] >= 0.3
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Tests for prompt assembly and per-model options
+"""
+
+from langchain_core.documents import Document
+from rag_tool.prompt_builder import PromptBuilder
+from rag_tool.model_options import model_options
+
+def make_doc(chunk_id, text, source="a.txt", start_index=-1):
+    return Document(page_content=text, metadata={"chunk_id": chunk_id, "source": source, "start_index": start_index})
+
+def test_instructions_first_question_last():
+    builder = PromptBuilder("en", num_ctx=4096, num_predict=512)
+    prompt = builder.build("What was decided?", [make_doc("a", "The plan was approved.")])
+    assert prompt.startswith(builder.instructions)
+    assert prompt.index("The plan was approved.") < prompt.index("What was decided?")
+    assert prompt.endswith("**ANSWER**\n")
+
+def test_context_order_is_stable():
+    builder = PromptBuilder("en", num_ctx=4096, num_predict=512)
+    docs = [make_doc("b", "second", "b.txt", 0), make_doc("a2", "later", "a.txt", 500), make_doc("a1", "first", "a.txt", 0)]
+    assert builder.build("q", docs) == builder.build("q", list(reversed(docs)))
+    prompt = builder.build("q", docs)
+    assert prompt.index("first") < prompt.index("later") < prompt.index("second")
+
+def test_lowest_priority_chunks_dropped_to_fit_window():
+    builder = PromptBuilder("en", num_ctx=400, num_predict=100)
+    budget = builder.context_budget("q")
+    docs = [make_doc("top", "y" * budget * 8)] + [make_doc(str(i), "z" * 100) for i in range(3)]
+    packed = builder.pack("q", docs)
+    assert [doc.metadata["chunk_id"] for doc in packed] == ["0", "1", "2"]
+    assert sum(len(builder.chunk_block(doc)) for doc in packed) / 4 <= budget
+
+def test_model_options(monkeypatch):
+    monkeypatch.setenv("OLLAMA_NUM_CTX", "2048")
+    monkeypatch.setenv("MODEL_OPTIONS", '{"llama3:8b": {"num_ctx": 8192}, "mistral-nemo:latest": {"num_predict": 2048}}')
+    assert model_options("llama3:8b") == {"num_ctx": 8192, "num_predict": 512}
+    assert model_options("other") == {"num_ctx": 2048, "num_predict": 512}
+    assert model_options("mistral-nemo:latest", defaults=False) == {"num_predict": 2048}
+    assert model_options("other", defaults=False) == {}
+
+def test_arabic_prompt_fits_window():
+    builder = PromptBuilder("ar", num_ctx=600, num_predict=100)
+    question = "ما الذي قررته اللجنة؟"
+    docs = [make_doc(str(i), "وافقت اللجنة على الميزانية " * 10, "a.pdf", i * 1000) for i in range(10)]
+    prompt = builder.build(question, docs)
+    assert 0 < prompt.count("Content:") < len(docs)
+    # Even at two characters per token for all non-ASCII text the prompt leaves room for the answer
+    ascii_chars = len(prompt.encode("ascii", "ignore"))
+    assert ascii_chars / 4 + (len(prompt) - ascii_chars) / 2 <= builder.num_ctx - builder.num_predict
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Tests for tolerant parsing of query expansion responses
+"""
+
+from rag_tool.query_transformer import normalize_query, parse_expansion
+
+def test_parse_json_object():
+    text = '{"paraphrases": ["a", "b"], "sub_questions": ["c"]}'
+    assert parse_expansion(text) == (["a", "b"], ["c"])
+
+def test_parse_fenced_object_with_prose():
+    text = 'Sure! Here you go:\n```json\n{"queries": ["a"], "subquestions": []}\n```'
+    assert parse_expansion(text) == (["a"], [])
+
+def test_parse_bare_array_as_paraphrases():
+    assert parse_expansion('Output: ["a", "b", "c"]') == (["a", "b", "c"], [])
+
+def test_parse_numbered_list_fallback():
+    text = "1. first version\n2) second version\n- third version"
+    assert parse_expansion(text) == (["first version", "second version", "third version"], [])
+
+def test_unparseable_response():
+    assert parse_expansion("I cannot help with that.") is None
+    assert parse_expansion('{"paraphrases": []}') is None
+
+def test_normalize_query():
+    assert normalize_query("  What  is EC-104?\n") == normalize_query("what is ec-104?")
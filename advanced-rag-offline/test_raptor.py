@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for the level-aware RAPTOR tree
+"""
+
+import os
+import numpy as np
+from rag_tool.dense_matrix import normalize_rows
+from rag_tool.indexing import fuse_raptor_hits
+from rag_tool.raptor import RaptorTree
+
+def make_embeddings(n=600, dim=16, topics=6, seed=0):
+    """Normalized noisy points around a few well separated topic directions"""
+    rng = np.random.default_rng(seed)
+    centers = np.eye(topics, dim) * 10
+    labels = np.arange(n) % topics
+    return normalize_rows(centers[labels] + rng.normal(scale=0.5, size=(n, dim))), labels
+
+def test_tree_links_are_consistent(tmp_path):
+    embeddings, _ = make_embeddings()
+    tree = RaptorTree.build(embeddings, str(tmp_path / "raptor"), branching=5)
+
+    assert tree.height >= 2
+    assert len(tree.embeddings[tree.height]) <= 5
+    assert tree.embeddings[0] is embeddings
+    # Leaves are read from the dense matrix, not copied into the tree
+    assert not os.path.exists(os.path.join(tree.path, "level_0", "embeddings.npy"))
+    for level in range(1, tree.height + 1):
+        for node in range(len(tree.embeddings[level])):
+            for child in tree.node_children(level, node):
+                assert tree.parents[level - 1][child] == node
+
+def test_search_descends_to_matching_topic(tmp_path):
+    embeddings, labels = make_embeddings()
+    tree = RaptorTree.build(embeddings, str(tmp_path / "raptor"), branching=5)
+
+    query = np.eye(6, 16)[2]
+    hits = tree.search(query, top_k=8, beam=2)
+    assert len(hits) == 8
+    assert all(labels[row] == 2 for row, score in hits)
+    assert [score for row, score in hits] == sorted((score for row, score in hits), reverse=True)
+
+def test_reopened_tree_matches(tmp_path):
+    embeddings, _ = make_embeddings(n=120)
+    tree_dir = str(tmp_path / "raptor")
+    built = RaptorTree.build(embeddings, tree_dir, branching=4)
+    reopened = RaptorTree(tree_dir, embeddings)
+    query = embeddings[7]
+    assert built.search(query, top_k=3) == reopened.search(query, top_k=3)
+    assert reopened.search(query, top_k=1)[0][0] == 7
+
+def test_search_ranks_chunks_by_their_cluster(tmp_path):
+    embeddings, labels = make_embeddings()
+    tree = RaptorTree.build(embeddings, str(tmp_path / "raptor"), branching=5)
+
+    # A query between topic 2 and topic 3 but closer to 2
+    query = normalize_rows(np.eye(6, 16)[2] * 0.6 + np.eye(6, 16)[3] * 0.4)
+    hits = tree.search(query, top_k=5, beam=2)
+    assert all(labels[row] == 2 for row, score in hits)
+    bottom_cluster = tree.parents[0][hits[0][0]]
+    assert hits[0][1] == float(np.asarray(tree.embeddings[1][bottom_cluster]) @ query)
+
+def test_fused_hits_add_topic_chunks():
+    dense = [("a", 0.9), ("b", 0.8), ("c", 0.7)]
+    raptor = [("c", 0.6), ("d", 0.6)]
+    fused = [chunk_id for chunk_id, score in fuse_raptor_hits(dense, raptor)]
+    # Found by both rankings, c is lifted above b; d only lives in the matching cluster
+    assert fused[:2] == ["c", "a"]
+    assert set(fused) == {"a", "b", "c", "d"}
+
+def test_updated_tree_copies_clusters(tmp_path):
+    embeddings, labels = make_embeddings()
+    tree = RaptorTree.build(embeddings, str(tmp_path / "raptor"), branching=5)
+    kept = np.arange(100, 600)
+    new, new_labels = make_embeddings(n=60, seed=1)
+    leaves = np.vstack([embeddings[kept], new])
+
+    updated = tree.updated(kept, leaves, str(tmp_path / "updated"))
+    assert updated.height == tree.height
+    assert list(updated.parents[0][:len(kept)]) == list(tree.parents[0][kept])
+    # New chunks join a cluster of their own topic
+    topic_of_cluster = {int(tree.parents[0][row]): labels[row] for row in range(len(labels))}
+    assert all(topic_of_cluster[int(node)] == topic for node, topic in zip(updated.parents[0][len(kept):], new_labels))
+    assert all(labels[kept][row] == 2 for row, score in updated.search(np.eye(6, 16)[2], top_k=5, beam=2)
+               if row < len(kept))
+    # A tree that must grow a level is rebuilt by the caller
+    assert tree.updated(np.arange(600), np.vstack([embeddings] * 10), str(tmp_path / "grown")) is None
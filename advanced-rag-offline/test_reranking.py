@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Tests for the rerank stage and its score cache
+"""
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rag_tool import reranking
+from rag_tool.reranking import BiEncoderReranker, LexicalReranker, Reranker, RerankCache, create_reranker
+
+def make_doc(chunk_id, text):
+    return Document(page_content=text, metadata={"chunk_id": chunk_id})
+
+class CountingReranker(LexicalReranker):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def score_batch(self, query, texts):
+        self.batches.append(len(texts))
+        return super().score_batch(query, texts)
+
+def test_lexical_reranker_orders_by_overlap():
+    docs = [make_doc("a", "the weather today"), make_doc("b", "committee decision on item 7C"),
+            make_doc("c", "item 7C was deferred")]
+    ranked = LexicalReranker().rerank("committee decision item 7C", docs, top_k=2)
+    assert [doc.metadata["chunk_id"] for doc in ranked] == ["b", "c"]
+    assert ranked[0].metadata["rerank_score"] > ranked[1].metadata["rerank_score"]
+
+def test_scores_are_batched_and_cached():
+    reranker = CountingReranker(batch_size=2)
+    docs = [make_doc(str(i), f"chunk {i} text") for i in range(5)]
+    reranker.rerank("chunk text", docs)
+    assert reranker.batches == [2, 2, 1]
+    # Same query in a different form and the same chunks: no new scoring calls
+    reranker.rerank("  Chunk TEXT ", [make_doc(str(i), f"chunk {i} text") for i in range(5)])
+    assert reranker.batches == [2, 2, 1]
+
+def test_cache_evicts_least_recently_used():
+    cache = RerankCache(capacity=2)
+    cache.put("a", 1.0)
+    cache.put("b", 2.0)
+    cache.get("a")
+    cache.put("c", 3.0)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1.0
+
+def test_create_reranker(monkeypatch):
+    monkeypatch.delenv("RERANKER", raising=False)
+    assert create_reranker() is None
+    assert isinstance(create_reranker("lexical"), LexicalReranker)
+    with pytest.raises(ValueError):
+        create_reranker("cross")
+    with pytest.raises(TypeError):
+        Reranker()
+
+def test_bi_encoder_defaults_to_the_embedding_model(monkeypatch):
+    monkeypatch.delenv("RERANKER_MODEL", raising=False)
+    monkeypatch.setenv("EMBEDDING_MODEL", "test-embedding")
+    monkeypatch.setattr(reranking, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    reranker = create_reranker("bi_encoder")
+    assert isinstance(reranker, BiEncoderReranker)
+    assert reranker.name == "bi_encoder:test-embedding"
+    docs = [make_doc("a", "the weather today"), make_doc("b", "committee decision")]
+    # The fake embeds equal texts equally, so the chunk equal to the query scores 1
+    ranked = reranker.rerank("committee decision", docs)
+    assert ranked[0].metadata["chunk_id"] == "b"
+    assert abs(ranked[0].metadata["rerank_score"] - 1.0) < 1e-5
+
+class StoredEmbeddingIndex:
+    """Index stand-in holding precomputed chunk embeddings"""
+    dense_ready = True
+
+    def __init__(self, embeddings, vectors):
+        self.embeddings = embeddings
+        self.vectors = vectors
+
+    def chunk_embeddings(self, chunk_ids):
+        return {chunk_id: self.vectors[chunk_id] for chunk_id in chunk_ids if chunk_id in self.vectors}
+
+    def embed_query(self, query):
+        return self.embeddings.embed_query(query)
+
+def test_bi_encoder_reuses_stored_embeddings_of_the_index_model(monkeypatch):
+    monkeypatch.delenv("RERANKER_MODEL", raising=False)
+    monkeypatch.setenv("EMBEDDING_MODEL", "test-embedding")
+    # No embedding client at all: scoring must not call the model
+    monkeypatch.setattr(reranking, "OllamaEmbeddings", lambda **kwargs: None)
+    fake = DeterministicFakeEmbedding(size=16)
+    index = StoredEmbeddingIndex(fake, {"a": fake.embed_query("the weather today"), "b": fake.embed_query("committee decision")})
+
+    ranked = create_reranker("bi_encoder", index=index).rerank(
+        "committee decision", [make_doc("a", "the weather today"), make_doc("b", "committee decision")])
+    assert ranked[0].metadata["chunk_id"] == "b"
+    assert abs(ranked[0].metadata["rerank_score"] - 1.0) < 1e-5
+
+    # A different reranker model embeds the texts itself
+    monkeypatch.setenv("RERANKER_MODEL", "other-embedding")
+    monkeypatch.setattr(reranking, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    assert BiEncoderReranker(index=index).index is None
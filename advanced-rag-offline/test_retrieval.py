@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Tests for retrieval depth modes
+"""
+
+import concurrent.futures
+import pytest
+from langchain_core.documents import Document
+from rag_tool import cache
+from rag_tool.deadline import Deadline
+from rag_tool.retrieval import RetrievalSystem, needs_expansion, resolve_mode
+
+def test_short_lookup_skips_expansion():
+    assert not needs_expansion("what is EC-104 item 7C")
+    assert not needs_expansion("ما هو البند 7 ج")
+
+def test_complex_questions_expand():
+    assert needs_expansion("Compare the EC-104 and EC-105 decisions on item 7C")
+    assert needs_expansion("What was decided? Who objected?")
+    assert needs_expansion("ما الفرق بين قرار المجلس وتوصية اللجنة")
+
+def test_resolve_mode(monkeypatch):
+    monkeypatch.setenv("RETRIEVAL_MODE", "fast")
+    assert resolve_mode(None) == "fast"
+    assert resolve_mode("deep") == "deep"
+    with pytest.raises(ValueError):
+        resolve_mode("turbo")
+
+class FakeIndex:
+    version = "test"
+
+    def __init__(self):
+        self.batches = []
+        self.depths = []
+
+    def hybrid_hits_batch(self, queries, top_k):
+        self.batches.append(list(queries))
+        self.depths.append(top_k)
+        return [[(f"{query}-{rank}", 1.0 / (rank + 1)) for rank in range(3)] for query in queries]
+
+    def embed_queries(self, queries):
+        # Questions about the budget are near duplicates of each other
+        return [[1.0, 0.0] if "budget" in query else [0.0, 1.0] for query in queries]
+
+    def get_documents(self, chunk_ids):
+        return [Document(page_content=chunk_id, metadata={"chunk_id": chunk_id}) for chunk_id in chunk_ids]
+
+def test_batch_searches_each_distinct_query_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("SEMANTIC_CACHE_ENABLED", "0")
+    index = FakeIndex()
+    retriever = RetrievalSystem(index)
+    translation = concurrent.futures.Future()
+    translation.set_result("b")
+    results = retriever.retrieve_batch(["a", "b", "a"], top_k=2, mode="fast", translations=[translation, None, None])
+    assert index.batches == [["a", "b"]]
+    assert results[0] is results[2]
+    assert [doc.page_content for doc in results[1]] == ["b-0", "b-1"]
+    # Served from the retrieval cache the second time
+    assert retriever.retrieve_batch(["b"], top_k=2, mode="fast")[0][0].page_content == "b-0"
+    assert len(index.batches) == 1
+
+def test_batch_searches_translations_as_deep_as_the_query(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("SEMANTIC_CACHE_ENABLED", "0")
+    index = FakeIndex()
+    retriever = RetrievalSystem(index)
+    translation = concurrent.futures.Future()
+    translation.set_result("c")
+    retriever.retrieve_batch(["a"], top_k=2, mode="fast", translations=[translation])
+    # Like retrieve(): the query and its translation are both searched top_k*3 deep
+    assert index.batches == [["a", "c"]]
+    assert index.depths == [6]
+
+def test_batch_stops_waiting_for_translations_at_the_deadline(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("SEMANTIC_CACHE_ENABLED", "0")
+    index = FakeIndex()
+    retriever = RetrievalSystem(index)
+    # A translation that never finishes
+    deadline = Deadline(0.1)
+    results = retriever.retrieve_batch(["a"], top_k=2, mode="fast", translations=[concurrent.futures.Future()],
+                                       deadline=deadline)
+    assert index.batches == [["a"]]
+    assert [doc.page_content for doc in results[0]] == ["a-0", "a-1"]
+    assert deadline.cut_stages == ["translation"]
+    # Results without the translation are not cached
+    retriever.retrieve_batch(["a"], top_k=2, mode="fast")
+    assert len(index.batches) == 2
+
+def test_batch_checks_the_semantic_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("SEMANTIC_CACHE_ENABLED", "1")
+    index = FakeIndex()
+    retriever = RetrievalSystem(index)
+    first = retriever.retrieve_batch(["the budget"], top_k=2, mode="fast")[0]
+    results = retriever.retrieve_batch(["budget approval", "minutes"], top_k=2, mode="fast")
+    assert results[0] == first
+    # Only the question that is not a near duplicate is searched
+    assert index.batches == [["the budget"], ["minutes"]]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for the concurrent retrieval fan-out
+"""
+
+import time
+from rag_tool.retrieval_executor import ConcurrentRetrievalExecutor
+
+def slow_search(query, k):
+    time.sleep(0.1)
+    return [(f"{query}-hit{i}", 1.0 - i/10) for i in range(2)]
+
+def slow_expansion(query):
+    time.sleep(0.1)
+    return [f"{query}-a", f"{query}-b"]
+
+def test_fan_out_overlaps_expansions_and_searches():
+    executor = ConcurrentRetrievalExecutor(max_workers=4)
+    started = time.time()
+    def slow_decomposition(query):
+        time.sleep(0.1)
+        return [f"{query}-c", f"{query}-d"]
+
+    accumulator = executor.run("q", slow_search, {"multi_query": slow_expansion, "decompose_query": slow_decomposition})
+    elapsed = time.time() - started
+
+    # 1 original search + 4 expansion searches, fused as they complete
+    assert accumulator.rankings == 5
+    # Serially this is 2 expansions + 5 searches = 0.7s
+    assert elapsed < 0.45
+
+def test_failed_expansion_is_skipped():
+    def broken(query):
+        raise RuntimeError("LLM unavailable")
+
+    accumulator = ConcurrentRetrievalExecutor(max_workers=2).run("q", slow_search, {"multi_query": broken})
+    assert accumulator.rankings == 1
+
+def test_fused_results_are_deduplicated():
+    def search(query, k):
+        return [("shared", 0.9), (f"{query}-only", 0.5)]
+
+    accumulator = ConcurrentRetrievalExecutor(max_workers=2).run("q", search, {"multi_query": slow_expansion})
+    fused = accumulator.fused()
+    assert accumulator.rankings == 3
+    assert [chunk_id for chunk_id, score in fused].count("shared") == 1
+    assert fused[0][0] == "shared"
+
+def test_translation_is_searched_deeply_and_duplicates_once():
+    calls = []
+
+    def search(query, k):
+        calls.append((query, k))
+        return [(f"{query}-hit", 1.0)]
+
+    expansions = {
+        "translation": lambda query: ["translated"],
+        "expand": lambda query: ["Q", "translated", "other"],
+    }
+    ConcurrentRetrievalExecutor(max_workers=4).run("q", search, expansions, top_k=10, primary=("translation",))
+    # "Q" is the original query and "translated" comes from both stages; each is searched once
+    queries = [query for query, k in calls]
+    assert sorted(queries) == ["other", "q", "translated"]
+    assert ("q", 30) in calls
+    assert ("other", 10) in calls
+
+def test_primary_stage_queries_are_searched_deeply():
+    calls = []
+
+    def search(query, k):
+        calls.append((query, k))
+        return [(f"{query}-hit", 1.0)]
+
+    ConcurrentRetrievalExecutor(max_workers=2).run("q", search, {"translation": lambda query: ["translated"]},
+                                                    top_k=10, primary=("translation",))
+    assert sorted(calls) == [("q", 30), ("translated", 30)]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Tests for the semantic near-duplicate query cache
+"""
+
+from rag_tool.semantic_cache import SemanticCache, guard_tokens
+
+def test_near_duplicate_hits_and_distant_misses():
+    cache = SemanticCache(threshold=0.9, capacity=10)
+    cache.add([1.0, 0.0, 0.1], "What did EC-104 decide on item 7C?", "answer")
+    assert cache.lookup([0.95, 0.0, 0.12], "EC-104 item 7C decision?") == "answer"
+    assert cache.lookup([0.0, 1.0, 0.0], "Who chairs the committee?") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_different_identifiers_are_false_hits():
+    cache = SemanticCache(threshold=0.9, capacity=10)
+    cache.add([1.0, 0.0], "decision on item 7C", "7C answer")
+    assert cache.lookup([1.0, 0.0], "decision on item 7D") is None
+    assert cache.stats()["false_hits"] == 1
+
+def test_scopes_do_not_mix():
+    cache = SemanticCache(threshold=0.9, capacity=10)
+    cache.add([1.0, 0.0], "question", "english", scope="en")
+    assert cache.lookup([1.0, 0.0], "question", scope="ar") is None
+    assert cache.lookup([1.0, 0.0], "question", scope="en") == "english"
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(threshold=0.9, capacity=2)
+    cache.add([1.0, 0.0, 0.0], "a", "A")
+    cache.add([0.0, 1.0, 0.0], "b", "B")
+    cache.lookup([1.0, 0.0, 0.0], "a")
+    cache.add([0.0, 0.0, 1.0], "c", "C")
+    assert cache.lookup([0.0, 1.0, 0.0], "b") is None
+    assert cache.lookup([1.0, 0.0, 0.0], "a") == "A"
+    assert cache.stats()["entries"] == 2
+
+def test_guard_tokens():
+    assert guard_tokens("EC-104 item 7C") == {"ec-104", "7c"}
+    assert guard_tokens("who chairs the committee") == frozenset()
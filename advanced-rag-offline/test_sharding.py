@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Tests for shard partitioning and the top-k merge of the sharded index
+"""
+
+import time
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rag_tool import indexing
+from rag_tool.sharding import ShardedIndex
+
+class FixedShard:
+    """Shard stand-in that returns a fixed, best-first hit list"""
+    def __init__(self, hits):
+        self.hits = hits
+
+    def search_by_vector(self, embedding, top_k=10):
+        return self.hits[:top_k]
+
+    def close(self):
+        pass
+
+def test_subtree_partition_keeps_files_together():
+    index = ShardedIndex("/docs", strategy="subtree")
+    chunks = [
+        Document(page_content="a", metadata={"source": "/docs/reports/2024/a.pdf"}),
+        Document(page_content="b", metadata={"source": "/docs/minutes/b.pdf"}),
+        Document(page_content="c", metadata={"source": "/docs/top.pdf"}),
+        Document(page_content="d", metadata={"source": "/docs/reports/d.pdf"}),
+    ]
+    partitions = index.partition(chunks)
+    assert sorted(partitions) == ["_root", "minutes", "reports"]
+    assert [c.page_content for c in partitions["reports"]] == ["a", "d"]
+    index.close()
+
+def test_hash_partition_is_stable():
+    index = ShardedIndex(strategy="hash", num_shards=3)
+    assert index.shard_for("/docs/a.pdf") == index.shard_for("/docs/a.pdf")
+    assert all(index.shard_for(f"/docs/{i}.pdf").startswith("shard_0") for i in range(20))
+    index.close()
+
+def test_search_merges_shards_by_score():
+    index = ShardedIndex(strategy="hash", num_shards=2)
+    index.shards = {
+        "shard_00": FixedShard([("a", 0.9), ("c", 0.5), ("e", 0.1)]),
+        "shard_01": FixedShard([("b", 0.8), ("d", 0.4)]),
+    }
+    assert index.search_by_vector([0.0], top_k=4) == [("a", 0.9), ("b", 0.8), ("c", 0.5), ("d", 0.4)]
+    index.close()
+
+def test_sparse_search_while_some_shards_are_dense(tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    index = ShardedIndex("/docs", strategy="subtree", max_workers=2)
+    index.build_sparse([
+        Document(page_content="annual budget report", metadata={"source": "/docs/reports/a.pdf", "start_index": 0}),
+        Document(page_content="quarterly spending plan", metadata={"source": "/docs/reports/c.pdf", "start_index": 0}),
+        Document(page_content="board meeting minutes", metadata={"source": "/docs/minutes/b.pdf", "start_index": 0}),
+        Document(page_content="staff meeting agenda", metadata={"source": "/docs/minutes/d.pdf", "start_index": 0}),
+        Document(page_content="security briefing notes", metadata={"source": "/docs/minutes/e.pdf", "start_index": 0}),
+    ], [])
+    index.shards["reports"].build_dense()
+    assert not index.dense_ready
+    # Every shard keeps its BM25 index until the whole sharded index is dense
+    hits = index.hybrid_hits("minutes", top_k=2)
+    assert index.get_documents([hits[0][0]])[0].page_content == "board meeting minutes"
+
+    dense = index.successor("build_dense")
+    assert dense.dense_ready and not index.shards["minutes"].dense_ready
+    full = dense.successor("build_raptor")
+    assert full.stage == "full" and all(shard.sparse_index is None for shard in full.shards.values())
+    # The served index is left as it was, so it still answers from BM25
+    assert index.hybrid_hits("minutes", top_k=2)[0] == hits[0]
+    index.release(full)
+    dense.release(full)
+    assert full.get_documents([full.search("annual budget report", top_k=1)[0][0]])[0].page_content == "annual budget report"
+    full.close()
+
+def test_replaced_shard_is_retired_after_a_delay(tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(indexing, "OllamaEmbeddings", lambda **kwargs: DeterministicFakeEmbedding(size=16))
+    monkeypatch.setattr(indexing, "INDEX_RETIRE_DELAY", 0.2)
+    monkeypatch.setenv("RAPTOR_ENABLED", "0")
+    index = ShardedIndex("/docs", strategy="subtree")
+    index.build_sparse([
+        Document(page_content="annual budget report", metadata={"source": "/docs/reports/a.pdf", "start_index": 0}),
+        Document(page_content="board meeting minutes", metadata={"source": "/docs/minutes/b.pdf", "start_index": 0}),
+    ], [])
+    # A search that picked the shard before the rebuild
+    shards = index.shards
+    previous = index.shards["reports"]
+    index.rebuild_shard("reports", [
+        Document(page_content="revised budget report", metadata={"source": "/docs/reports/a.pdf", "start_index": 0}),
+    ])
+    assert previous.chunk_store.text(0) == "annual budget report"
+    assert index.shards["reports"].chunk_store.text(0) == "revised budget report"
+    # The shard set is swapped, not changed under a running search
+    assert shards["reports"] is previous and index.shards is not shards
+    time.sleep(0.5)
+    assert previous.chunk_store.closed
+    assert index.shards["reports"].chunk_store.text(0) == "revised budget report"
+    index.close()
+
+def test_documents_are_read_from_the_shard_of_their_hit(tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    index = ShardedIndex("/docs", strategy="subtree")
+    index.build_sparse([
+        Document(page_content="annual budget report", metadata={"source": "/docs/reports/a.pdf", "start_index": 0}),
+        Document(page_content="quarterly sales figures", metadata={"source": "/docs/reports/c.pdf", "start_index": 0}),
+        Document(page_content="staff travel policy", metadata={"source": "/docs/reports/d.pdf", "start_index": 0}),
+        Document(page_content="board meeting minutes", metadata={"source": "/docs/minutes/b.pdf", "start_index": 0}),
+    ], [])
+    chunk_id, score = index.sparse_search("budget", top_k=1)[0]
+
+    probed = []
+    for shard_id, shard in index.shards.items():
+        get_documents = shard.get_documents
+        monkeypatch.setattr(shard, "get_documents",
+                            lambda ids, shard_id=shard_id, get_documents=get_documents: probed.append(shard_id) or get_documents(ids))
+    assert [doc.page_content for doc in index.get_documents([chunk_id])] == ["annual budget report"]
+    assert probed == ["reports"]
+    index.close()
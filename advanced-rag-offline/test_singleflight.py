@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Tests for single-flight request coalescing
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+import pytest
+from rag_tool.singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_computation():
+    flights = SingleFlight()
+    calls = []
+
+    def compute(question):
+        calls.append(question)
+        time.sleep(0.2)
+        return f"answer to {question}"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: flights.do("key", compute, "q"), range(4)))
+    assert results == ["answer to q"] * 4
+    assert calls == ["q"]
+    # Nothing is kept once the flight has landed
+    assert flights.do("key", compute, "q") == "answer to q"
+    assert len(calls) == 2
+
+def test_followers_receive_the_error():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError("Ollama unavailable")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flights.do, "key", fail)
+        started.wait()
+        follower = executor.submit(flights.do, "key", fail)
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError):
+                future.result()
+
+def test_async_callers_share_a_task_that_survives_cancellation():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "answer"
+
+    async def main():
+        leader = asyncio.ensure_future(flights.ado("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.ado("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == "answer"
+    assert calls == [1]
+
+def test_stream_subscribers_get_every_event():
+    flights = SingleFlight()
+    calls = []
+
+    def events():
+        calls.append(1)
+        for i in range(3):
+            time.sleep(0.05)
+            yield i
+
+    first = flights.stream("key", events)
+    assert next(first) == 0
+    # A late subscriber replays what it missed
+    second = flights.stream("key", events)
+    assert list(second) == [0, 1, 2]
+    assert list(first) == [1, 2]
+    assert calls == [1]
+
+def test_blocking_caller_joins_an_async_leader():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    async def compute():
+        calls.append("async")
+        started.set()
+        await asyncio.sleep(0.2)
+        return "answer"
+
+    async def main():
+        leader = asyncio.ensure_future(flights.ado("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.get_running_loop().run_in_executor(
+            None, flights.do, "key", lambda: calls.append("blocking") or "other answer")
+        return await asyncio.gather(leader, follower)
+
+    assert asyncio.run(main()) == ["answer", "answer"]
+    assert calls == ["async"]
+    assert not flights.flights
+
+def test_blocking_caller_joins_a_stream_and_a_stream_joins_a_blocking_leader():
+    flights = SingleFlight()
+    calls = []
+
+    def events():
+        calls.append("stream")
+        for i in range(3):
+            time.sleep(0.05)
+            yield i
+
+    stream = flights.stream("key", events, result_of=sum)
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        follower = pool.submit(flights.do, "key", lambda: calls.append("blocking") or -1)
+        assert list(stream) == [0, 1, 2]
+        # The blocking follower gets result_of(events) once the stream finishes
+        assert follower.result() == 3
+
+        leader = pool.submit(flights.do, "other", lambda: time.sleep(0.1) or 5)
+        time.sleep(0.02)
+        assert list(flights.stream("other", events, events_of=lambda result: [result, result])) == [5, 5]
+        assert leader.result() == 5
+    assert calls == ["stream"]
+    assert not flights.flights
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for the index snapshot shared by API worker processes
+"""
+
+import os
+from rag_tool import indexing
+from rag_tool.indexing import MultiRepresentationIndex
+from rag_tool.sharding import ShardedIndex
+from rag_tool.snapshot import IndexSnapshot, open_index, snapshot_key
+
+def test_snapshot_key_follows_documents_and_config(monkeypatch):
+    files = {"/docs/a.pdf": 1700000000.0}
+    key = snapshot_key(files, "en")
+    assert snapshot_key(dict(files), "en") == key
+    assert snapshot_key(files, "ar") != key
+    monkeypatch.setenv("INDEX_SHARDS", "2")
+    assert snapshot_key(files, "en") != key
+    monkeypatch.delenv("INDEX_SHARDS")
+    assert snapshot_key({**files, "/docs/b.pdf": 1700000001.0}, "en") != key
+    assert snapshot_key({"/docs/a.pdf": 1700000002.0}, "en") != key
+
+def test_publish_and_read(tmp_path):
+    snapshot = IndexSnapshot("abc", str(tmp_path))
+    assert snapshot.read() is None
+    snapshot.publish({"type": "single", "cache_key": "chunks_model"})
+    assert IndexSnapshot("abc", str(tmp_path)).read() == {"type": "single", "cache_key": "chunks_model"}
+    assert IndexSnapshot("other", str(tmp_path)).read() is None
+    # No temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["snapshot_abc.json"]
+
+def test_unreadable_manifest_is_ignored(tmp_path):
+    (tmp_path / "snapshot_abc.json").write_text("{not json")
+    assert IndexSnapshot("abc", str(tmp_path)).read() is None
+
+def test_index_descriptors(make_chunks, tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    index = MultiRepresentationIndex()
+    index.build_sparse(make_chunks(), [])
+    assert index.snapshot() == {"type": "single", "cache_key": index.cache_key, "stage": "sparse"}
+
+    sharded = ShardedIndex(strategy="hash", num_shards=2, max_workers=2)
+    sharded.build_sparse(make_chunks(), [])
+    descriptor = sharded.snapshot()
+    assert descriptor["type"] == "sharded"
+    assert (descriptor["strategy"], descriptor["num_shards"]) == ("hash", 2)
+    assert descriptor["shard_keys"] == sharded.shard_keys
+    assert descriptor["stage"] == "sparse"
+    index.chunk_store.close()
+    sharded.close()
+
+def test_unfinished_snapshot_opens_without_embedding(make_chunks, tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(MultiRepresentationIndex, "_load_or_create_dense_index",
+                        lambda self, *args: (_ for _ in ()).throw(AssertionError("embedded while opening")))
+    built = MultiRepresentationIndex()
+    built.build_sparse(make_chunks(), [])
+    opened = open_index(built.snapshot())
+    assert opened.stage == "sparse"
+    assert opened.sparse_index is not None and not opened.dense_ready
+    built.chunk_store.close()
+    opened.close()
+
+def test_one_owner_per_snapshot(tmp_path):
+    first, second = IndexSnapshot("abc", str(tmp_path)), IndexSnapshot("abc", str(tmp_path))
+    assert first.own()
+    # Owning again is a no-op for the owner; other processes (instances) are refused
+    assert first.own()
+    assert not second.own()
+    first.disown()
+    assert second.own()
+    second.disown()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Tests for the BM25 index served before the dense index is built
+"""
+
+from rag_tool import indexing
+from rag_tool.chunk_store import ChunkStore, chunk_id_for
+from rag_tool.indexing import MultiRepresentationIndex
+from rag_tool.sparse_index import SparseIndex
+
+def test_bm25_ranks_matching_chunks(make_chunks, tmp_path):
+    chunks = make_chunks()
+    store = ChunkStore.build(chunks, str(tmp_path / "store"))
+    index = SparseIndex(store)
+    hits = index.search("budget committee", top_k=3)
+    assert hits[0][0] == chunk_id_for(chunks[0])
+    # Chunks sharing no term with the query are left out
+    assert chunk_id_for(chunks[1]) not in [chunk_id for chunk_id, score in hits]
+    assert index.search("الميزانية")[0][0] == chunk_id_for(chunks[1])
+    assert index.search("") == []
+    store.close()
+
+def test_index_serves_sparse_hits_before_dense_build(make_chunks, tmp_path, monkeypatch):
+    monkeypatch.setattr(indexing, "CACHE_DIR", str(tmp_path))
+    index = MultiRepresentationIndex()
+    index.build_sparse(make_chunks(), [])
+    assert index.stage == "sparse"
+    assert not index.dense_ready
+    sparse_version = index.version
+    hits = index.hybrid_hits("security meeting", top_k=2)
+    assert [doc.page_content for doc in index.get_documents([hits[0][0]])] == ["Minutes of the security committee meeting"]
+    assert index.hybrid_hits_batch(["security meeting"], top_k=2) == [hits]
+    # A finished index gets another version, so results from the partial index are not reused
+    index.stage = "full"
+    assert index.version != sparse_version
+    index.close()
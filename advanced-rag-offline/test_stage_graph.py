@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for the stage DAG executor
+"""
+
+import asyncio
+import time
+import pytest
+from rag_tool.stage_graph import StageGraph
+
+def slow(value, seconds=0.2):
+    def stage(context):
+        time.sleep(seconds)
+        return value
+    return stage
+
+def test_independent_stages_run_concurrently():
+    graph = StageGraph("test")
+    graph.add("a", slow(1))
+    graph.add("b", slow(2))
+    graph.add("sum", lambda ctx: ctx["a"] + ctx["b"] + ctx["offset"], after=("a", "b"))
+    started = time.perf_counter()
+    context, timings = graph.run({"offset": 10})
+    assert context["sum"] == 13
+    assert time.perf_counter() - started < 0.35
+    assert timings["sum"]["start"] >= max(timings["a"]["wall"], timings["b"]["wall"])
+    assert timings["a"]["cpu"] < timings["a"]["wall"]
+    assert graph.stats()["a"]["runs"] == 1
+
+def test_on_stage_reports_each_stage_before_its_dependents_start():
+    graph = StageGraph("test")
+    graph.add("a", slow(1, 0.05))
+    graph.add("skipped", lambda ctx: "ran", when=lambda ctx: False)
+    graph.add("b", lambda ctx: reported[:], after=("a", "skipped"))
+    reported = []
+    context, timings = graph.run({}, on_stage=lambda name, ctx: reported.append((name, ctx[name])))
+    assert context["b"] == [("skipped", None), ("a", 1)]
+    assert reported[-1] == ("b", [("skipped", None), ("a", 1)])
+
+def test_skipped_stages_leave_none_and_dependents_run():
+    graph = StageGraph("test")
+    graph.add("warm", lambda ctx: "warmed")
+    graph.add("optional", lambda ctx: "ran", when=lambda ctx: ctx["enabled"])
+    graph.add("final", lambda ctx: (ctx["warm"], ctx["optional"]), after=("warm", "optional"))
+    context, timings = graph.run({"enabled": False}, skip={"warm"})
+    assert context["final"] == (None, None)
+    assert timings["warm"] == {"skipped": True}
+    assert timings["optional"] == {"skipped": True}
+    with pytest.raises(ValueError):
+        graph.run({"enabled": True}, skip={"unknown"})
+
+def test_dependencies_must_exist():
+    graph = StageGraph("test")
+    with pytest.raises(ValueError):
+        graph.add("b", lambda ctx: None, after=("a",))
+
+def test_stage_failure_propagates():
+    graph = StageGraph("test")
+    graph.add("fails", lambda ctx: 1 / 0)
+    graph.add("after", lambda ctx: "never", after=("fails",))
+    with pytest.raises(ZeroDivisionError):
+        graph.run({})
+
+def test_async_run_awaits_async_stages():
+    async def double(context):
+        await asyncio.sleep(0.2)
+        return context["sync"] * 2
+
+    graph = StageGraph("test")
+    graph.add("sync", slow(21))
+    graph.add("other", slow(None))
+    graph.add("double", lambda ctx: None, after=("sync",), afn=double)
+    context, timings = asyncio.run(graph.arun({}))
+    assert context["double"] == 42
+    assert timings["double"]["cpu"] is None
+    assert timings["sync"]["cpu"] is not None
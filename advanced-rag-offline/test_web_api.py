@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming endpoint and the metrics of the web API
+"""
+
+import json
+from pathlib import Path
+import pytest
+from fastapi.testclient import TestClient
+import web_api
+
+DOCUMENTS = {
+    "budget.pdf": "The committee approved the budget for the new library.",
+    "security.pdf": "Minutes of the security meeting about the server room.",
+}
+
+@pytest.fixture
+def client(make_pipeline, monkeypatch):
+    monkeypatch.setattr(web_api, "PIPELINE", make_pipeline(DOCUMENTS))
+    # Without a `with` block the lifespan (Ollama check, background build) does not run
+    return TestClient(web_api.app)
+
+def stream(client, query):
+    response = client.post("/invoke/stream", json={"query": query, "mode": "fast"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.text.endswith("\n")
+    # One JSON object per line
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_stream_framing(client, fake_models):
+    events = stream(client, "Who approved the budget?")
+    assert events[0]["type"] == "metadata"
+    assert events[0]["cached"] is False
+    assert events[0]["source_language"] == "en"
+    assert events[0]["sources"]
+    assert {Path(source).name for source in events[0]["sources"]} <= set(DOCUMENTS)
+    tokens = [event["text"] for event in events[1:-1]]
+    assert all(event["type"] == "token" for event in events[1:-1])
+    assert "".join(tokens).strip() == fake_models.answer
+    done = events[-1]
+    assert done["type"] == "done"
+    assert done["cut_stages"] == []
+    assert done["stats"]["tokens"] == len(tokens)
+    assert done["stats"]["time_to_first_token"] <= done["stats"]["total_time"]
+    # Streaming runs the query graph; only its generate stage streams
+    assert {"detect_language", "retrieve", "build_prompt", "generate"} <= set(done["stage_timings"])
+    assert done["stage_timings"]["warm_generator"].get("skipped") is None
+
+def test_streamed_cache_hit(client, fake_models):
+    first = stream(client, "Who approved the budget?")
+    generated = len(fake_models.calls)
+    events = stream(client, "Who approved the budget?")
+    assert [event["type"] for event in events] == ["metadata", "token", "done"]
+    assert events[0]["cached"] is True
+    assert events[1]["text"] == "".join(event["text"] for event in first[1:-1])
+    assert events[2]["stats"]["cached"] is True
+    assert len(fake_models.calls) == generated
+
+def test_error_mid_stream(client, fake_models):
+    fake_models.fail_after = 2
+    events = stream(client, "Who approved the budget?")
+    assert [event["type"] for event in events] == ["metadata", "token", "token", "error"]
+    assert "Generator connection lost" in events[-1]["detail"]
+    # A failed answer is not cached
+    fake_models.fail_after = None
+    events = stream(client, "Who approved the budget?")
+    assert events[0]["cached"] is False
+    assert events[-1]["type"] == "done"
+
+def test_invoke_returns_original_documents(client, fake_models):
+    response = client.post("/invoke", json={"query": "Who approved the budget?", "mode": "fast",
+                                            "return_original": True})
+    assert response.status_code == 200
+    assert response.json()["original_response"].startswith("Source: ")
+    # The documents are returned as they are, without a generation
+    assert not fake_models.calls
+
+def test_metrics_label_requests_by_route(client):
+    client.get("/health")
+    client.get("/no/such/path")
+    text = client.get("/metrics").text
+    assert 'rag_requests_total{endpoint="/health",status="200"}' in text
+    assert 'rag_requests_total{endpoint="other",status="404"}' in text
+    assert 'rag_pipeline_phase{phase="ready"} 1\n' in text
+    assert "rag_corpus_files 2\n" in text
+    assert "/invoke/stream" in web_api.KNOWN_PATHS
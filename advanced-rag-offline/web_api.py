@@ -1,15 +1,19 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 from rag_tool.pipeline import FocusedRAGPipeline
+from rag_tool.corpus_watcher import CorpusWatcher
+from rag_tool.metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, Gauge
 import os
 import uvicorn
 import shutil
 from pathlib import Path
 import glob
 import json
-from fastapi.responses import JSONResponse
+import time
+from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.openapi.utils import get_openapi
 
 from contextlib import asynccontextmanager
@@ -17,12 +21,13 @@ from contextlib import asynccontextmanager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global PIPELINE
+    watcher = None
     try:
         docs_path = os.getenv("DOCS_PATH", "./documents")
         docs_lang = os.getenv("DOCS_LANG", "ar")
         print(f"Starting RAG pipeline initialization with docs_path={docs_path}, docs_lang={docs_lang}")
         
-        # Check Ollama connectivity before initializing pipeline
+        # Check Ollama connectivity; the BM25 index is built without it, so this is not fatal
         ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         print(f"Checking Ollama connectivity at {ollama_base_url}...")
         try:
@@ -32,43 +37,28 @@ async def lifespan(app: FastAPI):
                 print("✅ Ollama is accessible")
             else:
                 print(f"❌ Ollama returned status code {response.status_code}")
-                raise Exception(f"Ollama connectivity failed with status {response.status_code}")
         except Exception as ollama_error:
             print(f"❌ Ollama connectivity check failed: {str(ollama_error)}")
-            raise Exception(f"Cannot connect to Ollama at {ollama_base_url}. Please ensure Ollama is running and accessible.")
+            print(f"⚠️ Answers and the dense index need Ollama at {ollama_base_url}; continuing startup")
         
         print("Creating pipeline...")
         PIPELINE = FocusedRAGPipeline(docs_path, docs_lang)
-        print("Pipeline created, starting initialization...")
-        
-        # Add timeout to initialization
-        import concurrent.futures
-        import threading
-        def initialize_pipeline():
-            try:
-                PIPELINE.initialize()
-                return True
-            except Exception as e:
-                print(f"Pipeline initialization failed: {str(e)}")
-                raise
-        
-        # Run initialization with timeout
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(initialize_pipeline)
-            try:
-                result = future.result(timeout=300)  # 5 minute timeout
-                if result:
-                    print("Pipeline initialization completed successfully")
-            except concurrent.futures.TimeoutError:
-                print("❌ Pipeline initialization timed out after 5 minutes")
-                PIPELINE = None
-                raise Exception("Pipeline initialization timed out. This might be due to large documents, missing models, or connectivity issues.")
+        # Build the indexes in the background so the API starts right away;
+        # /health reports the phase and queries are served from the first usable index
+        init_thread = PIPELINE.start_background_initialization()
+        print("Pipeline created, initializing in the background")
+        # New, changed and deleted documents are reindexed without a restart
+        if os.getenv("CORPUS_WATCH_ENABLED", "1") == "1":
+            watcher = CorpusWatcher(PIPELINE)
+            watcher.start(after=init_thread)
     except Exception as e:
-        print(f"❌ Pipeline initialization failed: {str(e)}")
+        print(f"❌ Pipeline creation failed: {str(e)}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         PIPELINE = None
     yield
+    if watcher is not None:
+        watcher.stop()
 
 app = FastAPI(
     title="Offline RAG Pipeline",
@@ -86,6 +76,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    """In-flight gauge, count and duration per endpoint; streamed responses count until their last byte"""
+    endpoint = request.url.path if request.url.path in KNOWN_PATHS else "other"
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    try:
+        response = await call_next(request)
+    except Exception:
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status="500")
+        raise
+    body = response.body_iterator
+
+    async def tracked_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+    response.body_iterator = tracked_body()
+    return response
+
+PIPELINE_PHASE = REGISTRY.register(Gauge(
+    "rag_pipeline_phase", "Current initialization phase (1 for the current one)", ["phase"]))
+CORPUS_FILES = REGISTRY.register(Gauge("rag_corpus_files", "Document files in the served index"))
+
+def pipeline_metrics():
+    """Pipeline state for /metrics, read at scrape time"""
+    if PIPELINE is not None:
+        PIPELINE_PHASE.set_only(1, phase=PIPELINE.phase)
+        CORPUS_FILES.set(len(PIPELINE.corpus_files))
+
+REGISTRY.add_collector(pipeline_metrics)
+
 @app.get("/")
 def root():
     return {
@@ -104,6 +132,18 @@ class ToolInput(BaseModel):
     query: str
     target_lang: Optional[str] = None
     return_original: bool = False
+    # Retrieval depth: "fast", "balanced" or "deep" (default: RETRIEVAL_MODE)
+    mode: Optional[Literal["fast", "balanced", "deep"]] = None
+    # Latency budget for translation, expansion and searches; late stages are cut
+    latency_budget_ms: Optional[int] = None
+
+class BatchInput(BaseModel):
+    queries: List[str]
+    target_lang: Optional[str] = None
+    return_original: bool = False
+    mode: Optional[Literal["fast", "balanced", "deep"]] = None
+    # Latency budget for the query translations and expansions of the whole batch
+    latency_budget_ms: Optional[int] = None
 
 # Cache directory
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
@@ -111,6 +151,16 @@ CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
 # Initialize pipeline
 PIPELINE = None
 
+def require_pipeline():
+    """Raise 503 while no index is usable yet, 500 if the pipeline could not start"""
+    if PIPELINE is None:
+        raise HTTPException(status_code=500, detail="Pipeline failed to initialize")
+    if not PIPELINE.is_initialized:
+        if PIPELINE.phase == "failed":
+            raise HTTPException(status_code=500, detail=f"Pipeline failed to initialize: {PIPELINE.init_error}")
+        raise HTTPException(status_code=503, detail=f"Pipeline is initializing ({PIPELINE.phase})",
+                            headers={"Retry-After": "10"})
+
 
 # @app.post("/query")
 # async def query_endpoint(request: QueryRequest):
@@ -133,10 +183,13 @@ PIPELINE = None
 
 @app.post("/invoke")
 async def invoke_endpoint(input: ToolInput):
-    if PIPELINE is None:
-        raise HTTPException(status_code=500, detail="Pipeline failed to initialize")
+    require_pipeline()
     try:
-        result = PIPELINE.query(input.query, input.target_lang)
+        latency_budget = input.latency_budget_ms / 1000 if input.latency_budget_ms else None
+        # Async path: retrieval runs in worker threads and generation is awaited,
+        # so other requests (and /health) are served meanwhile
+        result = await PIPELINE.aquery(input.query, input.target_lang, input.return_original, mode=input.mode,
+                                      latency_budget=latency_budget)
         response_data = {
             "response": result["original_response"],
             "translation": result.get("translation"),
@@ -152,34 +205,107 @@ async def invoke_endpoint(input: ToolInput):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/invoke/stream")
+def invoke_stream_endpoint(input: ToolInput):
+    """Stream the answer as NDJSON: a metadata line, token lines, then a done line with timing stats"""
+    require_pipeline()
+    latency_budget = input.latency_budget_ms / 1000 if input.latency_budget_ms else None
+    
+    def events():
+        try:
+            for event in PIPELINE.query_stream(input.query, input.target_lang, input.return_original,
+                                               mode=input.mode, latency_budget=latency_budget):
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception as e:
+            # Headers are already sent, so errors are reported in the stream
+            yield json.dumps({"type": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+    
+    # A sync generator is iterated in the threadpool, so the event loop stays free
+    return StreamingResponse(events(), media_type="application/x-ndjson; charset=utf-8")
+
+@app.post("/invoke/batch")
+def invoke_batch_endpoint(input: BatchInput):
+    """Answer many queries; one NDJSON line per query, in completion order, tagged with its index"""
+    require_pipeline()
+    latency_budget = input.latency_budget_ms / 1000 if input.latency_budget_ms else None
+    
+    def results():
+        try:
+            for index, result in PIPELINE.query_batch(input.queries, input.target_lang, input.return_original,
+                                                      mode=input.mode, latency_budget=latency_budget):
+                yield json.dumps({"index": index, "query": input.queries[index], **result}, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson; charset=utf-8")
+
 @app.get("/health")
 def health_check():
     if PIPELINE is None:
         return {"status": "unhealthy", "initialized": False, "error": "Pipeline failed to initialize"}
     
+    readiness = PIPELINE.readiness()
+    if readiness["phase"] == "failed":
+        status = "unhealthy"
+    elif not readiness["serving"]:
+        status = "initializing"
+    elif readiness["error"]:
+        # A later build stage failed; queries use the last usable index
+        status = "degraded"
+    elif readiness["phase"] != "ready":
+        status = "warming"
+    else:
+        status = "healthy"
+    
     # Check cache status
     cache_exists = os.path.exists(CACHE_DIR)
     cache_files = len(glob.glob(os.path.join(CACHE_DIR, "*.pkl"))) if cache_exists else 0
     
     return {
-        "status": "healthy", 
-        "initialized": PIPELINE.is_initialized if PIPELINE else False,
+        "status": status,
+        "initialized": PIPELINE.is_initialized,
+        "readiness": readiness,
         "cache": {
             "exists": cache_exists,
             "file_count": cache_files
         }
     }
 
+def clear_memory_caches():
+    """Drop the in-memory answer, retrieval and semantic cache tiers"""
+    if PIPELINE and PIPELINE.cache:
+        PIPELINE.cache.clear_memory()
+    if PIPELINE and PIPELINE.retriever:
+        PIPELINE.retriever.cache.clear_memory()
+    if PIPELINE and PIPELINE.semantic_cache:
+        PIPELINE.semantic_cache.clear()
+    if PIPELINE and PIPELINE.retriever and PIPELINE.retriever.semantic_cache:
+        PIPELINE.retriever.semantic_cache.clear()
+
 @app.post("/cache/clear")
-def clear_cache():
-    """Clear all cached data"""
+def clear_cache(answers_only: bool = False):
+    """Clear all cached data, or with answers_only only cached retrievals and answers"""
     from rag_tool.indexing import MultiRepresentationIndex
     
+    if answers_only:
+        clear_memory_caches()
+        removed = 0
+        for cache_file in glob.glob(os.path.join(CACHE_DIR, "retrieval_*.pkl")) + glob.glob(os.path.join(CACHE_DIR, "query_*.pkl")):
+            try:
+                os.remove(cache_file)
+                removed += 1
+            except OSError as e:
+                print(f"Warning: Error deleting {cache_file}: {str(e)}")
+        return {"message": f"Cleared {removed} cached retrievals and answers"}
+    
     if os.path.exists(CACHE_DIR):
         try:
             # Properly close Chroma clients and clean up persistence directories
             if PIPELINE and PIPELINE.index:
                 PIPELINE.index.close()
+            
+            # Drop in-memory cache entries along with the files
+            clear_memory_caches()
                 
             # Remove Chroma persistence directories
             chroma_dirs = [d for d in os.listdir(CACHE_DIR) if d.startswith("chroma_")]
@@ -235,15 +361,32 @@ def cache_status():
     try:
         cache_files = glob.glob(os.path.join(CACHE_DIR, "*.pkl"))
         total_size = sum(os.path.getsize(f) for f in cache_files)
+        semantic = {}
+        if PIPELINE and PIPELINE.semantic_cache:
+            semantic["answers"] = PIPELINE.semantic_cache.stats()
+        if PIPELINE and PIPELINE.retriever and PIPELINE.retriever.semantic_cache:
+            semantic["retrieval"] = PIPELINE.retriever.semantic_cache.stats()
+        tiers = {}
+        if PIPELINE and PIPELINE.cache:
+            tiers["answers"] = PIPELINE.cache_stats()
+        if PIPELINE and PIPELINE.retriever:
+            tiers["retrieval"] = PIPELINE.retriever.cache.stats()
         return {
             "exists": True,
             "file_count": len(cache_files),
             "size": total_size,
-            "size_mb": round(total_size / (1024 * 1024), 2)
+            "size_mb": round(total_size / (1024 * 1024), 2),
+            "tiers": tiers,
+            "semantic": semantic
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get cache status: {str(e)}")
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Metrics of this worker process in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
@@ -266,5 +409,8 @@ def custom_openapi():
 
 app.openapi = custom_openapi
 
+# Paths of all routes defined above; track_requests labels any other path "other"
+KNOWN_PATHS = frozenset(route.path for route in app.routes)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)